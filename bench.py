@@ -0,0 +1,564 @@
+"""Бенчмарки бота.
+
+Запуск:  python bench.py <бенчмарк> [параметры]
+Список:  python bench.py --help
+
+Микробенчмарки горячих функций с базовой линией на диске:
+
+    python bench.py micro --save               # записать bench_baseline.json
+    python bench.py micro --compare            # сравнить с ним, код 1 при регрессии
+    python bench.py micro --sizes 1000,100000  # без таблицы на миллион строк
+
+Базовая линия — замеры конкретной машины, в репозитории её нет: на новой
+машине (или после смены Python/SQLite) её сначала записывают через --save
+с той же версии кода, а потом сравнивают изменения с ней. Вместе с
+замерами сохраняются машина и версии; --compare предупреждает, если они
+не совпадают с текущими, — тогда сравнение мало что значит.
+"""
+import os
+import sys
+import json
+import platform
+import time
+import timeit
+import sqlite3
+import asyncio
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+from aiogram import Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+import main
+
+BENCHMARKS = {}
+
+
+def benchmark(name: str, help_text: str):
+    def decorator(func):
+        BENCHMARKS[name] = (func, help_text)
+        return func
+    return decorator
+
+
+# ===================== ВСПОМОГАТЕЛЬНОЕ =====================
+
+SAMPLE_FORM = {
+    "full_name": "Иванов Иван Иванович",
+    "place_birth": "г. Москва",
+    "email": "ivanov@example.com",
+    "passport_number": "4510 123456",
+    "home_address": "Москва, ул. Ленина, д. 1, кв. 1, 101000",
+    "phone": "+7 999 123-45-67",
+    "father_name": "Иванов Иван",
+    "father_birth_place": "г. Тула",
+    "mother_name": "Иванова Мария",
+    "mother_birth_place": "г. Калуга",
+    "marital_status": "женат",
+    "spouse_name": "Иванова Анна",
+    "spouse_birth_place": "г. Москва",
+    "work_place": "ООО Ромашка",
+    "work_address": "Москва, ул. Тверская, д. 2",
+    "airport": "Даболим",
+    "visa_term": "1 год",
+    "arrival_date": "2026-12-01",
+    "contact_name": "Петров Пётр",
+    "contact_phone": "+7 999 765-43-21",
+    "contact_address": "Москва, ул. Арбат, д. 3",
+    "hotel_booked": "Нет",
+    "hotel_details": "",
+    "five_year_visa": "Нет",
+    "visa_refusal": "Нет",
+    "visa_refusal_details": "",
+    "trips_last_5y": "2023-01 туризм",
+    "last_visa_details": "нет",
+    "outside_india": "Да",
+    "overstay": "Нет",
+}
+
+
+def setup_db(tmpdir: str) -> str:
+    main.DB_PATH = os.path.join(tmpdir, "bench.db")
+    main.init_db()
+    return main.DB_PATH
+
+
+def fill_applications(count: int, batch: int = 10000):
+    # Быстрое заполнение таблицы: одна транзакция, executemany пачками
+    conn = main.get_conn()
+    columns = ["user_id", "username", "created_at", "created_ts", "status"] + list(SAMPLE_FORM)
+    placeholders = ", ".join("?" for _ in columns)
+    sql = f"INSERT INTO applications ({', '.join(columns)}) VALUES ({placeholders})"
+    statuses = ["в ожидании", "одобрена", "отклонена"]
+    start_ts = int(time.time()) - count
+    with conn:
+        for offset in range(0, count, batch):
+            rows = []
+            for i in range(offset, min(count, offset + batch)):
+                ts = start_ts + i
+                rows.append(
+                    [i, f"user{i}", main.format_ts(ts), ts, statuses[i % 3]]
+                    + list(SAMPLE_FORM.values())
+                )
+            conn.executemany(sql, rows)
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100 * (len(values) - 1)))))
+    return values[k]
+
+
+def print_latencies(title: str, latencies, extra: str = ""):
+    ms = [v * 1000 for v in latencies]
+    print(
+        f"{title:<10} n={len(ms):<6} "
+        f"p50={percentile(ms, 50):8.2f} ms  "
+        f"p99={percentile(ms, 99):8.2f} ms  "
+        f"max={max(ms, default=0):8.2f} ms  {extra}"
+    )
+
+
+# ===================== БЕНЧМАРКИ =====================
+
+async def _handler_latency(blocking: bool, db_probe: bool, writers: int,
+                           duration: float, interval: float):
+    # Апдейты других пользователей приходят с постоянной частотой, пока
+    # writers корутин непрерывно сохраняют анкеты. Латентность считается от
+    # момента прихода апдейта, поэтому блокировка event loop синхронным
+    # commit'ом попадает в измерение. db_probe=False — шаг анкеты без БД,
+    # db_probe=True — чтение заявки.
+    latencies = []
+    writes = 0
+    deadline = time.perf_counter() + duration
+
+    async def handle_update():
+        if not db_probe:
+            await asyncio.sleep(0)
+        elif blocking:
+            main.get_application(1)
+        else:
+            await main.run_db(main.get_application, 1)
+
+    async def writer():
+        nonlocal writes
+        while time.perf_counter() < deadline:
+            if blocking:
+                main.save_application(1, "bench", SAMPLE_FORM)
+                await asyncio.sleep(0)
+            else:
+                await main.run_db(main.save_application, 1, "bench", SAMPLE_FORM)
+            writes += 1
+
+    async def update(arrival: float):
+        await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+        await handle_update()
+        latencies.append(time.perf_counter() - arrival)
+
+    tasks = [asyncio.create_task(writer()) for _ in range(writers)]
+    start = time.perf_counter()
+    arrivals = int(duration / interval)
+    await asyncio.gather(*(update(start + i * interval) for i in range(arrivals)))
+    await asyncio.gather(*tasks)
+    return latencies, writes
+
+
+@benchmark("handler-latency", "p99 латентности хендлеров при параллельной записи анкет")
+def bench_handler_latency(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        setup_db(tmpdir)
+        for db_probe in (False, True):
+            print("хендлер с запросом к БД:" if db_probe else "хендлер без БД:")
+            for blocking in (True, False):
+                latencies, writes = asyncio.run(
+                    _handler_latency(
+                        blocking, db_probe, args.writers, args.duration, args.interval
+                    )
+                )
+                print_latencies(
+                    "blocking" if blocking else "run_db",
+                    latencies,
+                    f"writes={writes}",
+                )
+
+
+def _legacy_conn():
+    # Поведение до пула: новое соединение на каждый запрос, rollback-журнал
+    conn = sqlite3.connect(main.DB_PATH)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _legacy_is_admin(user_id: int) -> bool:
+    conn = _legacy_conn()
+    row = conn.execute("SELECT 1 FROM admins WHERE user_id=?", (user_id,)).fetchone()
+    conn.close()
+    return row is not None
+
+
+def _legacy_get_application(app_id: int):
+    conn = _legacy_conn()
+    row = conn.execute("SELECT * FROM applications WHERE id=?", (app_id,)).fetchone()
+    conn.close()
+    return row
+
+
+def _legacy_update_status(app_id: int):
+    conn = _legacy_conn()
+    conn.execute(
+        "UPDATE applications SET status=?, admin_id=?, admin_comment=? WHERE id=?",
+        ("одобрена", 1, "", app_id),
+    )
+    conn.commit()
+    conn.close()
+
+
+def _qps(func, duration: float) -> float:
+    count = 0
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        func(count)
+        count += 1
+    return count / duration
+
+
+@benchmark("db-qps", "запросов в секунду: соединение на запрос против пула WAL")
+def bench_db_qps(args):
+    rows = 1000
+    cases = [
+        ("is_admin", _legacy_is_admin, lambda i: main.is_admin(main.SUPER_ADMIN_ID + i % 2)),
+        (
+            "get_application",
+            _legacy_get_application,
+            lambda i: main.get_application(i % rows + 1),
+        ),
+        (
+            "update_status",
+            _legacy_update_status,
+            lambda i: main.update_application_status(i % rows + 1, "одобрена", 1),
+        ),
+    ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        setup_db(tmpdir)
+        for _ in range(rows):
+            main.save_application(1, "bench", SAMPLE_FORM)
+        # старый режим: rollback-журнал и синхронный fsync по умолчанию
+        main.close_db()
+        conn = sqlite3.connect(main.DB_PATH)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+        legacy = {}
+        for name, func, _ in cases:
+            if name == "is_admin":
+                legacy[name] = _qps(lambda i: func(main.SUPER_ADMIN_ID + i % 2), args.duration)
+            else:
+                legacy[name] = _qps(lambda i: func(i % rows + 1), args.duration)
+        main.init_db()
+        for name, _, func in cases:
+            pooled = _qps(func, args.duration)
+            print(
+                f"{name:<16} до: {legacy[name]:10.0f} q/s   "
+                f"после: {pooled:10.0f} q/s   x{pooled / max(legacy[name], 1):.1f}"
+            )
+
+
+@benchmark("list-plan", "план запроса и время list_applications")
+def bench_list_plan(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        setup_db(tmpdir)
+        fill_applications(args.rows)
+        conn = main.get_conn()
+        queries = {
+            "pending": (
+                "SELECT id, created_ts, username, status FROM applications "
+                "WHERE status=? ORDER BY created_ts DESC, id DESC LIMIT ?",
+                ("в ожидании", 20),
+            ),
+            "all": (
+                "SELECT id, created_ts, username, status FROM applications "
+                "ORDER BY created_ts DESC, id DESC LIMIT ?",
+                (20,),
+            ),
+        }
+        for name, (sql, params) in queries.items():
+            plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            print(f"{name}: " + "; ".join(row["detail"] for row in plan))
+        for status in ("в ожидании", None):
+            count = 0
+            deadline = time.perf_counter() + args.duration
+            while time.perf_counter() < deadline:
+                main.list_applications(status=status)
+                count += 1
+            per_call = args.duration / count * 1e6
+            print(f"list_applications(status={status!r}): {per_call:.1f} мкс/вызов")
+
+
+async def _dispatch_cost(handlers: int, routed: bool, updates: int) -> float:
+    # Время Dispatcher.process_update на одно нажатие кнопки, когда
+    # зарегистрировано handlers кнопок с разными префиксами, а нажимается
+    # случайная из них
+    dp = Dispatcher(main.bot, storage=MemoryStorage())
+    prefixes = [f"btn{i}" for i in range(handlers)]
+
+    async def handler(*args):
+        pass
+
+    if routed:
+        router = main.CallbackRouter()
+        for prefix in prefixes:
+            router.add(main.CallbackCodec(prefix, ("app_id", int)), handler)
+
+        async def catch_all(callback_query: types.CallbackQuery, state):
+            await router.dispatch(callback_query, state, main.ROLE_USER)
+
+        dp.register_callback_query_handler(catch_all, state="*")
+    else:
+        for prefix in prefixes:
+            dp.register_callback_query_handler(
+                handler, lambda c, p=prefix + ":": c.data.startswith(p)
+            )
+
+    user = {"id": 1, "is_bot": False, "first_name": "bench"}
+    message = {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "x"}
+    batch = [
+        types.Update(**{
+            "update_id": i,
+            "callback_query": {
+                "id": str(i),
+                "from": user,
+                "chat_instance": "bench",
+                "message": message,
+                "data": f"{random.choice(prefixes)}:{i}",
+            },
+        })
+        for i in range(updates)
+    ]
+    Dispatcher.set_current(dp)
+    started = time.perf_counter()
+    for update in batch:
+        await dp.process_update(update)
+    return (time.perf_counter() - started) / updates
+
+
+@benchmark("callback-dispatch", "стоимость разбора нажатия кнопки: лямбда-фильтры против CallbackRouter")
+def bench_callback_dispatch(args):
+    updates = 20000
+    for handlers in (4, 16, 64, 256):
+        linear = asyncio.run(_dispatch_cost(handlers, False, updates))
+        routed = asyncio.run(_dispatch_cost(handlers, True, updates))
+        print(
+            f"хендлеров: {handlers:<4} фильтры: {linear * 1e6:8.1f} мкс/апдейт   "
+            f"роутер: {routed * 1e6:8.1f} мкс/апдейт   x{linear / routed:.1f}"
+        )
+
+
+@benchmark("export", "выгрузка заявок в CSV/JSONL/XLSX: время и пиковая память Python")
+def bench_export(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        setup_db(tmpdir)
+        fill_applications(args.rows)
+        formats = [fmt for fmt in main.EXPORT_FORMATS if fmt != "xlsx" or main.Workbook]
+        for fmt in formats:
+            started = time.perf_counter()
+            out, count = main.export_applications(fmt)
+            elapsed = time.perf_counter() - started
+            size = out.seek(0, os.SEEK_END)
+            out.close()
+
+            # Отдельный прогон под tracemalloc: он замедляет выполнение,
+            # поэтому время меряется без него
+            tracemalloc.start()
+            out, _ = main.export_applications(fmt)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            out.close()
+            print(
+                f"{fmt:<6} строк: {count}  {elapsed:6.2f} с  {count / elapsed:9.0f} строк/с  "
+                f"файл: {size / 2**20:6.1f} МБ  пик памяти: {peak / 2**20:5.1f} МБ"
+            )
+
+
+# ===================== МИКРОБЕНЧМАРКИ =====================
+
+# Каждый замер — timeit: число повторов подбирается так, чтобы прогон шёл
+# не меньше 0.2 с, из MICRO_REPEAT прогонов берётся лучший (меньше всего
+# помех от остальной системы). Результат — секунды на вызов.
+
+MICRO_REPEAT = 5
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+def machine_info() -> dict:
+    return {
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "cpu": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+    }
+
+
+def measure(func) -> float:
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=MICRO_REPEAT, number=number)) / number
+
+
+def sample_application(app_id: int = 1) -> dict:
+    # Заявка в виде строки applications; рендер принимает и dict
+    return dict(
+        SAMPLE_FORM,
+        id=app_id,
+        user_id=1,
+        username="bench",
+        created_at="2026-01-01T00:00:00",
+        status=None,
+        duplicate_of=None,
+        similar_to=None,
+        version=1,
+    )
+
+
+def micro_pure() -> dict:
+    app = sample_application()
+    user = types.User(id=1, is_bot=False, first_name="bench", username="bench")
+    app_ids = iter(range(1, 10 ** 9))
+    return {
+        "format_application_text": measure(lambda: main.format_application_text(app)),
+        "format_preview_from_data": measure(lambda: main.format_preview_from_data(user, SAMPLE_FORM)),
+        "create_calendar": measure(main.create_calendar),
+        "edit_menu_kb": measure(main.edit_menu_kb),
+        # из кэша и сборка новой клавиатуры (заявка, которой в кэше нет)
+        "admin_application_kb": measure(lambda: main.admin_application_kb(1)),
+        "admin_application_kb:miss": measure(
+            lambda: main.admin_application_kb.__wrapped__(next(app_ids))
+        ),
+    }
+
+
+def micro_roles() -> dict:
+    # роли читаются из кэша в памяти, размер таблицы заявок на них не влияет
+    admin_id = main.SUPER_ADMIN_ID
+    return {
+        "is_admin": measure(lambda: main.is_admin(admin_id)),
+        "is_admin:user": measure(lambda: main.is_admin(admin_id + 1)),
+    }
+
+
+def micro_db(rows: int) -> dict:
+    ids = random.Random(rows)
+    _, status = main.APP_FILTERS["new"]
+    middle = main.list_applications(limit=rows // 2 + 1)[-1]
+    cursor = (middle["created_ts"], middle["id"])
+    return {
+        f"get_application[{rows}]": measure(lambda: main.get_application(ids.randint(1, rows))),
+        f"list_applications[{rows}]": measure(lambda: main.list_applications(limit=11)),
+        f"list_applications:status[{rows}]": measure(
+            lambda: main.list_applications(status=status, limit=11)
+        ),
+        f"list_applications:deep[{rows}]": measure(
+            lambda: main.list_applications(before=cursor, limit=11)
+        ),
+        f"save_application[{rows}]": measure(
+            lambda: main.save_application(1, "bench", SAMPLE_FORM)
+        ),
+    }
+
+
+def compare_micro(baseline: dict, results: dict, threshold: float) -> int:
+    regressions = 0
+    print(f"\n{'замер':<40} {'было':>12} {'стало':>12} {'разница':>9}")
+    for name, seconds in results.items():
+        before = baseline.get(name)
+        if before is None:
+            print(f"{name:<40} {'—':>12} {format_seconds(seconds):>12}")
+            continue
+        delta = (seconds - before) / before
+        mark = ""
+        if delta > threshold:
+            mark = "  регрессия"
+            regressions += 1
+        print(
+            f"{name:<40} {format_seconds(before):>12} {format_seconds(seconds):>12} "
+            f"{delta:>+8.0%}{mark}"
+        )
+    return regressions
+
+
+def format_seconds(seconds: float) -> str:
+    if seconds < 1e-6:
+        return f"{seconds * 1e9:.0f} нс"
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.2f} мкс"
+    return f"{seconds * 1e3:.2f} мс"
+
+
+@benchmark("micro", "микробенчмарки рендера, клавиатур и запросов к БД; --save / --compare")
+def bench_micro(args):
+    results = micro_pure()
+    for rows in (int(size) for size in args.sizes.split(",")):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            setup_db(tmpdir)
+            fill_applications(rows)
+            if "is_admin" not in results:
+                results.update(micro_roles())
+            results.update(micro_db(rows))
+            main.close_db()
+
+    for name, seconds in results.items():
+        print(f"{name:<40} {format_seconds(seconds):>12}")
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"machine": machine_info(), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"базовая линия записана в {args.save}")
+    if args.compare:
+        if not os.path.exists(args.compare):
+            print(f"нет базовой линии {args.compare}: сначала запустите micro --save")
+            return 2
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        machine = machine_info()
+        if baseline["machine"] != machine:
+            print("внимание: базовая линия записана в другом окружении:")
+            for key, value in machine.items():
+                if baseline["machine"].get(key) != value:
+                    print(f"  {key}: {baseline['machine'].get(key)} -> {value}")
+        if compare_micro(baseline["results"], results, args.threshold):
+            return 1
+    return 0
+
+
+# ===================== ЗАПУСК =====================
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Бенчмарки VisaBot",
+        epilog="\n".join(f"{name}: {text}" for name, (_, text) in sorted(BENCHMARKS.items())),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("name", choices=sorted(BENCHMARKS), help="имя бенчмарка")
+    parser.add_argument("--writers", type=int, default=8, help="параллельных писателей")
+    parser.add_argument("--duration", type=float, default=3.0, help="длительность, с")
+    parser.add_argument("--rows", type=int, default=100000, help="строк в таблице заявок")
+    parser.add_argument("--interval", type=float, default=0.002, help="интервал апдейтов, с")
+    parser.add_argument("--sizes", default="1000,100000,1000000",
+                        help="micro: размеры таблицы заявок через запятую")
+    parser.add_argument("--save", nargs="?", const=BASELINE_PATH,
+                        help="micro: записать результаты как базовую линию")
+    parser.add_argument("--compare", nargs="?", const=BASELINE_PATH,
+                        help="micro: сравнить с базовой линией")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="micro: допустимое замедление (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    func, _ = BENCHMARKS[args.name]
+    return func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,346 @@
+"""Заглушка Telegram Bot API для локальных проверок бота.
+
+Бот запускается с TELEGRAM_API_URL=http://127.0.0.1:8081, и все запросы к
+Bot API (getUpdates, sendMessage, editMessageText, answerCallbackQuery, ...)
+приходят сюда. Апдейты для бота в режиме polling кладутся в очередь, которую
+бот забирает через getUpdates; в режиме webhook их отправляет сам тест.
+
+Проверка webhook-режима:
+
+    python fake_telegram.py webhook --users 50
+
+поднимает заглушку API на --api-port, отправляет апдейты виртуальных
+пользователей POST-запросами на --url (как это делает Telegram) и меряет
+время от отправки апдейта до ответа бота. Бот при этом запущен отдельно:
+
+    BOT_MODE=webhook WEBHOOK_SECRET=secret TELEGRAM_API_URL=http://127.0.0.1:8081 python main.py
+
+Полный прогон анкеты виртуальными пользователями с одобрением заявок и
+перцентилями по шагам — в loadtest.py.
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import itertools
+from collections import Counter, defaultdict
+
+from aiohttp import ClientSession, web
+
+BOT_USER = {"id": 1000000, "is_bot": True, "first_name": "VisaBot", "username": "visa_test_bot"}
+
+
+def make_user(user_id: int) -> dict:
+    return {
+        "id": user_id,
+        "is_bot": False,
+        "first_name": f"User{user_id}",
+        "username": f"user{user_id}",
+        "language_code": "ru",
+    }
+
+
+def make_chat(chat_id: int) -> dict:
+    return {"id": chat_id, "type": "private", "first_name": f"User{chat_id}"}
+
+
+class ApiError(Exception):
+    # Ответ Bot API с ok=false; описание — как у настоящего Telegram, по нему
+    # aiogram выбирает класс исключения (MessageNotModified и т.п.)
+
+    def __init__(self, description: str, code: int = 400):
+        super().__init__(description)
+        self.description = description
+        self.code = code
+
+
+class FakeTelegram:
+    # Принимает запросы вида /bot<token>/<method>, запоминает отправленные
+    # ботом сообщения и будит тех, кто ждёт ответа в конкретном чате.
+
+    def __init__(self, first_message_id: int = 1):
+        self.app = web.Application()
+        self.app.router.add_route("*", "/bot{token}/{method}", self._handle)
+        self.calls = Counter()
+        self.messages = {}
+        self.callback_answers = {}
+        self.updates = asyncio.Queue()
+        self.polling = asyncio.Event()
+        self._message_ids = itertools.count(first_message_id)
+        self._update_ids = itertools.count(1)
+        self._callback_ids = itertools.count(1)
+        self._waiters = defaultdict(list)
+        self._subscribers = defaultdict(list)
+        self._runner = None
+
+    # ---------- сервер ----------
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8081):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(request.query)
+        if request.content_type == "application/json":
+            params.update(await request.json())
+        else:
+            post = await request.post()
+            params.update({key: value for key, value in post.items() if isinstance(value, str)})
+        self.calls[method] += 1
+        handler = getattr(self, f"api_{method}", None)
+        try:
+            result = await handler(params) if handler else True
+        except ApiError as e:
+            return web.json_response(
+                {"ok": False, "error_code": e.code, "description": e.description},
+                status=e.code,
+            )
+        return web.json_response({"ok": True, "result": result})
+
+    # ---------- методы Bot API ----------
+
+    async def api_getMe(self, params):
+        return BOT_USER
+
+    async def api_getWebhookInfo(self, params):
+        return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+
+    async def api_getUpdates(self, params):
+        # Long polling: ждём первый апдейт до timeout секунд, потом забираем
+        # всё, что уже накопилось. offset=-1 (skip_updates при старте бота)
+        # ничего не подтверждает и не ждёт.
+        if int(params.get("offset", 0)) < 0:
+            return []
+        self.polling.set()
+        limit = int(params.get("limit", 100))
+        try:
+            first = await asyncio.wait_for(self.updates.get(), float(params.get("timeout", 0)))
+        except asyncio.TimeoutError:
+            return []
+        batch = [first]
+        while len(batch) < limit and not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return batch
+
+    async def api_sendMessage(self, params):
+        return self._new_message(int(params["chat_id"]), params, text=params.get("text", ""))
+
+    async def api_sendDocument(self, params):
+        # содержимое файла заглушке не нужно, запоминается только подпись
+        message = self._new_message(int(params["chat_id"]), params, caption=params.get("caption", ""))
+        message["document"] = {"file_id": f"doc{message['message_id']}", "file_unique_id": "doc"}
+        return message
+
+    async def api_editMessageText(self, params):
+        message = self._edited_message(params)
+        if message["text"] == params.get("text", "") and \
+                message.get("reply_markup") == self._markup(params):
+            raise ApiError("Bad Request: message is not modified")
+        message["text"] = params.get("text", "")
+        self._set_markup(message, params)
+        self._notify(message["chat"]["id"], message)
+        return message
+
+    async def api_editMessageReplyMarkup(self, params):
+        message = self._edited_message(params)
+        if message.get("reply_markup") == self._markup(params):
+            raise ApiError("Bad Request: message is not modified")
+        self._set_markup(message, params)
+        self._notify(message["chat"]["id"], message)
+        return message
+
+    async def api_answerCallbackQuery(self, params):
+        answer = {"text": params.get("text"), "show_alert": params.get("show_alert") in ("true", "True", True)}
+        self.callback_answers[params["callback_query_id"]] = answer
+        return True
+
+    # ---------- сообщения ----------
+
+    @staticmethod
+    def _markup(params):
+        return json.loads(params["reply_markup"]) if params.get("reply_markup") else None
+
+    def _set_markup(self, message: dict, params):
+        markup = self._markup(params)
+        if markup is None:
+            message.pop("reply_markup", None)
+        else:
+            message["reply_markup"] = markup
+
+    def _new_message(self, chat_id: int, params, **fields) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": make_chat(chat_id),
+            "from": BOT_USER,
+            **fields,
+        }
+        self._set_markup(message, params)
+        self.messages[(chat_id, message["message_id"])] = message
+        self._notify(chat_id, message)
+        return message
+
+    def add_message(self, message: dict):
+        # Сообщение бота, отправленное не через заглушку (например, из
+        # записанного потока): его можно редактировать, как отправленное здесь
+        key = (message["chat"]["id"], message["message_id"])
+        if key not in self.messages:
+            self.messages[key] = dict(message, **{"from": BOT_USER})
+
+    def _edited_message(self, params) -> dict:
+        key = (int(params["chat_id"]), int(params["message_id"]))
+        if key not in self.messages:
+            raise ApiError("Bad Request: message to edit not found")
+        return self.messages[key]
+
+    # ---------- ожидание ответов ----------
+
+    def _notify(self, chat_id: int, message: dict):
+        # Подписчики получают копию: сообщение может позже измениться
+        for queue in self._subscribers[chat_id]:
+            queue.put_nowait(dict(message))
+        waiters, self._waiters[chat_id] = self._waiters[chat_id], []
+        for future in waiters:
+            if not future.done():
+                future.set_result(message)
+
+    async def wait_message(self, chat_id: int, timeout: float = 10) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append(future)
+        return await asyncio.wait_for(future, timeout)
+
+    def subscribe(self, chat_id: int) -> asyncio.Queue:
+        # Очередь всех новых и отредактированных сообщений бота в чате, без
+        # пропусков между ожиданиями (в отличие от wait_message)
+        queue = asyncio.Queue()
+        self._subscribers[chat_id].append(queue)
+        return queue
+
+    # ---------- апдейты ----------
+
+    def message_update(self, user_id: int, text: str) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": make_chat(user_id),
+                "from": make_user(user_id),
+                "text": text,
+            },
+        }
+
+    def callback_update(self, user_id: int, data: str, message: dict) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._callback_ids)),
+                "from": make_user(user_id),
+                "chat_instance": str(user_id),
+                "message": message,
+                "data": data,
+            },
+        }
+
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+# ===================== ПРОВЕРКА WEBHOOK =====================
+
+WEBHOOK_SCRIPT = [
+    "/start",
+    "Заполнить анкету",
+    "Иванов Иван Иванович",
+    "г. Москва",
+    "ivanov@example.com",
+    "4510 123456",
+    "Москва, ул. Ленина, д. 1",
+]
+
+
+async def run_webhook_check(args) -> int:
+    fake = FakeTelegram()
+    await fake.start(port=args.api_port)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    latencies = []
+    errors = Counter()
+
+    async def virtual_user(session: ClientSession, user_id: int):
+        for text in WEBHOOK_SCRIPT:
+            reply = asyncio.ensure_future(fake.wait_message(user_id, args.timeout))
+            started = time.perf_counter()
+            async with session.post(args.url, json=fake.message_update(user_id, text),
+                                    headers=headers) as response:
+                if response.status != 200:
+                    errors[f"http {response.status}"] += 1
+                    reply.cancel()
+                    return
+            try:
+                await reply
+            except asyncio.TimeoutError:
+                errors["timeout"] += 1
+                return
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with ClientSession() as session:
+        await asyncio.gather(
+            *(virtual_user(session, 10_000 + i) for i in range(args.users))
+        )
+    elapsed = time.perf_counter() - started
+    await fake.stop()
+
+    ms = [v * 1000 for v in latencies]
+    print(f"апдейтов: {len(ms)} за {elapsed:.2f} с ({len(ms) / elapsed:.1f}/с)")
+    print(
+        f"апдейт -> ответ: p50={percentile(ms, 50):.1f} ms "
+        f"p95={percentile(ms, 95):.1f} ms p99={percentile(ms, 99):.1f} ms"
+    )
+    print(f"вызовы Bot API: {dict(fake.calls)}")
+    if errors:
+        print(f"ошибки: {dict(errors)}")
+    return 1 if errors else 0
+
+
+def main_cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Заглушка Telegram Bot API")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    serve = sub.add_parser("serve", help="только поднять заглушку API")
+    serve.add_argument("--api-port", type=int, default=8081)
+
+    webhook = sub.add_parser("webhook", help="прогнать апдейты через webhook бота")
+    webhook.add_argument("--api-port", type=int, default=8081)
+    webhook.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    webhook.add_argument("--secret", default="secret")
+    webhook.add_argument("--users", type=int, default=20)
+    webhook.add_argument("--timeout", type=float, default=10)
+
+    args = parser.parse_args(argv)
+    if args.command == "webhook":
+        return asyncio.run(run_webhook_check(args))
+
+    async def serve_forever():
+        fake = FakeTelegram()
+        await fake.start(port=args.api_port)
+        print(f"Заглушка Bot API: http://127.0.0.1:{args.api_port}")
+        await asyncio.Event().wait()
+
+    asyncio.run(serve_forever())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,301 @@
+"""Нагрузочный прогон бота на заглушке Bot API.
+
+N виртуальных пользователей проходят анкету целиком: /start, «Заполнить
+анкету», ответы на все вопросы (кнопки выбираются случайно, поэтому ветки
+анкеты тоже проходятся), «Отправить». Виртуальный админ одобряет каждую
+пришедшую заявку. В конце печатаются апдейты в секунду, перцентили задержки
+по шагам анкеты и доля ошибок.
+
+Бот можно запустить отдельно (как в fake_telegram.py) или дать скрипту
+поднять его самому на временной базе:
+
+    python loadtest.py --users 200 --spawn                # polling
+    python loadtest.py --users 200 --spawn --mode webhook
+
+При ручном запуске бот должен смотреть на заглушку и знать админа:
+
+    SUPER_ADMIN_ID=1 TG_CHAT_RATE=1000 TG_CHAT_BURST=1000 \\
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python main.py
+
+TG_CHAT_RATE/TG_CHAT_BURST поднимаются, потому что все уведомления о заявках
+идут в один чат админа, и лимит Telegram 1 сообщение/с на чат иначе
+растянет прогон на минуты.
+"""
+import os
+import re
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from collections import Counter, defaultdict
+
+from aiohttp import ClientError, ClientSession
+
+from fake_telegram import FakeTelegram, percentile
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_ID_RE = re.compile(r"№(\d+)")
+
+
+class LoadTest:
+
+    def __init__(self, args):
+        self.args = args
+        self.fake = FakeTelegram()
+        self.session = None
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self.step_order = []
+        self.updates_sent = 0
+        self.completed = 0
+        self.approved_at = {}
+        self.headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+
+    # ---------- доставка апдейтов ----------
+
+    async def send_update(self, update: dict):
+        self.updates_sent += 1
+        if self.args.mode == "polling":
+            self.fake.updates.put_nowait(update)
+            return
+        async with self.session.post(self.args.url, json=update, headers=self.headers) as response:
+            if response.status != 200:
+                raise RuntimeError(f"http {response.status}")
+
+    async def wait_ready(self, timeout: float = 30):
+        # polling: бот начал забирать апдейты; webhook: сервер бота отвечает
+        deadline = time.monotonic() + timeout
+        if self.args.mode == "polling":
+            await asyncio.wait_for(self.fake.polling.wait(), timeout)
+            return
+        while True:
+            try:
+                async with self.session.get(self.args.url):
+                    return
+            except ClientError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.2)
+
+    # ---------- учёт ----------
+
+    def observe(self, step: str, seconds: float):
+        if step not in self.latencies:
+            self.step_order.append(step)
+        self.latencies[step].append(seconds)
+
+    def error(self, step: str, kind: str):
+        if step not in self.latencies and step not in self.errors:
+            self.step_order.append(step)
+        self.errors[step][kind] += 1
+
+    # ---------- виртуальные пользователи ----------
+
+    @staticmethod
+    def step_name(message: dict) -> str:
+        return message.get("text", "").split("\n", 1)[0][:48]
+
+    @staticmethod
+    def text_answer(question: str, user_id: int) -> str:
+        question = question.lower()
+        if "почт" in question:
+            return f"user{user_id}@example.com"
+        if "паспорт" in question:
+            return f"45{user_id % 100:02d} {user_id:06d}"
+        if "телефон" in question:
+            return f"+7 9{user_id:09d}"
+        return f"Ответ пользователя {user_id}"
+
+    @staticmethod
+    def pick_button(message: dict, rng: random.Random):
+        buttons = [
+            button["callback_data"]
+            for row in message.get("reply_markup", {}).get("inline_keyboard", [])
+            for button in row
+            if "callback_data" in button
+        ]
+        if "confirm:send" in buttons:
+            return "confirm:send"
+        # пустые клетки и листание календаря не отвечают на вопрос
+        buttons = [data for data in buttons if data != "ignore" and not data.startswith("calnav:")]
+        return rng.choice(buttons) if buttons else None
+
+    async def next_message(self, inbox: asyncio.Queue, after: int) -> dict:
+        # Следующее новое сообщение бота (правки старых пропускаются)
+        while True:
+            message = await asyncio.wait_for(inbox.get(), self.args.timeout)
+            if message["message_id"] > after:
+                return message
+
+    async def virtual_user(self, user_id: int):
+        rng = random.Random(user_id)
+        inbox = self.fake.subscribe(user_id)
+        await asyncio.sleep(rng.uniform(0, self.args.ramp))
+
+        last_id = 0
+        step = "/start"
+        action = ("text", "/start")
+        for _ in range(100):
+            if self.args.think:
+                await asyncio.sleep(rng.uniform(0, self.args.think))
+            kind, value = action
+            if kind == "text":
+                update = self.fake.message_update(user_id, value)
+            else:
+                update = self.fake.callback_update(user_id, value, current)
+            started = time.perf_counter()
+            try:
+                await self.send_update(update)
+                current = await self.next_message(inbox, last_id)
+            except asyncio.TimeoutError:
+                self.error(step, "timeout")
+                return
+            except (ClientError, RuntimeError) as e:
+                self.error(step, str(e) or type(e).__name__)
+                return
+            self.observe(step, time.perf_counter() - started)
+            last_id = current["message_id"]
+
+            text = current.get("text", "")
+            if text.startswith("Спасибо!"):
+                break
+            if step != "/start" and self.step_name(current) == step:
+                # бот переспросил тот же вопрос: ответ не прошёл проверку
+                self.error(step, "rejected")
+
+            if step == "/start":
+                step, action = "Заполнить анкету", ("text", "Заполнить анкету")
+                continue
+            step = self.step_name(current)
+            data = self.pick_button(current, rng)
+            action = ("callback", data) if data else ("text", self.text_answer(text, user_id))
+        else:
+            self.error(step, "loop")
+            return
+
+        self.completed += 1
+        match = APP_ID_RE.search(text)
+        if not match or "повторная подача" in text:
+            return
+        app_id = int(match.group(1))
+        try:
+            while True:
+                message = await self.next_message(inbox, last_id)
+                last_id = message["message_id"]
+                if f"№{app_id} одобрена" in message.get("text", ""):
+                    break
+        except asyncio.TimeoutError:
+            self.error("одобрение", "timeout")
+            return
+        pressed = self.approved_at.pop(app_id, None)
+        if pressed is not None:
+            self.observe("одобрение", time.perf_counter() - pressed)
+
+    async def admin(self):
+        # Нажимает «Одобрить» под каждой пришедшей заявкой
+        inbox = self.fake.subscribe(self.args.admin)
+        while True:
+            message = await inbox.get()
+            for row in message.get("reply_markup", {}).get("inline_keyboard", []):
+                for button in row:
+                    data = button.get("callback_data", "")
+                    if data.startswith("approve:"):
+                        app_id = int(data.split(":")[1])
+                        if app_id in self.approved_at:
+                            continue
+                        self.approved_at[app_id] = time.perf_counter()
+                        await self.send_update(
+                            self.fake.callback_update(self.args.admin, data, message)
+                        )
+
+    # ---------- прогон ----------
+
+    async def run(self) -> int:
+        await self.fake.start(port=self.args.api_port)
+        bot = None
+        try:
+            async with ClientSession() as self.session:
+                if self.args.spawn:
+                    bot = await spawn_bot(self.args)
+                await self.wait_ready()
+                admin = asyncio.ensure_future(self.admin())
+                started = time.perf_counter()
+                await asyncio.gather(*(
+                    self.virtual_user(self.args.first_user + i) for i in range(self.args.users)
+                ))
+                elapsed = time.perf_counter() - started
+                admin.cancel()
+        finally:
+            if bot is not None:
+                bot.terminate()
+                await bot.wait()
+            await self.fake.stop()
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> int:
+        total_errors = sum(sum(kinds.values()) for kinds in self.errors.values())
+        print(
+            f"пользователей: {self.args.users}, анкет отправлено: {self.completed}, "
+            f"режим: {self.args.mode}"
+        )
+        print(
+            f"апдейтов: {self.updates_sent} за {elapsed:.2f} с "
+            f"({self.updates_sent / elapsed:.1f}/с), "
+            f"ошибок: {total_errors} ({total_errors * 100 / max(self.updates_sent, 1):.2f}%)"
+        )
+        print(f"{'шаг':<50} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}  ошибки")
+        for step in self.step_order:
+            ms = [v * 1000 for v in self.latencies.get(step, [])]
+            errors = ", ".join(f"{kind}={n}" for kind, n in self.errors[step].items())
+            print(
+                f"{step:<50} {len(ms):>6} {percentile(ms, 50):>8.1f} {percentile(ms, 95):>8.1f} "
+                f"{percentile(ms, 99):>8.1f} {max(ms, default=0):>8.1f}  {errors}"
+            )
+        print(f"вызовы Bot API: {dict(self.fake.calls)}")
+        return 1 if total_errors else 0
+
+
+async def spawn_bot(args):
+    # Бот на временной базе, настроенный на заглушку и виртуального админа
+    db_dir = tempfile.mkdtemp(prefix="loadtest-")
+    env = dict(
+        os.environ,
+        BOT_TOKEN="123456:loadtest",
+        SUPER_ADMIN_ID=str(args.admin),
+        TELEGRAM_API_URL=f"http://127.0.0.1:{args.api_port}",
+        BOT_MODE=args.mode,
+        WEBHOOK_SECRET=args.secret,
+        DB_PATH=os.path.join(db_dir, "bot.db"),
+        TG_CHAT_RATE="1000",
+        TG_CHAT_BURST="1000",
+        TG_GLOBAL_RATE="100000",
+    )
+    log = open(os.path.join(db_dir, "bot.log"), "wb")
+    print(f"бот: база и лог в {db_dir}")
+    return await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(BASE_DIR, "main.py"),
+        env=env, stdout=log, stderr=log,
+    )
+
+
+def main_cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон анкеты на заглушке Bot API")
+    parser.add_argument("--users", type=int, default=50, help="виртуальных пользователей")
+    parser.add_argument("--first-user", type=int, default=100_000, help="ID первого пользователя")
+    parser.add_argument("--admin", type=int, default=1, help="ID админа (SUPER_ADMIN_ID бота)")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook", help="webhook бота")
+    parser.add_argument("--secret", default="secret")
+    parser.add_argument("--ramp", type=float, default=1.0, help="разброс старта пользователей, с")
+    parser.add_argument("--think", type=float, default=0.0, help="пауза между ответами до, с")
+    parser.add_argument("--timeout", type=float, default=15, help="ожидание ответа бота, с")
+    parser.add_argument("--spawn", action="store_true", help="запустить main.py на временной базе")
+    args = parser.parse_args(argv)
+    return asyncio.run(LoadTest(args).run())
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
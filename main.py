@@ -1,12 +1,36 @@
+import io
 import os
+import re
+import csv
+import copy
+import hmac
+import hashlib
+import secrets
+import json
+import pstats
+import random
+import cProfile
+import bisect
+import asyncio
 import logging
 import sqlite3
 import calendar
-from datetime import datetime, date
-
+import functools
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta
+
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import (
     ReplyKeyboardMarkup,
@@ -16,6 +40,19 @@ from aiogram.types import (
     CallbackQuery,
 )
 from aiogram.utils import executor
+from aiogram.utils.exceptions import (
+    BadRequest,
+    MessageNotModified,
+    NotFound,
+    RetryAfter,
+    Unauthorized,
+)
+
+try:
+    # XLSX-выгрузка необязательна: без openpyxl доступны только CSV и JSONL
+    from openpyxl import Workbook
+except ImportError:
+    Workbook = None
 
 # ===================== НАСТРОЙКИ =====================
 
@@ -30,28 +67,397 @@ if SUPER_ADMIN_ID == 0:
 
 logging.basicConfig(level=logging.INFO)
 
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(bot, storage=storage)
-
-# Путь к базе данных рядом с bot.py
+# Адрес Bot API. Можно указать локальный Bot API сервер или заглушку
+# из fake_telegram.py для локальных проверок.
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip()
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook.
+# В режиме webhook бот поднимает aiohttp-сервер на WEBAPP_HOST:WEBAPP_PORT.
+# WEBHOOK_URL — публичный адрес для setWebhook; если пуст, вебхук не
+# регистрируется (например, когда процессов несколько, его ставит один).
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+if BOT_MODE not in ("polling", "webhook"):
+    raise RuntimeError("BOT_MODE должен быть polling или webhook")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+    # без секрета кто угодно может прислать апдейт от имени админа
+    raise RuntimeError("В режиме webhook нужно задать WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "127.0.0.1")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "64"))
+
+# Апдейты одного чата обрабатываются строго по порядку, разных чатов —
+# параллельно, но не больше UPDATE_CONCURRENCY одновременно (по умолчанию
+# как WEBHOOK_CONCURRENCY). В очередях ждут не больше UPDATE_QUEUE_LIMIT
+# апдейтов: дальше приём новых приостанавливается до освобождения места.
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", str(WEBHOOK_CONCURRENCY)))
+UPDATE_QUEUE_LIMIT = int(os.getenv("UPDATE_QUEUE_LIMIT", "1000"))
+
+# Повторно доставленные апдейты (ретрай вебхука и т.п.) отбрасываются по
+# update_id и id нажатия кнопки; ключи помнятся DEDUP_TTL секунд, но не
+# больше DEDUP_CACHE_SIZE штук
+DEDUP_TTL = float(os.getenv("DEDUP_TTL", "600"))
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "20000"))
+
+# Метрики Prometheus. Отдаются только отдельным HTTP-сервером на
+# METRICS_HOST:METRICS_PORT (по умолчанию локальный адрес), если задан
+# METRICS_PORT; на публичный сервер вебхука они не вешаются.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+
+# Трассировка апдейтов, по умолчанию выключена. Апдейты дольше TRACE_SLOW_MS
+# записываются JSON-строкой в TRACE_FILE (если не задан — в лог); доля
+# TRACE_PROFILE_RATE апдейтов дополнительно выполняется под cProfile
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "0").lower() in ("1", "true", "yes")
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "500"))
+TRACE_FILE = os.getenv("TRACE_FILE", "").strip()
+TRACE_PROFILE_RATE = float(os.getenv("TRACE_PROFILE_RATE", "0"))
+
+# Запись входящих апдейтов для replay.py (по умолчанию выключена): каждый
+# апдейт без персональных данных дописывается строкой JSON в RECORD_FILE
+RECORD_FILE = os.getenv("RECORD_FILE", "").strip()
+
+# Путь к базе данных: по умолчанию рядом с bot.py, DB_PATH задаёт другой
+# файл (например, отдельную базу для нагрузочного прогона)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "bot.db")
+DB_PATH = os.getenv("DB_PATH", "").strip() or os.path.join(BASE_DIR, "bot.db")
+
+# Пул соединений SQLite: один поток-писатель и DB_READERS потоков-читателей
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# Хранилище FSM: сколько сессий держать в памяти, как часто сбрасывать
+# изменения в базу и через сколько секунд бездействия удалять анкету
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "5000"))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))
+FSM_SESSION_TTL = int(os.getenv("FSM_SESSION_TTL", str(14 * 24 * 3600)))
+FSM_SWEEP_INTERVAL = int(os.getenv("FSM_SWEEP_INTERVAL", "3600"))
+
+# Если за одной базой работают несколько процессов бота, кэш ролей
+# перечитывается раз в ROLES_RELOAD_INTERVAL секунд, а для FSM стоит
+# выставить FSM_CACHE_SIZE=0 и FSM_FLUSH_INTERVAL=0 (запись без задержки)
+ROLES_RELOAD_INTERVAL = float(os.getenv("ROLES_RELOAD_INTERVAL", "60"))
+
+# Лимиты Telegram на исходящие сообщения: около 30 в секунду на бота и
+# около 1 в секунду в один чат (короткие всплески допускаются)
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_CHAT_RATE = float(os.getenv("TG_CHAT_RATE", "1"))
+TG_CHAT_BURST = int(os.getenv("TG_CHAT_BURST", "3"))
+# Максимальная длина текста одного сообщения в Telegram
+TG_MESSAGE_LIMIT = 4096
+# Максимальный размер файла, который бот может отправить документом
+TG_DOCUMENT_LIMIT = 50 * 1024 * 1024
+
+# Очередь исходящих сообщений (outbox): размер пачки, число попыток доставки
+# и как часто проверять отложенные повторы
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+
+# Воронка анкеты: события копятся в памяти и пишутся в базу пачкой раз в
+# FUNNEL_FLUSH_INTERVAL секунд или при накоплении FUNNEL_BATCH штук
+FUNNEL_FLUSH_INTERVAL = float(os.getenv("FUNNEL_FLUSH_INTERVAL", "2"))
+FUNNEL_BATCH = int(os.getenv("FUNNEL_BATCH", "500"))
+
+# Выгрузка заявок (/export): строки читаются из курсора пачками по
+# EXPORT_CHUNK, файл держится в памяти до EXPORT_SPOOL_SIZE байт, дальше
+# переносится во временный файл на диске
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "1000"))
+EXPORT_SPOOL_SIZE = int(os.getenv("EXPORT_SPOOL_SIZE", str(8 * 1024 * 1024)))
+
+# Сколько клавиатур заявок (по одной на app_id) держать готовыми в памяти
+KB_CACHE_SIZE = int(os.getenv("KB_CACHE_SIZE", "1024"))
+# Сколько отрисованных текстов заявок держать в памяти
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "1024"))
+
+# На сколько месяцев вперёд можно листать календарь даты прибытия
+CALENDAR_MONTHS_AHEAD = int(os.getenv("CALENDAR_MONTHS_AHEAD", "12"))
+
+
+# ===================== МЕТРИКИ =====================
+
+# Минимальный реестр метрик в текстовом формате Prometheus (без внешних
+# зависимостей): счётчики, гейджи и гистограммы с метками. Значения
+# обновляются в том числе из потоков БД, поэтому у каждой метрики своя
+# блокировка. Метки передаются позиционно в порядке labels.
+
+METRICS = []
+
+# Имя хендлера для гистограмм: middleware ставит имя функции aiogram,
+# маршрутизатор кнопок и шаги анкеты уточняют его
+handler_label = ContextVar("handler_label", default="")
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _labels_text(self, values: tuple, extra: tuple = ()) -> str:
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in pairs) + "}"
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, self._labels_text(key), value) for key, value in self._values.items()]
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in self._samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set(self, value: float, *labels):
+        # для счётчиков, которые ведутся в другом месте (например, outbox.stats)
+        with self._lock:
+            self._values[labels] = value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                # [счётчики по корзинам (последняя — +Inf), сумма]
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", self._labels_text(key, (("le", bound),)), cumulative))
+            samples.append((f"{self.name}_sum", self._labels_text(key), total))
+            samples.append((f"{self.name}_count", self._labels_text(key), cumulative))
+        return samples
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+UPDATES_TOTAL = Counter("bot_updates_total", "Обработанные апдейты", ("type",))
+UPDATE_SECONDS = Histogram("bot_update_seconds", "Время обработки апдейта целиком", ("type",))
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Время работы хендлера", ("handler",))
+HANDLER_ERRORS = Counter(
+    "bot_handler_errors_total", "Необработанные исключения в хендлерах", ("handler", "error")
+)
+DB_QUERY_SECONDS = Histogram(
+    "bot_db_query_seconds", "Время выполнения хелпера БД в потоке", ("helper",)
+)
+DB_WAIT_SECONDS = Histogram(
+    "bot_db_wait_seconds", "Ожидание свободного потока БД", ("pool",)
+)
+API_REQUEST_SECONDS = Histogram(
+    "bot_api_request_seconds", "Время запроса к Bot API", ("method",)
+)
+API_ERRORS = Counter("bot_api_errors_total", "Ошибки запросов к Bot API", ("method", "error"))
+OUTBOX_DELIVERY_SECONDS = Histogram(
+    "bot_outbox_delivery_seconds",
+    "Время от постановки сообщения в outbox до доставки",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+OUTBOX_MESSAGES = Counter(
+    "bot_outbox_messages_total", "Сообщения outbox с момента запуска", ("result",)
+)
+OUTBOX_DEPTH = Gauge("bot_outbox_depth", "Сообщений в очереди на отправку")
+FSM_SESSIONS = Gauge("bot_fsm_sessions", "Сессии FSM", ("where",))
+UPDATES_PENDING = Gauge("bot_updates_pending", "Апдейты в очередях чатов, включая обрабатываемые")
+UPDATE_QUEUES = Gauge("bot_update_queues", "Чаты с необработанными апдейтами")
+UPDATES_DUPLICATE = Counter(
+    "bot_updates_duplicate_total", "Отброшенные повторные доставки апдейтов", ("kind",)
+)
+
+
+# ===================== ТРАССИРОВКА =====================
+
+# Дерево span'ов одного апдейта: корень — апдейт, внутри — хендлер,
+# хелперы БД (run_db) и запросы к Bot API. Текущий span хранится в
+# contextvar, поэтому параллельные апдейты не смешиваются. При выключенной
+# трассировке middleware не ставится, а run_db и Bot.request проверяют
+# только флаг TRACE_ENABLED.
+
+_current_span = ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("name", "started", "duration", "children")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration = None
+        self.children = []
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def to_dict(self, origin: float) -> dict:
+        result = {
+            "name": self.name,
+            "start_ms": round((self.started - origin) * 1000, 3),
+            "duration_ms": None if self.duration is None else round(self.duration * 1000, 3),
+        }
+        if self.children:
+            result["children"] = [child.to_dict(origin) for child in self.children]
+        return result
+
+
+class trace_span:
+    # with trace_span("db:get_application"): ... — дочерний span текущего;
+    # вне трассируемого апдейта ничего не делает
+
+    __slots__ = ("name", "span", "token")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.span = None
+        self.token = None
+
+    def __enter__(self):
+        parent = _current_span.get()
+        if parent is not None:
+            self.span = Span(self.name)
+            parent.children.append(self.span)
+            self.token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc):
+        if self.span is not None:
+            self.span.finish()
+            _current_span.reset(self.token)
+        return False
+
+
+def dump_slow_trace(record: dict):
+    line = json.dumps(record, ensure_ascii=False)
+    if TRACE_FILE:
+        with open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+    else:
+        logging.warning(f"Медленный апдейт: {line}")
+
+
+def profile_summary(profile: cProfile.Profile, limit: int = 25) -> list:
+    # Самые дорогие функции по суммарному времени: [функция, вызовов, own ms, total ms]
+    stats = pstats.Stats(profile)
+    rows = []
+    for (filename, line, name), (_, calls, own, total, _) in stats.stats.items():
+        rows.append([f"{os.path.basename(filename)}:{line}:{name}", calls,
+                     round(own * 1000, 3), round(total * 1000, 3)])
+    rows.sort(key=lambda row: row[3], reverse=True)
+    return rows[:limit]
 
 
 # ===================== РАБОТА С БАЗОЙ ДАННЫХ =====================
 
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
+# Каждый поток держит одно долгоживущее соединение: файл не открывается
+# и схема не разбирается на каждый запрос, а подготовленные выражения
+# остаются в кэше соединения (cached_statements).
+_db_local = threading.local()
+_db_conns = []
+_db_conns_lock = threading.Lock()
+_db_generation = 0
+
+
+def _open_conn() -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=30,
+        check_same_thread=False,
+        cached_statements=256,
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
 
-def init_db():
-    conn = get_conn()
-    cur = conn.cursor()
+def get_conn() -> sqlite3.Connection:
+    conn = getattr(_db_local, "conn", None)
+    if conn is None or _db_local.generation != _db_generation:
+        conn = _open_conn()
+        _db_local.conn = conn
+        _db_local.generation = _db_generation
+        with _db_conns_lock:
+            _db_conns.append(conn)
+    return conn
 
-    cur.execute(
+
+def close_db():
+    # Закрывает все соединения пула; потоки откроют новые при следующем запросе
+    global _db_generation
+    with _db_conns_lock:
+        _db_generation += 1
+        for conn in _db_conns:
+            conn.close()
+        _db_conns.clear()
+
+
+def db_write(func):
+    # Помечает хелпер как пишущий: run_db выполнит его в потоке-писателе
+    func.db_write = True
+    return func
+
+
+# ---------- МИГРАЦИИ ----------
+
+# Версия схемы хранится в PRAGMA user_version. Каждая миграция выполняется
+# один раз в своей транзакции, поэтому старые файлы bot.db обновляются
+# на месте. Новые миграции добавляются только в конец списка.
+
+def _migration_base_schema(conn: sqlite3.Connection):
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS applications(
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -95,7 +501,7 @@ def init_db():
         """
     )
 
-    cur.execute(
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS admins(
             user_id INTEGER PRIMARY KEY,
@@ -105,32 +511,335 @@ def init_db():
         """
     )
 
-    # гарантируем, что главный админ есть
-    cur.execute(
-        "INSERT OR IGNORE INTO admins (user_id, username, is_superadmin) VALUES (?, ?, 1)",
-        (SUPER_ADMIN_ID, None),
+
+def _migration_created_ts(conn: sqlite3.Connection):
+    # created_at хранится строкой, а сортировка по datetime(created_at) не
+    # может использовать индекс. Добавляем целочисленный epoch и покрывающие
+    # индексы для списков заявок в админ-панели.
+    conn.execute("ALTER TABLE applications ADD COLUMN created_ts INTEGER")
+    conn.execute(
+        "UPDATE applications "
+        "SET created_ts = COALESCE(CAST(strftime('%s', created_at) AS INTEGER), 0)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_applications_status_created "
+        "ON applications(status, created_ts, id, username)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_applications_created "
+        "ON applications(created_ts, id, status, username)"
     )
 
-    conn.commit()
-    conn.close()
 
+def _migration_fsm_sessions(conn: sqlite3.Connection):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS fsm_sessions(
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            state TEXT,
+            data TEXT,
+            bucket TEXT,
+            updated_ts INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_fsm_sessions_updated ON fsm_sessions(updated_ts)"
+    )
 
-def is_admin(user_id: int) -> bool:
+
+def _migration_outbox(conn: sqlite3.Connection):
+    # Доставленные сообщения удаляются, в таблице остаются только
+    # ожидающие (pending) и окончательно не доставленные (failed)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS outbox(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            created_ts REAL NOT NULL,
+            next_try_ts REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'pending',
+            last_error TEXT
+        )
+        """
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox(status, next_try_ts)"
+    )
+
+
+def _migration_app_version(conn: sqlite3.Connection):
+    # Версия строки заявки растёт при каждом изменении: по (id, version)
+    # кэшируется отрисованный текст заявки
+    conn.execute("ALTER TABLE applications ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+
+def _migration_funnel(conn: sqlite3.Connection):
+    # Сырые события анкеты и агрегаты по дням, которые обновляются при
+    # каждой записи событий: отчёт читает только funnel_daily
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS funnel_events(
+            id INTEGER PRIMARY KEY,
+            ts REAL NOT NULL,
+            user_id INTEGER NOT NULL,
+            step TEXT NOT NULL,
+            event TEXT NOT NULL,
+            elapsed REAL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS funnel_daily(
+            day TEXT NOT NULL,
+            step TEXT NOT NULL,
+            event TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            timed INTEGER NOT NULL DEFAULT 0,
+            elapsed_sum REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, step, event)
+        ) WITHOUT ROWID
+        """
+    )
+
+
+# Поиск по заявкам: FTS5-индекс без собственной копии текста (content=''),
+# строки находятся по rowid = applications.id. Паспорт и телефон
+# дополнительно индексируются одними цифрами, чтобы «4510123» находило
+# «4510 123456», а «+7 (999) 123» — «79991234567».
+SEARCH_COLUMNS = ("full_name", "email", "passport_number", "phone")
+
+
+def _digits_sql(expr: str) -> str:
+    for ch in " -+().":
+        expr = f"replace({expr}, '{ch}', '')"
+    return expr
+
+
+def _search_values_sql(prefix: str) -> str:
+    columns = [f"{prefix}{column}" for column in SEARCH_COLUMNS]
+    columns.append(_digits_sql(f"{prefix}passport_number"))
+    columns.append(_digits_sql(f"{prefix}phone"))
+    return ", ".join(columns)
+
+
+def _migration_search(conn: sqlite3.Connection):
+    conn.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS applications_fts USING fts5(
+            full_name, email, passport_number, phone, passport_digits, phone_digits,
+            content='', prefix='3', tokenize='unicode61 remove_diacritics 2'
+        )
+        """
+    )
+    # Из индекса без content строку можно удалить, только передав старые
+    # значения колонок, поэтому UPDATE — это delete + insert
+    columns = ", ".join(SEARCH_COLUMNS + ("passport_digits", "phone_digits"))
+    conn.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS applications_fts_ai AFTER INSERT ON applications BEGIN
+            INSERT INTO applications_fts (rowid, {columns})
+            VALUES (new.id, {_search_values_sql("new.")});
+        END
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS applications_fts_ad AFTER DELETE ON applications BEGIN
+            INSERT INTO applications_fts (applications_fts, rowid, {columns})
+            VALUES ('delete', old.id, {_search_values_sql("old.")});
+        END
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS applications_fts_au
+        AFTER UPDATE OF {", ".join(SEARCH_COLUMNS)} ON applications BEGIN
+            INSERT INTO applications_fts (applications_fts, rowid, {columns})
+            VALUES ('delete', old.id, {_search_values_sql("old.")});
+            INSERT INTO applications_fts (rowid, {columns})
+            VALUES (new.id, {_search_values_sql("new.")});
+        END
+        """
+    )
+    # Заявки, созданные до появления индекса
+    conn.execute(
+        f"""
+        INSERT INTO applications_fts (rowid, {columns})
+        SELECT id, {_search_values_sql("")} FROM applications
+        """
+    )
+
+
+# Нормализованные ключи анкеты для поиска повторных подач: паспорт без
+# пробелов и знаков, телефон одними цифрами (8XXXXXXXXXX -> 7XXXXXXXXXX),
+# email в нижнем регистре. Слишком короткие значения («нет», «-») не ключи.
+DUPLICATE_KEY_MIN_LEN = 5
+
+
+def normalize_passport(value: str) -> str:
+    return re.sub(r"[\W_]", "", value or "").upper()
+
+
+def normalize_phone(value: str) -> str:
+    digits = re.sub(r"\D", "", value or "")
+    if len(digits) == 11 and digits.startswith("8"):
+        digits = "7" + digits[1:]
+    return digits
+
+
+def normalize_email(value: str) -> str:
+    return (value or "").strip().lower()
+
+
+def application_keys(passport: str, phone: str, email: str) -> list:
+    keys = [
+        ("passport", normalize_passport(passport)),
+        ("phone", normalize_phone(phone)),
+        ("email", normalize_email(email)),
+    ]
+    return [(kind, value) for kind, value in keys if len(value) >= DUPLICATE_KEY_MIN_LEN]
+
+
+def _migration_duplicates(conn: sqlite3.Connection):
+    conn.execute("ALTER TABLE applications ADD COLUMN duplicate_of INTEGER")
+    conn.execute("ALTER TABLE applications ADD COLUMN similar_to INTEGER")
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_applications_duplicate_of "
+        "ON applications(duplicate_of) WHERE duplicate_of IS NOT NULL"
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS application_keys(
+            kind TEXT NOT NULL,
+            value TEXT NOT NULL,
+            app_id INTEGER NOT NULL,
+            PRIMARY KEY (kind, value, app_id)
+        ) WITHOUT ROWID
+        """
+    )
+    # Ключи уже поданных анкет; duplicate_of задним числом не проставляется
+    rows = conn.execute("SELECT id, passport_number, phone, email FROM applications")
+    conn.executemany(
+        "INSERT OR IGNORE INTO application_keys (kind, value, app_id) VALUES (?, ?, ?)",
+        (
+            key + (row["id"],)
+            for row in rows
+            for key in application_keys(row["passport_number"], row["phone"], row["email"])
+        ),
+    )
+
+
+def _migration_submission_token(conn: sqlite3.Connection):
+    # Токен сессии анкеты: повторная отправка той же сессии не создаёт
+    # вторую строку. У старых анкет токена нет (NULL не конфликтует)
+    conn.execute("ALTER TABLE applications ADD COLUMN submission_token TEXT")
+    conn.execute(
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_applications_submission_token "
+        "ON applications(submission_token)"
+    )
+
+
+def _migration_outbox_chat(conn: sqlite3.Connection):
+    # Для проверки «нет ли у чата более раннего ожидающего сообщения»
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_chat_id ON outbox(chat_id, id)")
+
+
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_created_ts,
+    _migration_fsm_sessions,
+    _migration_outbox,
+    _migration_app_version,
+    _migration_funnel,
+    _migration_search,
+    _migration_duplicates,
+    _migration_submission_token,
+    _migration_outbox_chat,
+]
+
+
+def migrate(conn: sqlite3.Connection):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+        conn.execute("BEGIN")
+        try:
+            migration(conn)
+            conn.execute(f"PRAGMA user_version={number}")
+        except Exception:
+            conn.rollback()
+            raise
+        conn.commit()
+        logging.info(f"База данных обновлена до версии {number} ({migration.__name__})")
+
+
+@db_write
+def init_db():
+    close_db()
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT 1 FROM admins WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row is not None
+    # WAL сохраняется в файле базы: читатели не блокируют писателя и наоборот
+    conn.execute("PRAGMA journal_mode=WAL")
+    migrate(conn)
+
+    # гарантируем, что главный админ есть
+    with conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO admins (user_id, username, is_superadmin) VALUES (?, ?, 1)",
+            (SUPER_ADMIN_ID, None),
+        )
+    reload_admin_roles()
+
+
+# ---------- КЭШ РОЛЕЙ ----------
+
+# Таблица admins маленькая и меняется редко, поэтому она целиком держится
+# в памяти: user_id -> признак главного админа. Словарь не изменяется на
+# месте, а заменяется новым после каждой записи в admins (upsert_admin),
+# так что читать его можно из любого потока без блокировок.
+_admin_roles = None
+
+ROLE_USER = "user"
+ROLE_ADMIN = "admin"
+ROLE_SUPERADMIN = "superadmin"
+
+
+def _load_admin_roles(conn: sqlite3.Connection) -> dict:
+    rows = conn.execute("SELECT user_id, is_superadmin FROM admins").fetchall()
+    return {row["user_id"]: row["is_superadmin"] == 1 for row in rows}
+
+
+def reload_admin_roles():
+    global _admin_roles
+    _admin_roles = _load_admin_roles(get_conn())
+
+
+def admin_roles() -> dict:
+    if _admin_roles is None:
+        reload_admin_roles()
+    return _admin_roles
+
+
+def get_role(user_id: int) -> str:
+    roles = admin_roles()
+    if user_id not in roles:
+        return ROLE_USER
+    return ROLE_SUPERADMIN if roles[user_id] else ROLE_ADMIN
+
+
+def is_admin(user_id: int) -> bool:
+    return user_id in admin_roles()
 
 
 def is_superadmin(user_id: int) -> bool:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT is_superadmin FROM admins WHERE user_id=?", (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return bool(row and row["is_superadmin"] == 1)
+    return admin_roles().get(user_id, False)
 
 
 def get_admins():
@@ -138,95 +847,160 @@ def get_admins():
     cur = conn.cursor()
     cur.execute("SELECT * FROM admins")
     rows = cur.fetchall()
-    conn.close()
     return rows
 
 
+@db_write
 def upsert_admin(user_id: int, username: str, is_super: bool = False):
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO admins (user_id, username, is_superadmin)
-        VALUES (?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            username=excluded.username,
-            is_superadmin=excluded.is_superadmin
-        """,
-        (user_id, username, 1 if is_super else 0),
-    )
-    conn.commit()
-    conn.close()
-
-
-def save_application(user_id: int, username: str, data: dict) -> int:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO applications (
-            user_id, username, full_name, created_at,
-            place_birth, email, passport_number,
-            home_address, phone,
-            father_name, father_birth_place,
-            mother_name, mother_birth_place,
-            marital_status,
-            spouse_name, spouse_birth_place,
-            work_place, work_address,
-            airport, visa_term, arrival_date,
-            contact_name, contact_phone, contact_address,
-            hotel_booked, hotel_details,
-            five_year_visa,
-            visa_refusal, visa_refusal_details,
-            trips_last_5y, last_visa_details,
-            outside_india, overstay,
-            status, admin_comment, admin_id
+    with conn:
+        conn.execute(
+            """
+            INSERT INTO admins (user_id, username, is_superadmin)
+            VALUES (?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username=excluded.username,
+                is_superadmin=excluded.is_superadmin
+            """,
+            (user_id, username, 1 if is_super else 0),
         )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    reload_admin_roles()
+
+
+def _find_duplicate(conn: sqlite3.Connection, user_id: int, keys: list) -> tuple:
+    # Повторная подача — это совпадение ключа с анкетой того же пользователя,
+    # которая ещё ждёт решения: она прикрепляется к исходной и решается
+    # вместе с ней. Совпадение паспорта с анкетой другого пользователя —
+    # только пометка «возможный дубль»: такая анкета проверяется отдельно.
+    # Телефон и email бывают общими у членов семьи и для других
+    # пользователей не считаются. Возвращает (duplicate_of, similar_to).
+    if not keys:
+        return None, None
+    # OR из пар, а не (kind, value) IN (VALUES ...): с row-value IN SQLite
+    # сканирует всю таблицу ключей, а так — по точке первичного ключа на пару
+    match = " OR ".join("(k.kind = ? AND k.value = ?)" for _ in keys)
+    row = conn.execute(
+        f"""
+        SELECT COALESCE(a.duplicate_of, a.id) AS original, a.user_id = ? AS same_user
+        FROM application_keys AS k
+        JOIN applications AS a ON a.id = k.app_id
+        WHERE ({match})
+          AND a.status = 'в ожидании'
+          AND (k.kind = 'passport' OR a.user_id = ?)
+        ORDER BY same_user DESC, k.app_id DESC
+        LIMIT 1
         """,
-        (
-            user_id,
-            username,
-            data.get("full_name", ""),
-            datetime.utcnow().isoformat(timespec="seconds"),
-            data.get("place_birth", ""),
-            data.get("email", ""),
-            data.get("passport_number", ""),
-            data.get("home_address", ""),
-            data.get("phone", ""),
-            data.get("father_name", ""),
-            data.get("father_birth_place", ""),
-            data.get("mother_name", ""),
-            data.get("mother_birth_place", ""),
-            data.get("marital_status", ""),
-            data.get("spouse_name", ""),
-            data.get("spouse_birth_place", ""),
-            data.get("work_place", ""),
-            data.get("work_address", ""),
-            data.get("airport", ""),
-            data.get("visa_term", ""),
-            data.get("arrival_date", ""),
-            data.get("contact_name", ""),
-            data.get("contact_phone", ""),
-            data.get("contact_address", ""),
-            data.get("hotel_booked", ""),
-            data.get("hotel_details", ""),
-            data.get("five_year_visa", ""),
-            data.get("visa_refusal", ""),
-            data.get("visa_refusal_details", ""),
-            data.get("trips_last_5y", ""),
-            data.get("last_visa_details", ""),
-            data.get("outside_india", ""),
-            data.get("overstay", ""),
-            "в ожидании",
-            "",
-            None,
-        ),
+        [user_id] + [part for key in keys for part in key] + [user_id],
+    ).fetchone()
+    if row is None:
+        return None, None
+    if row["same_user"]:
+        return row["original"], None
+    return None, row["original"]
+
+
+def _find_submitted(conn: sqlite3.Connection, token: str):
+    if token is None:
+        return None
+    return conn.execute(
+        "SELECT id, duplicate_of FROM applications WHERE submission_token=?", (token,)
+    ).fetchone()
+
+
+@db_write
+def save_application(user_id: int, username: str, data: dict) -> tuple:
+    # Возвращает (id анкеты, id исходной анкеты или None, создана ли сейчас).
+    # Если анкета с submission_token из data уже сохранена, новая строка не
+    # создаётся и возвращается уже сохранённая анкета.
+    token = data.get("submission_token")
+    conn = get_conn()
+    row = _find_submitted(conn, token)
+    if row is not None:
+        return row["id"], row["duplicate_of"], False
+
+    created_ts = int(time.time())
+    keys = application_keys(
+        data.get("passport_number", ""), data.get("phone", ""), data.get("email", "")
     )
-    app_id = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return app_id
+    with conn:
+        duplicate_of, similar_to = _find_duplicate(conn, user_id, keys)
+        cur = conn.execute(
+            """
+            INSERT INTO applications (
+                user_id, username, full_name, created_at, created_ts,
+                place_birth, email, passport_number,
+                home_address, phone,
+                father_name, father_birth_place,
+                mother_name, mother_birth_place,
+                marital_status,
+                spouse_name, spouse_birth_place,
+                work_place, work_address,
+                airport, visa_term, arrival_date,
+                contact_name, contact_phone, contact_address,
+                hotel_booked, hotel_details,
+                five_year_visa,
+                visa_refusal, visa_refusal_details,
+                trips_last_5y, last_visa_details,
+                outside_india, overstay,
+                status, admin_comment, admin_id, duplicate_of, similar_to,
+                submission_token
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(submission_token) DO NOTHING
+            """,
+            (
+                user_id,
+                username,
+                data.get("full_name", ""),
+                format_ts(created_ts),
+                created_ts,
+                data.get("place_birth", ""),
+                data.get("email", ""),
+                data.get("passport_number", ""),
+                data.get("home_address", ""),
+                data.get("phone", ""),
+                data.get("father_name", ""),
+                data.get("father_birth_place", ""),
+                data.get("mother_name", ""),
+                data.get("mother_birth_place", ""),
+                data.get("marital_status", ""),
+                data.get("spouse_name", ""),
+                data.get("spouse_birth_place", ""),
+                data.get("work_place", ""),
+                data.get("work_address", ""),
+                data.get("airport", ""),
+                data.get("visa_term", ""),
+                data.get("arrival_date", ""),
+                data.get("contact_name", ""),
+                data.get("contact_phone", ""),
+                data.get("contact_address", ""),
+                data.get("hotel_booked", ""),
+                data.get("hotel_details", ""),
+                data.get("five_year_visa", ""),
+                data.get("visa_refusal", ""),
+                data.get("visa_refusal_details", ""),
+                data.get("trips_last_5y", ""),
+                data.get("last_visa_details", ""),
+                data.get("outside_india", ""),
+                data.get("overstay", ""),
+                "в ожидании",
+                "",
+                None,
+                duplicate_of,
+                similar_to,
+                token,
+            ),
+        )
+        if cur.rowcount == 0:
+            # ту же сессию успел сохранить другой процесс бота
+            row = _find_submitted(conn, token)
+            return row["id"], row["duplicate_of"], False
+        app_id = cur.lastrowid
+        conn.executemany(
+            "INSERT OR IGNORE INTO application_keys (kind, value, app_id) VALUES (?, ?, ?)",
+            [key + (app_id,) for key in keys],
+        )
+    return app_id, duplicate_of, True
 
 
 def get_application(app_id: int):
@@ -234,48 +1008,766 @@ def get_application(app_id: int):
     cur = conn.cursor()
     cur.execute("SELECT * FROM applications WHERE id=?", (app_id,))
     row = cur.fetchone()
-    conn.close()
     return row
 
 
-def update_application_status(app_id: int, status: str, admin_id: int, comment: str = ""):
+@db_write
+def update_application_status(app_id: int, status: str, admin_id: int, comment: str = "") -> bool:
+    # Решение по анкете распространяется и на её повторные подачи того же
+    # пользователя. Возвращает, изменилась ли сама анкета: если она уже в
+    # этом статусе (повторное нажатие, второй админ), возвращается False,
+    # даже когда догоняются отставшие повторные подачи
+    conn = get_conn()
+    with conn:
+        cur = conn.execute(
+            "UPDATE applications SET status=?, admin_id=?, admin_comment=?, "
+            "version=version+1 WHERE id=? AND status!=?",
+            (status, admin_id, comment, app_id, status),
+        )
+        changed = cur.rowcount > 0
+        conn.execute(
+            "UPDATE applications SET status=?, admin_id=?, admin_comment=?, "
+            "version=version+1 WHERE duplicate_of=? AND status!=? AND user_id="
+            "(SELECT user_id FROM applications WHERE id=?)",
+            (status, admin_id, comment, app_id, status, app_id),
+        )
+    return changed
+
+
+def list_duplicates(app_id: int) -> list:
+    rows = get_conn().execute(
+        "SELECT id FROM applications WHERE duplicate_of=? ORDER BY id", (app_id,)
+    ).fetchall()
+    return [row["id"] for row in rows]
+
+
+def list_applications(status: str = None, before: tuple = None, after: tuple = None,
+                      limit: int = 20):
+    # Keyset-пагинация по (created_ts, id): before — страница старше курсора,
+    # after — страница новее курсора. Запросы идут по покрывающим индексам
+    # (status, created_ts, id, username) и (created_ts, id, status, username),
+    # поэтому стоимость страницы не зависит от размера таблицы.
+    where = []
+    params = []
+    if status is not None:
+        where.append("status=?")
+        params.append(status)
+    if before is not None:
+        where.append("(created_ts, id) < (?, ?)")
+        params.extend(before)
+    elif after is not None:
+        where.append("(created_ts, id) > (?, ?)")
+        params.extend(after)
+    order = "ASC" if after is not None and before is None else "DESC"
+    sql = (
+        "SELECT id, created_ts, username, status FROM applications"
+        + (" WHERE " + " AND ".join(where) if where else "")
+        + f" ORDER BY created_ts {order}, id {order} LIMIT ?"
+    )
+    params.append(limit)
+
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(sql, params)
+    rows = cur.fetchall()
+    if order == "ASC":
+        rows.reverse()
+    return rows
+
+
+def fts_query(text: str) -> str:
+    # Запрос пользователя -> выражение FTS5: каждое слово ищется по префиксу,
+    # все слова должны найтись. Если запрос состоит из цифр (паспорт,
+    # телефон), дополнительно ищется префикс слитных цифр.
+    tokens = re.findall(r"\w+", text)
+    if not tokens:
+        return ""
+    query = " ".join(f'"{token}"*' for token in tokens)
+    digits = "".join(ch for ch in text if ch.isdigit())
+    if len(digits) >= 3 and all(token.isdigit() for token in tokens):
+        query = f'({query}) OR {{passport_digits phone_digits}} : "{digits}"*'
+    return query
+
+
+def search_applications(text: str, limit: int = 20, offset: int = 0):
+    # Самые релевантные сначала; вес совпадения по паспорту и телефону выше,
+    # чем по ФИО и почте
+    query = fts_query(text)
+    if not query:
+        return []
     conn = get_conn()
     cur = conn.cursor()
     cur.execute(
-        "UPDATE applications SET status=?, admin_id=?, admin_comment=? WHERE id=?",
-        (status, admin_id, comment, app_id),
+        """
+        SELECT a.id, a.created_ts, a.username, a.status, a.full_name
+        FROM (
+            SELECT rowid, bm25(applications_fts, 2.0, 1.0, 4.0, 3.0, 4.0, 3.0) AS score
+            FROM applications_fts
+            WHERE applications_fts MATCH ?
+            ORDER BY score
+            LIMIT ? OFFSET ?
+        ) AS hits
+        JOIN applications AS a ON a.id = hits.rowid
+        ORDER BY hits.score
+        """,
+        (query, limit, offset),
     )
-    conn.commit()
-    conn.close()
+    return cur.fetchall()
 
 
-def list_applications(only_pending: bool = False, limit: int = 20):
+def format_ts(ts: int) -> str:
+    return datetime.utcfromtimestamp(ts).isoformat(timespec="seconds")
+
+
+def load_fsm_session(chat_id: int, user_id: int):
     conn = get_conn()
     cur = conn.cursor()
-    if only_pending:
-        cur.execute(
+    cur.execute(
+        "SELECT state, data, bucket, updated_ts FROM fsm_sessions WHERE chat_id=? AND user_id=?",
+        (chat_id, user_id),
+    )
+    return cur.fetchone()
+
+
+@db_write
+def save_fsm_sessions(upserts: list, deletes: list):
+    conn = get_conn()
+    with conn:
+        if upserts:
+            conn.executemany(
+                """
+                INSERT INTO fsm_sessions (chat_id, user_id, state, data, bucket, updated_ts)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                    state=excluded.state,
+                    data=excluded.data,
+                    bucket=excluded.bucket,
+                    updated_ts=excluded.updated_ts
+                """,
+                upserts,
+            )
+        if deletes:
+            conn.executemany(
+                "DELETE FROM fsm_sessions WHERE chat_id=? AND user_id=?", deletes
+            )
+
+
+@db_write
+def enqueue_messages(messages: list):
+    # messages: [(chat_id, text, reply_markup_json или None), ...]
+    now = time.time()
+    conn = get_conn()
+    with conn:
+        conn.executemany(
+            "INSERT INTO outbox (chat_id, text, reply_markup, created_ts, next_try_ts) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(chat_id, text, markup, now, now) for chat_id, text, markup in messages],
+        )
+
+
+@db_write
+def claim_due_messages(now: float, limit: int, lease: float):
+    # Выбранные сообщения откладываются на lease секунд в той же транзакции,
+    # поэтому несколько процессов бота не отправят одно сообщение дважды.
+    # Если процесс упадёт, сообщение снова станет доступным после lease.
+    conn = get_conn()
+    with conn:
+        rows = conn.execute(
             """
-            SELECT id, created_at, username, status
-            FROM applications
-            WHERE status='в ожидании'
-            ORDER BY datetime(created_at) DESC
+            SELECT id, chat_id, text, reply_markup, created_ts, attempts
+            FROM outbox
+            WHERE status='pending' AND next_try_ts <= ?
+              AND NOT EXISTS (
+                  -- более раннее сообщение чата ещё ждёт: порядок в чате важнее
+                  SELECT 1 FROM outbox AS earlier
+                  WHERE earlier.chat_id = outbox.chat_id AND earlier.id < outbox.id
+                    AND earlier.status='pending' AND earlier.next_try_ts > ?
+              )
+            ORDER BY id
             LIMIT ?
             """,
-            (limit,),
+            (now, now, limit),
+        ).fetchall()
+        conn.executemany(
+            "UPDATE outbox SET next_try_ts=? WHERE id=?",
+            [(now + lease, row["id"]) for row in rows],
         )
-    else:
-        cur.execute(
+    return rows
+
+
+def count_pending_messages() -> int:
+    conn = get_conn()
+    return conn.execute("SELECT COUNT(*) FROM outbox WHERE status='pending'").fetchone()[0]
+
+
+@db_write
+def finish_outbox_batch(sent_ids: list, retries: list, failed: list, deferred: list = ()):
+    # retries: [(next_try_ts, last_error, id)], failed: [(last_error, id)],
+    # deferred: [(next_try_ts, id)] — не отправлялись, попытка не считается
+    conn = get_conn()
+    with conn:
+        conn.executemany("DELETE FROM outbox WHERE id=?", [(i,) for i in sent_ids])
+        conn.executemany(
+            "UPDATE outbox SET next_try_ts=?, attempts=attempts+1, last_error=? WHERE id=?",
+            retries,
+        )
+        conn.executemany("UPDATE outbox SET next_try_ts=? WHERE id=?", deferred)
+        conn.executemany(
+            "UPDATE outbox SET status='failed', attempts=attempts+1, last_error=? WHERE id=?",
+            failed,
+        )
+
+
+def count_fsm_sessions() -> int:
+    return get_conn().execute("SELECT COUNT(*) FROM fsm_sessions").fetchone()[0]
+
+
+@db_write
+def delete_expired_fsm_sessions(before_ts: int) -> int:
+    conn = get_conn()
+    with conn:
+        cur = conn.execute("DELETE FROM fsm_sessions WHERE updated_ts < ?", (before_ts,))
+    return cur.rowcount
+
+
+@db_write
+def save_funnel_events(events: list):
+    # events: [(ts, user_id, step, event, elapsed или None), ...]
+    # Агрегаты пачки считаются в памяти и добавляются в funnel_daily
+    # одним upsert на (день, шаг, событие)
+    rollup = {}
+    for ts, _, step, event, elapsed in events:
+        day = datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d")
+        entry = rollup.setdefault((day, step, event), [0, 0, 0.0])
+        entry[0] += 1
+        if elapsed is not None:
+            entry[1] += 1
+            entry[2] += elapsed
+    conn = get_conn()
+    with conn:
+        conn.executemany(
+            "INSERT INTO funnel_events (ts, user_id, step, event, elapsed) VALUES (?, ?, ?, ?, ?)",
+            events,
+        )
+        conn.executemany(
             """
-            SELECT id, created_at, username, status
-            FROM applications
-            ORDER BY datetime(created_at) DESC
-            LIMIT ?
+            INSERT INTO funnel_daily (day, step, event, count, timed, elapsed_sum)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(day, step, event) DO UPDATE SET
+                count = count + excluded.count,
+                timed = timed + excluded.timed,
+                elapsed_sum = elapsed_sum + excluded.elapsed_sum
             """,
-            (limit,),
+            [key + tuple(entry) for key, entry in rollup.items()],
         )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+
+
+def funnel_stats(since_day: str) -> dict:
+    # {(шаг, событие): (количество, среднее время или None)} начиная с since_day
+    rows = get_conn().execute(
+        """
+        SELECT step, event, SUM(count) AS count, SUM(timed) AS timed,
+               SUM(elapsed_sum) AS elapsed_sum
+        FROM funnel_daily
+        WHERE day >= ?
+        GROUP BY step, event
+        """,
+        (since_day,),
+    ).fetchall()
+    return {
+        (row["step"], row["event"]): (
+            row["count"], row["elapsed_sum"] / row["timed"] if row["timed"] else None
+        )
+        for row in rows
+    }
+
+
+# ---------- АСИНХРОННЫЙ ДОСТУП К БД ----------
+
+# Все обращения к SQLite выполняются в отдельных потоках, чтобы медленный
+# commit/fsync не блокировал event loop и ответы другим пользователям.
+# Запись идёт через единственный поток-писатель (в SQLite писатель всегда
+# один), чтение — через пул читателей, которые в WAL не ждут запись.
+db_write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-w")
+db_read_executor = ThreadPoolExecutor(max_workers=DB_READERS, thread_name_prefix="sqlite-r")
+
+
+def _timed_db_call(func, pool: str, queued: float, args, kwargs):
+    started = time.perf_counter()
+    DB_WAIT_SECONDS.observe(started - queued, pool)
+    try:
+        return func(*args, **kwargs)
+    finally:
+        DB_QUERY_SECONDS.observe(time.perf_counter() - started, func.__name__)
+
+
+async def run_db(func, *args, **kwargs):
+    write = getattr(func, "db_write", False)
+    executor = db_write_executor if write else db_read_executor
+    loop = asyncio.get_running_loop()
+    call = loop.run_in_executor(
+        executor,
+        _timed_db_call, func, "write" if write else "read", time.perf_counter(), args, kwargs,
+    )
+    if not TRACE_ENABLED:
+        return await call
+    with trace_span(f"db:{func.__name__}"):
+        return await call
+
+
+# ===================== ХРАНИЛИЩЕ FSM =====================
+
+class SQLiteStorage(BaseStorage):
+    # Состояния и ответы анкеты хранятся в таблице fsm_sessions, поэтому
+    # переживают перезапуск бота. Горячие сессии лежат в LRU-кэше в памяти;
+    # изменения копятся в _dirty и раз в FSM_FLUSH_INTERVAL секунд пишутся
+    # в базу одной транзакцией. Сессии без изменений дольше FSM_SESSION_TTL
+    # удаляются из кэша и из базы фоновой задачей.
+
+    def __init__(
+        self,
+        cache_size: int = FSM_CACHE_SIZE,
+        flush_interval: float = FSM_FLUSH_INTERVAL,
+        ttl: int = FSM_SESSION_TTL,
+        sweep_interval: int = FSM_SWEEP_INTERVAL,
+    ):
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._flushing = {}
+        self._flush_task = None
+        self._sweep_task = None
+
+    # ---------- служебное ----------
+
+    @staticmethod
+    def _empty_record() -> dict:
+        return {"state": None, "data": {}, "bucket": {}, "ts": time.time()}
+
+    def _key(self, chat, user) -> tuple:
+        chat, user = self.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    async def _get_record(self, key: tuple) -> dict:
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            return record
+        if self.cache_size <= 0:
+            self._cache.clear()
+
+        # вытесненная из кэша, но ещё не записанная сессия
+        record = self._dirty.get(key) or self._flushing.get(key)
+        if record is None:
+            row = await run_db(load_fsm_session, *key)
+            # пока шёл запрос, сессию мог загрузить другой апдейт или flush
+            # мог забрать её в запись: прочитанная строка тогда уже устарела
+            record = self._cache.get(key) or self._dirty.get(key) or self._flushing.get(key)
+            if record is None and row is None:
+                record = self._empty_record()
+            elif record is None:
+                record = {
+                    "state": row["state"],
+                    "data": json.loads(row["data"] or "{}"),
+                    "bucket": json.loads(row["bucket"] or "{}"),
+                    "ts": row["updated_ts"],
+                }
+
+        self._cache[key] = record
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return record
+
+    async def _mark_dirty(self, key: tuple, record: dict):
+        record["ts"] = time.time()
+        self._dirty[key] = record
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+            if self.flush_interval > 0:
+                self._flush_task = asyncio.create_task(self._flush_loop())
+        if self.flush_interval <= 0:
+            await self.flush()
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logging.exception("Не удалось очистить устаревшие FSM-сессии")
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        self._flushing, self._dirty = self._dirty, {}
+        upserts = []
+        deletes = []
+        for (chat_id, user_id), record in self._flushing.items():
+            if record["state"] is None and not record["data"] and not record["bucket"]:
+                deletes.append((chat_id, user_id))
+            else:
+                upserts.append((
+                    chat_id,
+                    user_id,
+                    record["state"],
+                    json.dumps(record["data"], ensure_ascii=False),
+                    json.dumps(record["bucket"], ensure_ascii=False),
+                    int(record["ts"]),
+                ))
+        try:
+            await run_db(save_fsm_sessions, upserts, deletes)
+        except Exception:
+            logging.exception("Не удалось сохранить FSM-сессии, повторим позже")
+            # более свежие изменения из _dirty не перетираем
+            for key, record in self._flushing.items():
+                self._dirty.setdefault(key, record)
+        finally:
+            self._flushing = {}
+
+    async def sweep(self):
+        deadline = time.time() - self.ttl
+        expired = [
+            key for key, record in self._cache.items()
+            if record["ts"] < deadline and key not in self._dirty
+        ]
+        for key in expired:
+            del self._cache[key]
+        removed = await run_db(delete_expired_fsm_sessions, int(deadline))
+        if removed:
+            logging.info(f"Удалено устаревших FSM-сессий: {removed}")
+
+    def stats(self) -> dict:
+        return {"cached": len(self._cache), "dirty": len(self._dirty)}
+
+    # ---------- BaseStorage ----------
+
+    async def close(self):
+        for task in (self._flush_task, self._sweep_task):
+            if task is not None:
+                task.cancel()
+        self._flush_task = self._sweep_task = None
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        record = await self._get_record(self._key(chat, user))
+        return record["state"] if record["state"] is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None) -> dict:
+        record = await self._get_record(self._key(chat, user))
+        return copy.deepcopy(record["data"])
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key = self._key(chat, user)
+        record = await self._get_record(key)
+        record["state"] = self.resolve_state(state)
+        await self._mark_dirty(key, record)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key = self._key(chat, user)
+        record = await self._get_record(key)
+        record["data"] = copy.deepcopy(data or {})
+        await self._mark_dirty(key, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key = self._key(chat, user)
+        record = await self._get_record(key)
+        record["data"].update(copy.deepcopy(data or {}), **kwargs)
+        await self._mark_dirty(key, record)
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        key = self._key(chat, user)
+        record = await self._get_record(key)
+        record["state"] = None
+        if with_data:
+            record["data"] = {}
+        await self._mark_dirty(key, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None) -> dict:
+        record = await self._get_record(self._key(chat, user))
+        return copy.deepcopy(record["bucket"])
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        key = self._key(chat, user)
+        record = await self._get_record(key)
+        record["bucket"] = copy.deepcopy(bucket or {})
+        await self._mark_dirty(key, record)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        key = self._key(chat, user)
+        record = await self._get_record(key)
+        record["bucket"].update(copy.deepcopy(bucket or {}), **kwargs)
+        await self._mark_dirty(key, record)
+
+
+# ===================== ОЧЕРЕДЬ АПДЕЙТОВ =====================
+
+def update_chat_id(update: types.Update):
+    # Ключ очереди: чат сообщения, для нажатий кнопок — чат сообщения с
+    # кнопкой (или пользователь, если сообщения нет). Прочие апдейты бот не
+    # обрабатывает, они идут каждый в свою очередь.
+    message = update.message or update.edited_message
+    if message is not None:
+        return message.chat.id
+    callback_query = update.callback_query
+    if callback_query is not None:
+        if callback_query.message is not None:
+            return callback_query.message.chat.id
+        return callback_query.from_user.id
+    return ("update", update.update_id)
+
+
+class SeenKeys:
+    # Ограниченный набор недавно встреченных ключей. Время жизни у всех
+    # ключей одно, поэтому порядок добавления совпадает с порядком
+    # истечения, и устаревшие ключи снимаются с начала OrderedDict.
+
+    def __init__(self, ttl: float = DEDUP_TTL, size: int = DEDUP_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._expires = OrderedDict()
+
+    def add(self, key) -> bool:
+        # True, если ключ новый; False, если он уже встречался за ttl
+        now = time.monotonic()
+        while self._expires:
+            expires = next(iter(self._expires.values()))
+            if expires > now and len(self._expires) < self.size:
+                break
+            self._expires.popitem(last=False)
+        if key in self._expires:
+            return False
+        self._expires[key] = now + self.ttl
+        return True
+
+
+class UpdateScheduler:
+    # Апдейты раскладываются по очередям чатов. У непустой очереди есть свой
+    # воркер, который обрабатывает апдейты чата по одному: двойное нажатие
+    # «Отправить» или быстрые ответы на шаги анкеты не гоняются за данными
+    # FSM. Воркеры разных чатов работают параллельно, но одновременно
+    # обрабатывается не больше concurrency апдейтов. Опустевшая очередь
+    # удаляется вместе с воркером, так что память занимают только чаты с
+    # необработанными апдейтами. Всего в очередях не больше limit апдейтов:
+    # submit ждёт места, и polling/webhook перестают принимать новые.
+
+    def __init__(self, process, concurrency: int = UPDATE_CONCURRENCY,
+                 limit: int = UPDATE_QUEUE_LIMIT):
+        self.process = process
+        self.concurrency = concurrency
+        self.limit = limit
+        self._queues = {}
+        self._workers = set()
+        self._pending = 0
+        self._slots = None
+        self._room = None
+        self._admission = None
+
+    def start(self):
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._room = asyncio.Event()
+        self._admission = asyncio.Lock()
+
+    def stats(self) -> dict:
+        return {"pending": self._pending, "chats": len(self._queues)}
+
+    async def submit(self, updates):
+        # Под блокировкой, чтобы пачки апдейтов, ждущие места, не обгоняли
+        # друг друга: порядок постановки в очередь — порядок получения
+        async with self._admission:
+            for update in updates:
+                while self._pending >= self.limit:
+                    self._room.clear()
+                    await self._room.wait()
+                self._pending += 1
+                key = update_chat_id(update)
+                queue = self._queues.get(key)
+                if queue is None:
+                    queue = self._queues[key] = deque()
+                    task = asyncio.create_task(self._worker(key, queue))
+                    self._workers.add(task)
+                    task.add_done_callback(self._workers.discard)
+                queue.append(update)
+
+    async def drain(self):
+        # дожидаемся апдейтов, которые уже приняты
+        while self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+
+    async def _worker(self, key, queue: deque):
+        try:
+            while queue:
+                update = queue.popleft()
+                try:
+                    async with self._slots:
+                        await self._process_one(update)
+                finally:
+                    self._pending -= 1
+                    self._room.set()
+        finally:
+            # Очередь удаляется при любом выходе, иначе новые апдейты чата
+            # вставали бы в очередь без воркера. Между проверкой очереди и
+            # удалением нет await, поэтому submit не может добавить апдейт в
+            # уже отработавшую очередь. Остаток есть, только если воркер
+            # отменён (остановка бота).
+            if queue:
+                logging.warning(f"Не обработано {len(queue)} апдейтов чата {key}")
+                self._pending -= len(queue)
+                self._room.set()
+            del self._queues[key]
+
+    async def _process_one(self, update: types.Update):
+        # Каждый апдейт — отдельной задачей: aiogram кэширует состояние FSM
+        # в contextvar, и следующий апдейт чата не должен его видеть.
+        # asyncio.wait не пробрасывает ни ошибку, ни отмену самой задачи, так
+        # что CancelledError здесь — только отмена воркера.
+        task = asyncio.create_task(self.process(update))
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        if task.cancelled():
+            logging.error(f"Обработка апдейта {update.update_id} отменена")
+        elif task.exception() is not None:
+            logging.error(
+                f"Ошибка обработки апдейта {update.update_id}", exc_info=task.exception()
+            )
+
+
+# ===================== БОТ =====================
+
+class InstrumentedBot(Bot):
+    # Bot, который меряет время и ошибки каждого запроса к Bot API
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            if TRACE_ENABLED:
+                with trace_span(f"api:{method}"):
+                    return await super().request(method, data, files, **kwargs)
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            API_ERRORS.inc(method, type(e).__name__)
+            raise
+        finally:
+            API_REQUEST_SECONDS.observe(time.perf_counter() - started, method)
+
+
+bot = InstrumentedBot(
+    token=API_TOKEN,
+    server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION,
+)
+
+
+class ScheduledDispatcher(Dispatcher):
+    # Dispatcher, который вместо gather отдаёт апдейты в UpdateScheduler:
+    # и polling, и webhook получают порядок внутри чата и общий лимит
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = UpdateScheduler(self._process_scheduled)
+        self.seen = SeenKeys()
+        self._updates_request = None
+
+    def is_new(self, update: types.Update) -> bool:
+        # Повторная доставка отбрасывается до очереди и middleware
+        if not self.seen.add(("update", update.update_id)):
+            UPDATES_DUPLICATE.inc("update")
+            return False
+        callback_query = update.callback_query
+        if callback_query is not None and not self.seen.add(("callback", callback_query.id)):
+            UPDATES_DUPLICATE.inc("callback")
+            return False
+        return True
+
+    async def process_updates(self, updates, fast: bool = True):
+        # Результаты хендлеров (ответы вебхуку) боту не нужны
+        updates = [update for update in updates if self.is_new(update)]
+        if updates:
+            await self.scheduler.submit(updates)
+        return []
+
+    async def start_polling(self, timeout=20, relax=0.1, limit=None, reset_webhook=None,
+                            fast=True, error_sleep=5, allowed_updates=None):
+        # Цикл как у aiogram, но пачка ставится в очереди здесь же, а не в
+        # фоновой задаче: когда очереди заполнены, submit ждёт и следующий
+        # getUpdates не запрашивается, так что лишние апдейты ждут на стороне
+        # Telegram, а не копятся в памяти. Бот создаётся без своего таймаута,
+        # поэтому request_timeout из aiogram не нужен.
+        # Повторяет Dispatcher.start_polling из aiogram==2.25.1 (версия
+        # закреплена в requirements.txt) и опирается на его внутренние
+        # _polling и _close_waiter: при обновлении aiogram сверить с оригиналом.
+        if self._polling:
+            raise RuntimeError("Polling already started")
+        logging.info("Start polling.")
+        Dispatcher.set_current(self)
+        Bot.set_current(self.bot)
+        if reset_webhook is None:
+            await self.reset_webhook(check=False)
+        if reset_webhook:
+            await self.reset_webhook(check=True)
+
+        self._polling = True
+        offset = None
+        try:
+            while self._polling:
+                self._updates_request = asyncio.ensure_future(self.bot.get_updates(
+                    limit=limit, offset=offset, timeout=timeout, allowed_updates=allowed_updates,
+                ))
+                try:
+                    updates = await self._updates_request
+                except asyncio.CancelledError:
+                    # stop_polling отменяет только запрос getUpdates; отмена
+                    # самой задачи polling пробрасывается дальше
+                    if not self._polling:
+                        break
+                    raise
+                except Exception:
+                    logging.exception("Ошибка получения апдейтов")
+                    await asyncio.sleep(error_sleep)
+                    continue
+                finally:
+                    self._updates_request = None
+                # после остановки пачка не берётся: её offset не подтверждён
+                if updates and self._polling:
+                    offset = updates[-1].update_id + 1
+                    await self.process_updates(updates, fast)
+                if relax:
+                    await asyncio.sleep(relax)
+        finally:
+            self._close_waiter.set_result(None)
+            logging.warning("Polling is stopped.")
+
+    def stop_polling(self):
+        # Висящий long polling запрос прерывается, чтобы остановка не ждала
+        # его таймаута и не приняла апдейты после начала завершения
+        super().stop_polling()
+        if self._updates_request is not None:
+            self._updates_request.cancel()
+
+    async def _process_scheduled(self, update: types.Update):
+        Bot.set_current(self.bot)
+        Dispatcher.set_current(self)
+        # через notify, чтобы сработали middleware уровня апдейта
+        await self.updates_handler.notify(update)
+
+
+storage = SQLiteStorage()
+dp = ScheduledDispatcher(bot, storage=storage)
 
 
 # ===================== СОСТОЯНИЯ (FSM) =====================
@@ -319,103 +1811,348 @@ class AdminDialog(StatesGroup):
     waiting_for_text = State()
 
 
+# ===================== CALLBACK-ДАННЫЕ =====================
+
+class CallbackCodec:
+    # Формат callback_data: "<префикс>:<часть>:<часть>...". Части задаются
+    # парами (имя, тип); unpack возвращает namedtuple с приведёнными типами
+    # и бросает ValueError на чужих или испорченных данных.
+
+    def __init__(self, prefix: str, *parts):
+        self.prefix = prefix
+        self.types = [kind for _, kind in parts]
+        self.fields = namedtuple("CallbackData", [name for name, _ in parts])
+
+    def pack(self, *values) -> str:
+        return ":".join([self.prefix, *map(str, values)])
+
+    def unpack(self, data: str):
+        if not self.types:
+            if data != self.prefix:
+                raise ValueError(data)
+            return self.fields()
+        if not data.startswith(self.prefix + ":"):
+            raise ValueError(data)
+        # последняя часть забирает остаток строки вместе с двоеточиями
+        values = data[len(self.prefix) + 1:].split(":", len(self.types) - 1)
+        if len(values) != len(self.types):
+            raise ValueError(data)
+        return self.fields(*(kind(value) for kind, value in zip(self.types, values)))
+
+
+CB_IGNORE = CallbackCodec("ignore")
+
+CB_AIRPORT = CallbackCodec("airport", ("value", str))
+CB_VISA_TERM = CallbackCodec("visaterm", ("value", str))
+CB_DATE = CallbackCodec("cal", ("value", str))
+CB_CAL_NAV = CallbackCodec("calnav", ("year", int), ("month", int))
+CB_HOTEL = CallbackCodec("hotel", ("value", str))
+CB_FIVE_YEAR_VISA = CallbackCodec("fivevisa", ("value", str))
+CB_VISA_REFUSAL = CallbackCodec("vref", ("value", str))
+CB_OUTSIDE_INDIA = CallbackCodec("outindia", ("value", str))
+CB_OVERSTAY = CallbackCodec("overstay", ("value", str))
+
+CB_CONFIRM_SEND = CallbackCodec("confirm:send")
+CB_CONFIRM_EDIT = CallbackCodec("confirm:edit")
+CB_EDIT = CallbackCodec("edit", ("field", str))
+
+CB_ADMIN_NEW = CallbackCodec("admin:new")
+CB_ADMIN_ALL = CallbackCodec("admin:all")
+CB_ADMIN_ADMINS = CallbackCodec("admin:admins")
+CB_ADMIN_FUNNEL = CallbackCodec("admin:funnel", ("days", int))
+CB_ADMIN_PANEL = CallbackCodec("admin:panel")
+CB_ADMIN_OPEN = CallbackCodec("admin:open", ("app_id", int))
+CB_SEARCH = CallbackCodec("search", ("page", int))
+# страницы списка: направление b — старше курсора, a — новее, n — первая страница
+CB_APPS = CallbackCodec(
+    "apps", ("flt", str), ("direction", str), ("ts", int), ("app_id", int)
+)
+CB_APPROVE = CallbackCodec("approve", ("app_id", int))
+CB_REJECT = CallbackCodec("reject", ("app_id", int))
+CB_MSG_USER = CallbackCodec("msguser", ("app_id", int))
+CB_MAKE_ADMIN = CallbackCodec("makeadmin", ("app_id", int))
+
+
+class CallbackRouter:
+    # Маршрутизация нажатий кнопок по префиксу callback_data словарём вместо
+    # перебора лямбда-фильтров. Хендлер маршрута вызывается как
+    # handler(callback_query, cb, state, role), где cb — разобранные данные.
+    #
+    # Состояния маршрута как у фильтра state в aiogram: None — только вне
+    # сценариев, "*" — в любом состоянии, State или список State — только в них.
+
+    def __init__(self):
+        self._routes = {}
+        self._depth = 0
+
+    def add(self, codec: CallbackCodec, handler, state=None):
+        if codec.prefix in self._routes:
+            raise ValueError(f"Маршрут {codec.prefix!r} уже зарегистрирован")
+        if state == "*":
+            states = None
+        else:
+            items = state if isinstance(state, (list, tuple, set)) else [state]
+            states = frozenset(item.state if isinstance(item, State) else item for item in items)
+        self._routes[codec.prefix] = (codec, handler, states)
+        self._depth = max(self._depth, codec.prefix.count(":") + 1)
+
+    def route(self, codec: CallbackCodec, state=None):
+        def decorator(handler):
+            self.add(codec, handler, state)
+            return handler
+        return decorator
+
+    def resolve(self, data: str):
+        # Префикс занимает не больше _depth первых частей data: для
+        # "admin:open:5" проверяются "admin" и "admin:open"
+        end = -1
+        for _ in range(self._depth):
+            end = data.find(":", end + 1)
+            route = self._routes.get(data if end < 0 else data[:end])
+            if route is not None or end < 0:
+                return route
+        return None
+
+    async def dispatch(self, callback_query: CallbackQuery, state: FSMContext, role: str) -> bool:
+        route = self.resolve(callback_query.data or "")
+        if route is None:
+            return False
+        codec, handler, states = route
+        if states is not None and await state.get_state() not in states:
+            return False
+        handler_label.set(getattr(handler, "__name__", codec.prefix))
+        try:
+            cb = codec.unpack(callback_query.data)
+        except ValueError:
+            await callback_query.answer("Ошибка данных", show_alert=True)
+            return True
+        await handler(callback_query, cb, state, role)
+        return True
+
+
+callbacks = CallbackRouter()
+
+
 # ===================== КЛАВИАТУРЫ =====================
 
-user_main_kb = ReplyKeyboardMarkup(resize_keyboard=True)
-user_main_kb.add(KeyboardButton("Заполнить анкету"))
+# Клавиатуры хранятся уже сериализованными в JSON: строку в reply_markup
+# aiogram передаёт в запрос как есть, без сборки объектов и json.dumps на
+# каждую отправку. Постоянные клавиатуры собираются один раз при запуске,
+# зависящие от параметров (заявка, месяц календаря) — в LRU-кэше.
+
+def markup_json(markup):
+    if markup is None or isinstance(markup, str):
+        return markup
+    return markup.as_json()
+
+
+def _main_menu_kb(*buttons) -> str:
+    kb = ReplyKeyboardMarkup(resize_keyboard=True)
+    kb.add(*[KeyboardButton(text) for text in buttons])
+    return kb.as_json()
+
 
-admin_main_kb = ReplyKeyboardMarkup(resize_keyboard=True)
-admin_main_kb.add(KeyboardButton("Заполнить анкету"), KeyboardButton("Админ-панель"))
+user_main_kb = _main_menu_kb("Заполнить анкету")
+admin_main_kb = _main_menu_kb("Заполнить анкету", "Админ-панель")
 
 
-def airport_kb() -> InlineKeyboardMarkup:
+@functools.lru_cache(maxsize=None)
+def airport_kb() -> str:
     kb = InlineKeyboardMarkup(row_width=2)
     kb.add(
-        InlineKeyboardButton("Даболим", callback_data="airport:Dabolim"),
-        InlineKeyboardButton("Мора", callback_data="airport:Mopa"),
+        InlineKeyboardButton("Даболим", callback_data=CB_AIRPORT.pack("Dabolim")),
+        InlineKeyboardButton("Мора", callback_data=CB_AIRPORT.pack("Mopa")),
     )
-    return kb
+    return kb.as_json()
 
 
-def visa_term_kb() -> InlineKeyboardMarkup:
+@functools.lru_cache(maxsize=None)
+def visa_term_kb() -> str:
     kb = InlineKeyboardMarkup(row_width=3)
     kb.add(
-        InlineKeyboardButton("30 дней", callback_data="visaterm:30d"),
-        InlineKeyboardButton("1 год", callback_data="visaterm:1y"),
-        InlineKeyboardButton("5 лет", callback_data="visaterm:5y"),
+        InlineKeyboardButton("30 дней", callback_data=CB_VISA_TERM.pack("30d")),
+        InlineKeyboardButton("1 год", callback_data=CB_VISA_TERM.pack("1y")),
+        InlineKeyboardButton("5 лет", callback_data=CB_VISA_TERM.pack("5y")),
     )
-    return kb
+    return kb.as_json()
 
 
-def yes_no_kb(prefix: str) -> InlineKeyboardMarkup:
+@functools.lru_cache(maxsize=None)
+def yes_no_kb(codec: CallbackCodec) -> str:
     kb = InlineKeyboardMarkup(row_width=2)
     kb.add(
-        InlineKeyboardButton("Да", callback_data=f"{prefix}:yes"),
-        InlineKeyboardButton("Нет", callback_data=f"{prefix}:no"),
+        InlineKeyboardButton("Да", callback_data=codec.pack("yes")),
+        InlineKeyboardButton("Нет", callback_data=codec.pack("no")),
     )
-    return kb
+    return kb.as_json()
 
 
-def admin_panel_kb() -> InlineKeyboardMarkup:
+@functools.lru_cache(maxsize=None)
+def admin_panel_kb() -> str:
     kb = InlineKeyboardMarkup(row_width=1)
     kb.add(
-        InlineKeyboardButton("Новые заявки", callback_data="admin:new"),
-        InlineKeyboardButton("Все заявки", callback_data="admin:all"),
-        InlineKeyboardButton("Список админов", callback_data="admin:admins"),
+        InlineKeyboardButton("Новые заявки", callback_data=CB_ADMIN_NEW.pack()),
+        InlineKeyboardButton("Все заявки", callback_data=CB_ADMIN_ALL.pack()),
+        InlineKeyboardButton("Список админов", callback_data=CB_ADMIN_ADMINS.pack()),
+        InlineKeyboardButton("Воронка", callback_data=CB_ADMIN_FUNNEL.pack(7)),
     )
+    return kb.as_json()
+
+
+FUNNEL_PERIODS = (1, 7, 30)
+
+
+@functools.lru_cache(maxsize=None)
+def funnel_kb(days: int) -> str:
+    kb = InlineKeyboardMarkup(row_width=3)
+    kb.add(*[
+        InlineKeyboardButton(
+            ("• " if period == days else "") + f"{period} дн.",
+            callback_data=CB_ADMIN_FUNNEL.pack(period),
+        )
+        for period in FUNNEL_PERIODS
+    ])
+    kb.row(InlineKeyboardButton("Назад", callback_data=CB_ADMIN_PANEL.pack()))
+    return kb.as_json()
+
+
+# Фильтры списка заявок: ключ в callback_data -> (название, статус)
+APP_FILTERS = {
+    "new": ("Новые", "в ожидании"),
+    "ok": ("Одобренные", "одобрена"),
+    "rej": ("Отклонённые", "отклонена"),
+    "all": ("Все", None),
+}
+
+APPS_PAGE_SIZE = 10
+
+
+def applications_page_kb(rows, flt: str, has_newer: bool, has_older: bool) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardMarkup(row_width=5)
+    for app in rows:
+        kb.insert(InlineKeyboardButton(f"№{app['id']}", callback_data=CB_ADMIN_OPEN.pack(app["id"])))
+    nav = []
+    if has_newer and rows:
+        first = rows[0]
+        nav.append(InlineKeyboardButton(
+            "« Новее", callback_data=CB_APPS.pack(flt, "a", first["created_ts"], first["id"])
+        ))
+    if has_older and rows:
+        last = rows[-1]
+        nav.append(InlineKeyboardButton(
+            "Старее »", callback_data=CB_APPS.pack(flt, "b", last["created_ts"], last["id"])
+        ))
+    if nav:
+        kb.row(*nav)
+    kb.row(*[
+        InlineKeyboardButton(
+            ("• " if key == flt else "") + title, callback_data=CB_APPS.pack(key, "n", 0, 0)
+        )
+        for key, (title, _) in APP_FILTERS.items()
+    ])
+    kb.row(InlineKeyboardButton("Назад", callback_data=CB_ADMIN_PANEL.pack()))
     return kb
 
 
-def admin_application_kb(app_id: int) -> InlineKeyboardMarkup:
+def search_page_kb(rows, page: int, has_next: bool) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardMarkup(row_width=5)
+    for app in rows:
+        kb.insert(InlineKeyboardButton(f"№{app['id']}", callback_data=CB_ADMIN_OPEN.pack(app["id"])))
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("« Назад", callback_data=CB_SEARCH.pack(page - 1)))
+    if has_next:
+        nav.append(InlineKeyboardButton("Дальше »", callback_data=CB_SEARCH.pack(page + 1)))
+    if nav:
+        kb.row(*nav)
+    return kb
+
+
+@functools.lru_cache(maxsize=KB_CACHE_SIZE)
+def admin_application_kb(app_id: int) -> str:
     kb = InlineKeyboardMarkup(row_width=2)
     kb.add(
-        InlineKeyboardButton("Одобрить", callback_data=f"approve:{app_id}"),
-        InlineKeyboardButton("Отклонить", callback_data=f"reject:{app_id}"),
+        InlineKeyboardButton("Одобрить", callback_data=CB_APPROVE.pack(app_id)),
+        InlineKeyboardButton("Отклонить", callback_data=CB_REJECT.pack(app_id)),
     )
     kb.add(
-        InlineKeyboardButton("Написать пользователю", callback_data=f"msguser:{app_id}")
+        InlineKeyboardButton("Написать пользователю", callback_data=CB_MSG_USER.pack(app_id))
     )
     kb.add(
-        InlineKeyboardButton("Сделать админом", callback_data=f"makeadmin:{app_id}")
+        InlineKeyboardButton("Сделать админом", callback_data=CB_MAKE_ADMIN.pack(app_id))
     )
-    return kb
+    return kb.as_json()
 
 
-def confirm_kb() -> InlineKeyboardMarkup:
+@functools.lru_cache(maxsize=None)
+def confirm_kb() -> str:
     kb = InlineKeyboardMarkup(row_width=2)
     kb.add(
-        InlineKeyboardButton("Отправить", callback_data="confirm:send"),
-        InlineKeyboardButton("Редактировать анкету", callback_data="confirm:edit"),
+        InlineKeyboardButton("Отправить", callback_data=CB_CONFIRM_SEND.pack()),
+        InlineKeyboardButton("Редактировать анкету", callback_data=CB_CONFIRM_EDIT.pack()),
     )
-    return kb
+    return kb.as_json()
+
+
+def shift_month(year: int, month: int, delta: int) -> tuple:
+    year, month = divmod(year * 12 + month - 1 + delta, 12)
+    return year, month + 1
 
 
-def create_calendar() -> InlineKeyboardMarkup:
+def create_calendar(year: int = None, month: int = None) -> str:
+    # Месяц ограничивается диапазоном от текущего до CALENDAR_MONTHS_AHEAD
+    # вперёд; в текущем месяце прошедшие дни недоступны
     today = date.today()
-    year, month = today.year, today.month
-    cal = calendar.monthcalendar(year, month)
+    offset = 0
+    if year is not None:
+        offset = (year - today.year) * 12 + month - today.month
+        offset = max(0, min(CALENDAR_MONTHS_AHEAD, offset))
+    year, month = shift_month(today.year, today.month, offset)
+    first_day = today.day if offset == 0 else 1
+    return calendar_kb(year, month, first_day, offset > 0, offset < CALENDAR_MONTHS_AHEAD)
+
+
+@functools.lru_cache(maxsize=32)
+def month_grid(year: int, month: int) -> tuple:
+    return tuple(tuple(week) for week in calendar.monthcalendar(year, month))
+
 
+@functools.lru_cache(maxsize=32)
+def calendar_kb(year: int, month: int, first_day: int, has_prev: bool, has_next: bool) -> str:
+    ignore = CB_IGNORE.pack()
     kb = InlineKeyboardMarkup(row_width=7)
 
     month_name = calendar.month_name[month]
-    kb.row(InlineKeyboardButton(f"{month_name} {year}", callback_data="ignore"))
+    kb.row(
+        InlineKeyboardButton(
+            "«" if has_prev else " ",
+            callback_data=CB_CAL_NAV.pack(*shift_month(year, month, -1)) if has_prev else ignore,
+        ),
+        InlineKeyboardButton(f"{month_name} {year}", callback_data=ignore),
+        InlineKeyboardButton(
+            "»" if has_next else " ",
+            callback_data=CB_CAL_NAV.pack(*shift_month(year, month, 1)) if has_next else ignore,
+        ),
+    )
 
     week_days = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
-    kb.row(*[InlineKeyboardButton(d, callback_data="ignore") for d in week_days])
+    kb.row(*[InlineKeyboardButton(d, callback_data=ignore) for d in week_days])
 
-    for week in cal:
+    for week in month_grid(year, month):
         row = []
         for day in week:
             if day == 0:
-                row.append(InlineKeyboardButton(" ", callback_data="ignore"))
+                row.append(InlineKeyboardButton(" ", callback_data=ignore))
+            elif day < first_day:
+                row.append(InlineKeyboardButton("·", callback_data=ignore))
             else:
                 date_str = f"{year:04d}-{month:02d}-{day:02d}"
                 row.append(
-                    InlineKeyboardButton(str(day), callback_data=f"cal:{date_str}")
+                    InlineKeyboardButton(str(day), callback_data=CB_DATE.pack(date_str))
                 )
         kb.row(*row)
 
-    return kb
+    return kb.as_json()
 
 
 EDIT_FIELDS = [
@@ -450,667 +2187,1197 @@ EDIT_FIELDS = [
 ]
 
 
-def edit_menu_kb() -> InlineKeyboardMarkup:
+@functools.lru_cache(maxsize=None)
+def edit_menu_kb() -> str:
     kb = InlineKeyboardMarkup(row_width=2)
     for field, title in EDIT_FIELDS:
-        kb.insert(InlineKeyboardButton(title, callback_data=f"edit:{field}"))
-    return kb
-
-
-# ===================== ВСПОМОГАТЕЛЬНОЕ =====================
-
-def format_application_text(app: sqlite3.Row) -> str:
-    uname = f"@{app['username']}" if app["username"] else "без username"
-    status = app["status"] or "в ожидании"
-    lines = [
-        f"Заявка №{app['id']} (статус: {status})",
-        f"Создана: {app['created_at']}",
-        "",
-        f"Пользователь: {uname} (ID {app['user_id']})",
-        f"ФИО: {app['full_name']}",
-        "",
-        f"1. Место рождения: {app['place_birth']}",
-        f"2. Электронная почта: {app['email']}",
-        f"3. Номер национального паспорта: {app['passport_number']}",
-        f"4. Домашний адрес: {app['home_address']}",
-        f"5. Номер телефона: {app['phone']}",
-        f"6. ФИО отца: {app['father_name']}",
-        f"7. Место рождения отца: {app['father_birth_place']}",
-        f"8. ФИО матери: {app['mother_name']}",
-        f"   Место рождения матери: {app['mother_birth_place']}",
-        f"9. Семейное положение: {app['marital_status']}",
-        f"10. ФИО супруга(и): {app['spouse_name']}",
-        f"11. Место рождения супруга(и): {app['spouse_birth_place']}",
-        f"12. Место работы: {app['work_place']}",
-        f"13. Адрес места работы: {app['work_address']}",
-        f"14. Аэропорт/порт прибытия: {app['airport']}",
-        f"15. Срок визы: {app['visa_term']}",
-        f"16. Дата прибытия: {app['arrival_date']}",
-        f"17. ФИО контактного лица в России: {app['contact_name']}",
-        f"18. Телефон контактного лица: {app['contact_phone']}",
-        f"19. Адрес контактного лица: {app['contact_address']}",
-        f"20. Отель забронирован: {app['hotel_booked']}",
-        f"    Детали отеля: {app['hotel_details']}",
-        f"21. 5-летние визы в Индию и срок действия: {app['five_year_visa']}",
-        f"22. Отказы по визе в Индию: {app['visa_refusal']}",
-        f"    Детали отказов: {app['visa_refusal_details']}",
-        f"23. Поездки в Индию за последние 5 лет: {app['trips_last_5y']}",
-        f"24. Номер последней визы, дата выдачи, адрес проживания: {app['last_visa_details']}",
-        f"25. Сейчас вы за пределами Индии: {app['outside_india']}",
-        f"26. Exit permit / превышения сроков пребывания: {app['overstay']}",
-    ]
-    return "\n".join(lines)
-
-
-def format_preview_from_data(user: types.User, data: dict) -> str:
-    uname = f"@{user.username}" if user.username else "без username"
-    lines = [
-        f"Ваш username: {uname}",
-        f"ФИО: {data.get('full_name', '')}",
-        "",
-        f"1. Место рождения: {data.get('place_birth', '')}",
-        f"2. Электронная почта: {data.get('email', '')}",
-        f"3. Номер национального паспорта: {data.get('passport_number', '')}",
-        f"4. Домашний адрес: {data.get('home_address', '')}",
-        f"5. Номер телефона: {data.get('phone', '')}",
-        f"6. ФИО отца: {data.get('father_name', '')}",
-        f"7. Место рождения отца: {data.get('father_birth_place', '')}",
-        f"8. ФИО матери: {data.get('mother_name', '')}",
-        f"   Место рождения матери: {data.get('mother_birth_place', '')}",
-        f"9. Семейное положение: {data.get('marital_status', '')}",
-        f"10. ФИО супруга(и): {data.get('spouse_name', '')}",
-        f"11. Место рождения супруга(и): {data.get('spouse_birth_place', '')}",
-        f"12. Место работы: {data.get('work_place', '')}",
-        f"13. Адрес места работы: {data.get('work_address', '')}",
-        f"14. Аэропорт/порт прибытия: {data.get('airport', '')}",
-        f"15. Срок визы: {data.get('visa_term', '')}",
-        f"16. Дата прибытия: {data.get('arrival_date', '')}",
-        f"17. ФИО контактного лица в России: {data.get('contact_name', '')}",
-        f"18. Телефон контактного лица: {data.get('contact_phone', '')}",
-        f"19. Адрес контактного лица: {data.get('contact_address', '')}",
-        f"20. Отель забронирован: {data.get('hotel_booked', '')}",
-        f"    Детали отеля: {data.get('hotel_details', '')}",
-        f"21. 5-летние визы в Индию и срок действия: {data.get('five_year_visa', '')}",
-        f"22. Отказы по визе в Индию: {data.get('visa_refusal', '')}",
-        f"    Детали отказов: {data.get('visa_refusal_details', '')}",
-        f"23. Поездки в Индию за последние 5 лет: {data.get('trips_last_5y', '')}",
-        f"24. Номер последней визы, дата выдачи, адрес проживания: {data.get('last_visa_details', '')}",
-        f"25. Сейчас вы за пределами Индии: {data.get('outside_india', '')}",
-        f"26. Exit permit / превышения сроков пребывания: {data.get('overstay', '')}",
-    ]
-    return "\n".join(lines)
-
-
-async def show_preview(message: types.Message, state: FSMContext):
-    data = await state.get_data()
-    text = format_preview_from_data(message.from_user, data)
-    await message.answer(
-        "Проверьте, пожалуйста, вашу анкету:\n\n"
-        + text
-        + "\n\nЕсли всё верно, нажмите «Отправить».\n"
-          "Если нужно что-то поменять — «Редактировать анкету».",
-        reply_markup=confirm_kb(),
-    )
+        kb.insert(InlineKeyboardButton(title, callback_data=CB_EDIT.pack(field)))
+    return kb.as_json()
+
+
+STATIC_KEYBOARDS = (airport_kb, visa_term_kb, admin_panel_kb, confirm_kb, edit_menu_kb)
+for _builder in STATIC_KEYBOARDS:
+    _builder()
+
+
+# ===================== АНКЕТА =====================
+
+class Question:
+    # Описание одного вопроса анкеты.
+    #   field     — ключ ответа в данных FSM (и колонка в applications)
+    #   state     — состояние Form, в котором ждём ответ
+    #   prompt    — текст вопроса, keyboard — функция, строящая клавиатуру
+    #   callback  — CallbackCodec кнопок ответа (None — ответ текстом)
+    #   options   — код кнопки -> сохраняемое значение (None — сам код)
+    #   notice    — всплывающий ответ на нажатие кнопки ({value} — выбор)
+    #   validate  — функция(ответ) -> текст ошибки или None
+    #   save      — функция(ответ) -> dict для данных FSM
+    #   next      — следующий вопрос (None — сразу к предпросмотру)
+    #   branches  — ответ -> вопрос, куда переходим даже при редактировании
+    #   label     — подпись поля в тексте анкеты (None — поле не выводится)
+
+    def __init__(self, field: str, state: State, prompt: str, keyboard=None,
+                 callback: CallbackCodec = None, options: dict = None, notice: str = None,
+                 validate=None, save=None, next: str = None, branches: dict = None,
+                 label: str = None):
+        self.field = field
+        self.state = state
+        self.prompt = prompt
+        self.keyboard = keyboard
+        self.callback = callback
+        self.options = options
+        self.notice = notice
+        self.validate = validate
+        self.save = save or (lambda value: {field: value})
+        self.next = next
+        self.branches = branches or {}
+        self.label = label
+
+
+YES_NO = {"yes": "Да", "no": "Нет"}
+
+
+def validate_email(value: str):
+    if "@" not in value or " " in value:
+        return "Похоже, это не адрес электронной почты. Введите email ещё раз:"
+    return None
+
+
+def validate_arrival_date(value: str):
+    try:
+        arrival = date.fromisoformat(value)
+    except ValueError:
+        return "Некорректная дата, выберите её на календаре."
+    if arrival < date.today():
+        return "Эта дата уже прошла, выберите другую."
+    return None
 
 
-async def notify_admins_about_application(app_id: int):
-    app = get_application(app_id)
-    if not app:
-        return
-    text = format_application_text(app)
-    admins = get_admins()
-    for adm in admins:
-        try:
-            await bot.send_message(
-                adm["user_id"],
-                text,
-                reply_markup=admin_application_kb(app_id),
-            )
-        except Exception as e:
-            logging.warning(f"Не удалось отправить заявку админу {adm['user_id']}: {e}")
+def save_five_year_visa_details(value: str) -> dict:
+    base = "Да"
+    if value:
+        base += f", детали: {value}"
+    return {"five_year_visa": base}
+
+
+_QUESTIONS = [
+    Question("full_name", Form.full_name, "Ваше ФИО (Фамилия Имя Отчество):", label="ФИО"),
+    Question(
+        "place_birth", Form.place_birth, "1. Место вашего рождения (город/село/область):",
+        label="1. Место рождения",
+    ),
+    Question(
+        "email", Form.email, "2. Ваша электронная почта:", validate=validate_email,
+        label="2. Электронная почта",
+    ),
+    Question(
+        "passport_number", Form.passport_number, "3. Номер национального паспорта:",
+        label="3. Номер национального паспорта",
+    ),
+    Question(
+        "home_address", Form.home_address,
+        "4. Домашний адрес (Город, улица, номер дома, квартира, индекс):",
+        label="4. Домашний адрес",
+    ),
+    Question("phone", Form.phone, "5. Ваш номер телефона:", label="5. Номер телефона"),
+    Question(
+        "father_name", Form.father_name, "6. Фамилия, имя отца (даже если нет в живых):",
+        label="6. ФИО отца",
+    ),
+    Question(
+        "father_birth_place", Form.father_birth_place, "7. Место рождения отца:",
+        label="7. Место рождения отца",
+    ),
+    Question(
+        "mother_name", Form.mother_name, "8. Фамилия, имя матери (даже если нет в живых):",
+        label="8. ФИО матери",
+    ),
+    Question(
+        "mother_birth_place", Form.mother_birth_place, "8. Место рождения матери:",
+        label="   Место рождения матери",
+    ),
+    Question(
+        "marital_status", Form.marital_status, "9. Ваше семейное положение:",
+        label="9. Семейное положение",
+    ),
+    Question(
+        "spouse_name", Form.spouse_name,
+        "10. Если вы в браке, укажите фамилию и имя вашего супруга(и). "
+        "Если не в браке, напишите «нет»:",
+        label="10. ФИО супруга(и)",
+    ),
+    Question(
+        "spouse_birth_place", Form.spouse_birth_place,
+        "11. Место рождения вашего супруга(и). "
+        "Если не в браке, напишите «нет»:",
+        label="11. Место рождения супруга(и)",
+    ),
+    Question(
+        "work_place", Form.work_place,
+        "12. Название вашего места работы "
+        "(если не работаете, напишите «безработный(ая)»):",
+        label="12. Место работы",
+    ),
+    Question(
+        "work_address", Form.work_address,
+        "13. Адрес вашего места работы "
+        "(если не работаете, напишите «безработный(ая)»):",
+        label="13. Адрес места работы",
+    ),
+    Question(
+        "airport", Form.airport,
+        "14. Аэропорт или порт планируемого прибытия в Индию:",
+        keyboard=airport_kb, callback=CB_AIRPORT,
+        options={"Dabolim": "Даболим", "Mopa": "Мора"}, notice="Вы выбрали: {value}",
+        label="14. Аэропорт/порт прибытия",
+    ),
+    Question(
+        "visa_term", Form.visa_term, "15. На какой срок нужна виза:",
+        keyboard=visa_term_kb, callback=CB_VISA_TERM,
+        options={"30d": "30 дней", "1y": "1 год", "5y": "5 лет"}, notice="Вы выбрали: {value}",
+        label="15. Срок визы",
+    ),
+    Question(
+        "arrival_date", Form.arrival_date,
+        "16. Дата планируемого прибытия в Индию (выберите дату на календаре):",
+        keyboard=create_calendar, callback=CB_DATE, notice="Дата выбрана: {value}",
+        validate=validate_arrival_date,
+        label="16. Дата прибытия",
+    ),
+    Question(
+        "contact_name", Form.contact_name, "17. Фамилия и имя контактного лица в России:",
+        label="17. ФИО контактного лица в России",
+    ),
+    Question(
+        "contact_phone", Form.contact_phone, "18. Телефон контактного лица в России:",
+        label="18. Телефон контактного лица",
+    ),
+    Question(
+        "contact_address", Form.contact_address, "19. Адрес контактного лица в России:",
+        label="19. Адрес контактного лица",
+    ),
+    Question(
+        "hotel_booked", Form.hotel_booked,
+        "20. Если забронирован отель, выберите «Да». Если нет — «Нет»:",
+        keyboard=lambda: yes_no_kb(CB_HOTEL), callback=CB_HOTEL, options=YES_NO,
+        notice="{value}", branches={"Да": "hotel_details"},
+        label="20. Отель забронирован",
+    ),
+    Question(
+        "hotel_details", Form.hotel_details, "Укажите название отеля и его адрес:",
+        next="five_year_visa",
+        label="    Детали отеля",
+    ),
+    Question(
+        "five_year_visa", Form.five_year_visa, "21. Были ли у вас 5-летние визы в Индию?",
+        keyboard=lambda: yes_no_kb(CB_FIVE_YEAR_VISA), callback=CB_FIVE_YEAR_VISA, options=YES_NO,
+        branches={"Да": "five_year_visa_details"},
+        label="21. 5-летние визы в Индию и срок действия",
+    ),
+    Question(
+        "five_year_visa_details", Form.five_year_visa_details,
+        "Укажите срок, до которого действовала 5-летняя виза, "
+        "и любую дополнительную информацию:",
+        save=save_five_year_visa_details, next="visa_refusal",
+    ),
+    Question(
+        "visa_refusal", Form.visa_refusal, "22. Были ли у вас отказы по визе в Индию:",
+        keyboard=lambda: yes_no_kb(CB_VISA_REFUSAL), callback=CB_VISA_REFUSAL, options=YES_NO,
+        notice="{value}", branches={"Да": "visa_refusal_details"},
+        label="22. Отказы по визе в Индию",
+    ),
+    Question(
+        "visa_refusal_details", Form.visa_refusal_details,
+        "Опишите, по какой причине были отказы по визе в Индию:",
+        next="trips_last_5y",
+        label="    Детали отказов",
+    ),
+    Question(
+        "trips_last_5y", Form.trips_last_5y,
+        "23. Если были поездки в Индию за последние 5 лет, "
+        "укажите даты и цель поездок:",
+        label="23. Поездки в Индию за последние 5 лет",
+    ),
+    Question(
+        "last_visa_details", Form.last_visa_details,
+        "24. Номер последней визы, дата выдачи последней визы, "
+        "адрес проживания по последней поездке:",
+        label="24. Номер последней визы, дата выдачи, адрес проживания",
+    ),
+    Question(
+        "outside_india", Form.outside_india,
+        "25. В момент оформления вы находитесь за пределами Индии?",
+        keyboard=lambda: yes_no_kb(CB_OUTSIDE_INDIA), callback=CB_OUTSIDE_INDIA, options=YES_NO,
+        notice="{value}",
+        label="25. Сейчас вы за пределами Индии",
+    ),
+    Question(
+        "overstay", Form.overstay,
+        "26. Были у вас exit permit или превышения пребывания в Индии "
+        "90 дней за 1 въезд или 180 дней в году?",
+        keyboard=lambda: yes_no_kb(CB_OVERSTAY), callback=CB_OVERSTAY, options=YES_NO,
+        notice="{value}",
+        label="26. Exit permit / превышения сроков пребывания",
+    ),
+]
 
+QUESTIONS = {q.field: q for q in _QUESTIONS}
 
-# ===================== ХЕНДЛЕРЫ ПОЛЬЗОВАТЕЛЯ =====================
+# Основной порядок вопросов совпадает с меню редактирования EDIT_FIELDS:
+# у вопроса без явного next следующим становится следующий пункт меню
+for (_field, _), (_next_field, _) in zip(EDIT_FIELDS, EDIT_FIELDS[1:]):
+    if QUESTIONS[_field].next is None:
+        QUESTIONS[_field].next = _next_field
 
-@dp.message_handler(commands=["start"])
-async def cmd_start(message: types.Message, state: FSMContext):
-    if message.from_user.id == SUPER_ADMIN_ID:
-        upsert_admin(
-            message.from_user.id,
-            message.from_user.username or "",
-            is_super=True,
-        )
+QUESTIONS_BY_STATE = {q.state.state: q for q in _QUESTIONS}
+TEXT_STATES = [q.state for q in _QUESTIONS if q.callback is None]
 
-    kb = admin_main_kb if is_admin(message.from_user.id) else user_main_kb
 
-    await state.finish()
-    await message.answer(
-        "Здравствуйте!\n\n"
-        "Этот бот собирает анкету для оформления визы в Индию.\n"
-        "Нажмите кнопку «Заполнить анкету», чтобы начать.",
-        reply_markup=kb,
-    )
+# ===================== ОТПРАВКА СООБЩЕНИЙ =====================
 
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
 
-@dp.message_handler(lambda m: m.text == "Заполнить анкету")
-async def start_form(message: types.Message, state: FSMContext):
-    await state.finish()
-    await Form.full_name.set()
-    await message.answer("Ваше ФИО (Фамилия Имя Отчество):")
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
 
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
 
-# ---------- ВОПРОСЫ ----------
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
 
-@dp.message_handler(state=Form.full_name)
-async def form_full_name(message: types.Message, state: FSMContext):
-    await state.update_data(full_name=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.place_birth.set()
-        await message.answer("1. Место вашего рождения (город/село/область):")
 
+class RateLimiter:
+    # Общий лимит бота плюс отдельный лимит на каждый чат. Сначала ждём
+    # токен своего чата, потом общий: медленный чат не держит общий лимит.
+    # Полные (простаивающие) корзины чатов периодически удаляются.
 
-@dp.message_handler(state=Form.place_birth)
-async def form_place_birth(message: types.Message, state: FSMContext):
-    await state.update_data(place_birth=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.email.set()
-        await message.answer("2. Ваша электронная почта:")
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets = {}
 
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= 10000:
+                self.chat_buckets = {
+                    key: value for key, value in self.chat_buckets.items()
+                    if not value.is_full()
+                }
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
 
-@dp.message_handler(state=Form.email)
-async def form_email(message: types.Message, state: FSMContext):
-    await state.update_data(email=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.passport_number.set()
-        await message.answer("3. Номер национального паспорта:")
-
-
-@dp.message_handler(state=Form.passport_number)
-async def form_passport_number(message: types.Message, state: FSMContext):
-    await state.update_data(passport_number=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.home_address.set()
-        await message.answer(
-            "4. Домашний адрес (Город, улица, номер дома, квартира, индекс):"
-        )
+    async def acquire(self, chat_id: int):
+        await self._chat_bucket(chat_id).acquire()
+        await self.global_bucket.acquire()
 
 
-@dp.message_handler(state=Form.home_address)
-async def form_home_address(message: types.Message, state: FSMContext):
-    await state.update_data(home_address=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.phone.set()
-        await message.answer("5. Ваш номер телефона:")
+limiter = RateLimiter(TG_GLOBAL_RATE, TG_CHAT_RATE, TG_CHAT_BURST)
 
+# Ошибки, после которых повторять отправку бессмысленно
+# (бот заблокирован, чат не найден, неверный запрос)
+PERMANENT_SEND_ERRORS = (BadRequest, Unauthorized, NotFound)
 
-@dp.message_handler(state=Form.phone)
-async def form_phone(message: types.Message, state: FSMContext):
-    await state.update_data(phone=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.father_name.set()
-        await message.answer("6. Фамилия, имя отца (даже если нет в живых):")
 
+async def send_message_limited(chat_id: int, text: str, **kwargs):
+    # Одна попытка с учётом лимитов; повторы ведёт outbox через next_try_ts
+    await limiter.acquire(chat_id)
+    return await bot.send_message(chat_id, text, **kwargs)
 
-@dp.message_handler(state=Form.father_name)
-async def form_father_name(message: types.Message, state: FSMContext):
-    await state.update_data(father_name=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.father_birth_place.set()
-        await message.answer("7. Место рождения отца:")
-
-
-@dp.message_handler(state=Form.father_birth_place)
-async def form_father_birth_place(message: types.Message, state: FSMContext):
-    await state.update_data(father_birth_place=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.mother_name.set()
-        await message.answer("8. Фамилия, имя матери (даже если нет в живых):")
-
-
-@dp.message_handler(state=Form.mother_name)
-async def form_mother_name(message: types.Message, state: FSMContext):
-    await state.update_data(mother_name=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.mother_birth_place.set()
-        await message.answer("8. Место рождения матери:")
-
-
-@dp.message_handler(state=Form.mother_birth_place)
-async def form_mother_birth_place(message: types.Message, state: FSMContext):
-    await state.update_data(mother_birth_place=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.marital_status.set()
-        await message.answer("9. Ваше семейное положение:")
-
-
-@dp.message_handler(state=Form.marital_status)
-async def form_marital_status(message: types.Message, state: FSMContext):
-    await state.update_data(marital_status=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.spouse_name.set()
-        await message.answer(
-            "10. Если вы в браке, укажите фамилию и имя вашего супруга(и). "
-            "Если не в браке, напишите «нет»:"
-        )
-
-
-@dp.message_handler(state=Form.spouse_name)
-async def form_spouse_name(message: types.Message, state: FSMContext):
-    await state.update_data(spouse_name=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.spouse_birth_place.set()
-        await message.answer(
-            "11. Место рождения вашего супруга(и). "
-            "Если не в браке, напишите «нет»:"
-        )
-
-
-@dp.message_handler(state=Form.spouse_birth_place)
-async def form_spouse_birth_place(message: types.Message, state: FSMContext):
-    await state.update_data(spouse_birth_place=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.work_place.set()
-        await message.answer(
-            "12. Название вашего места работы "
-            "(если не работаете, напишите «безработный(ая)»):"
-        )
 
+async def wait_event(event: asyncio.Event, timeout: float) -> bool:
+    # Вместо asyncio.wait_for(event.wait(), timeout): в Python 3.11 wait_for
+    # теряет отмену, если событие наступило в ту же итерацию цикла, и stop()
+    # фоновой задачи ждал бы её вечно (исправлено в 3.12)
+    waiter = asyncio.ensure_future(event.wait())
+    try:
+        done, _ = await asyncio.wait({waiter}, timeout=timeout)
+    finally:
+        waiter.cancel()
+    return bool(done)
+
+
+class Outbox:
+    # Уведомления пользователям и админам не отправляются из хендлеров
+    # напрямую: хендлер только кладёт сообщение в таблицу outbox, а фоновый
+    # воркер пачками доставляет их с учётом лимитов, повторяет временные
+    # ошибки и продолжает с того же места после перезапуска.
+
+    def __init__(self, batch: int = OUTBOX_BATCH, max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 poll_interval: float = OUTBOX_POLL_INTERVAL):
+        self.batch = batch
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.stats = {
+            "depth": 0,
+            "enqueued": 0,
+            "sent": 0,
+            "retried": 0,
+            "failed": 0,
+            "latency_sum": 0.0,
+            "latency_max": 0.0,
+        }
+        self._wakeup = None
+        self._task = None
+
+    async def enqueue(self, chat_id: int, text: str, reply_markup=None):
+        await self.enqueue_many([(chat_id, text, reply_markup)])
+
+    async def enqueue_many(self, messages: list):
+        rows = [
+            (chat_id, text, markup_json(markup))
+            for chat_id, text, markup in messages
+        ]
+        await run_db(enqueue_messages, rows)
+        self.stats["enqueued"] += len(rows)
+        self.stats["depth"] += len(rows)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        self.stats["depth"] = await run_db(count_pending_messages)
+        while True:
+            try:
+                rows = await run_db(claim_due_messages, time.time(), self.batch, 300)
+                if rows:
+                    await self._deliver_batch(rows)
+                    self.stats["depth"] = await run_db(count_pending_messages)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception("Ошибка воркера очереди сообщений")
+            self._wakeup.clear()
+            await wait_event(self._wakeup, self.poll_interval)
+
+    async def _deliver_batch(self, rows):
+        sent, retries, failed, deferred = [], [], [], []
+
+        # Сообщения одного чата отправляются по порядку, разные чаты —
+        # параллельно. После ошибки остаток чата откладывается до того же
+        # времени, что и повтор неотправленного сообщения.
+        by_chat = OrderedDict()
+        for row in rows:
+            by_chat.setdefault(row["chat_id"], []).append(row)
+
+        def defer_rest(chat_rows, index, next_try_ts):
+            deferred.extend((next_try_ts, row["id"]) for row in chat_rows[index + 1:])
+
+        async def deliver_chat(chat_rows):
+            for index, row in enumerate(chat_rows):
+                try:
+                    await send_message_limited(
+                        row["chat_id"], row["text"], reply_markup=row["reply_markup"]
+                    )
+                except RetryAfter as e:
+                    retries.append((time.time() + e.timeout, str(e), row["id"]))
+                    defer_rest(chat_rows, index, retries[-1][0])
+                    return
+                except PERMANENT_SEND_ERRORS as e:
+                    logging.warning(f"Сообщение {row['id']} в чат {row['chat_id']} не доставлено: {e}")
+                    failed.append((str(e), row["id"]))
+                except Exception as e:
+                    if row["attempts"] + 1 >= self.max_attempts:
+                        logging.warning(f"Сообщение {row['id']} не доставлено после всех попыток: {e}")
+                        failed.append((str(e), row["id"]))
+                    else:
+                        delay = min(2 ** row["attempts"], 300)
+                        retries.append((time.time() + delay, str(e), row["id"]))
+                        defer_rest(chat_rows, index, retries[-1][0])
+                        return
+                else:
+                    sent.append(row["id"])
+                    latency = time.time() - row["created_ts"]
+                    OUTBOX_DELIVERY_SECONDS.observe(latency)
+                    self.stats["latency_sum"] += latency
+                    self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+
+        await asyncio.gather(*(deliver_chat(chat_rows) for chat_rows in by_chat.values()))
+        await run_db(finish_outbox_batch, sent, retries, failed, deferred)
+        self.stats["sent"] += len(sent)
+        self.stats["retried"] += len(retries)
+        self.stats["failed"] += len(failed)
+
+
+outbox = Outbox()
+
+
+# ===================== АНАЛИТИКА =====================
+
+class FunnelRecorder:
+    # События анкеты (начало, ответ на шаг, правка, отправка) не пишутся в
+    # базу из хендлера: record только добавляет их в буфер, а фоновая задача
+    # сбрасывает буфер одной транзакцией вместе с обновлением агрегатов.
+    # Незаписанный хвост буфера теряется только при аварийной остановке.
+
+    def __init__(self, flush_interval: float = FUNNEL_FLUSH_INTERVAL, batch: int = FUNNEL_BATCH):
+        self.flush_interval = flush_interval
+        self.batch = batch
+        self._buffer = []
+        self._full = None
+        self._task = None
+
+    def record(self, user_id: int, step: str, event: str, elapsed: float = None):
+        self._buffer.append((time.time(), user_id, step, event, elapsed))
+        if len(self._buffer) >= self.batch and self._full is not None:
+            self._full.set()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        events, self._buffer = self._buffer, []
+        try:
+            await run_db(save_funnel_events, events)
+        except Exception:
+            logging.exception(f"Не удалось записать {len(events)} событий воронки")
+
+    def start(self):
+        self._full = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await wait_event(self._full, self.flush_interval)
+            self._full.clear()
+            await self.flush()
+
+
+funnel = FunnelRecorder()
+
+
+# ===================== ЭКСПОРТ =====================
+
+# Выгрузка идёт в потоке-читателе БД: строки берутся из курсора через
+# fetchmany и сразу пишутся в файл, поэтому память не зависит от размера
+# таблицы. Результат — SpooledTemporaryFile, открытый на начале.
+
+EXPORT_FORMATS = ("csv", "jsonl", "xlsx")
+
+
+def _export_rows(cur: sqlite3.Cursor):
+    while True:
+        rows = cur.fetchmany(EXPORT_CHUNK)
+        if not rows:
+            return
+        yield from rows
+
+
+def _write_csv(out, columns, rows):
+    # utf-8-sig: Excel открывает такой CSV с кириллицей без перекодировки
+    text = io.TextIOWrapper(out, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+    text.flush()
+    text.detach()
+
+
+def _write_jsonl(out, columns, rows):
+    text = io.TextIOWrapper(out, encoding="utf-8", newline="\n")
+    for row in rows:
+        text.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+        text.write("\n")
+    text.flush()
+    text.detach()
+
+
+def _write_xlsx(out, columns, rows):
+    # write_only: openpyxl не держит лист в памяти, а пишет строки по мере
+    # добавления
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("applications")
+    ws.append(columns)
+    for row in rows:
+        ws.append(list(row))
+    wb.save(out)
+
+
+EXPORT_WRITERS = {"csv": _write_csv, "jsonl": _write_jsonl, "xlsx": _write_xlsx}
+
+
+def export_applications(fmt: str, status: str = None, since_ts: int = None,
+                        until_ts: int = None):
+    # Возвращает (файл, число строк); since_ts включительно, until_ts — нет
+    where = []
+    params = []
+    if status is not None:
+        where.append("status=?")
+        params.append(status)
+    if since_ts is not None:
+        where.append("created_ts >= ?")
+        params.append(since_ts)
+    if until_ts is not None:
+        where.append("created_ts < ?")
+        params.append(until_ts)
+    sql = (
+        "SELECT * FROM applications"
+        + (" WHERE " + " AND ".join(where) if where else "")
+        + " ORDER BY created_ts, id"
+    )
+    cur = get_conn().cursor()
+    # обычные кортежи вместо sqlite3.Row: писателям имена колонок не нужны
+    cur.row_factory = None
+    cur.execute(sql, params)
+    columns = [column[0] for column in cur.description]
+    count = 0
+
+    def rows():
+        nonlocal count
+        for row in _export_rows(cur):
+            count += 1
+            yield row
+
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE, mode="w+b")
+    try:
+        EXPORT_WRITERS[fmt](out, columns, rows())
+    except BaseException:
+        out.close()
+        raise
+    finally:
+        cur.close()
+    out.seek(0)
+    return out, count
+
+
+def parse_export_args(args: str):
+    # /export [csv|jsonl|xlsx] [new|ok|rej|all] [ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]]
+    # Аргументы распознаются по виду, порядок формата и статуса не важен.
+    # Возвращает (формат, статус, since_ts, until_ts) или ValueError.
+    fmt = "csv"
+    status = None
+    days = []
+    for token in args.split():
+        token = token.lower()
+        if token in EXPORT_FORMATS:
+            fmt = token
+        elif token in APP_FILTERS:
+            status = APP_FILTERS[token][1]
+        else:
+            try:
+                days.append(datetime.strptime(token, "%Y-%m-%d"))
+            except ValueError:
+                raise ValueError(f"Непонятный аргумент: {token}")
+    if len(days) > 2:
+        raise ValueError("Укажите не больше двух дат: начало и конец периода.")
+    if fmt == "xlsx" and Workbook is None:
+        raise ValueError("Выгрузка в XLSX недоступна: на сервере не установлен openpyxl.")
+    epoch = datetime(1970, 1, 1)
+    since_ts = int((days[0] - epoch).total_seconds()) if days else None
+    # дата конца периода включается целиком
+    until_ts = int((days[1] + timedelta(days=1) - epoch).total_seconds()) if len(days) > 1 else None
+    return fmt, status, since_ts, until_ts
 
-@dp.message_handler(state=Form.work_place)
-async def form_work_place(message: types.Message, state: FSMContext):
-    await state.update_data(work_place=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.work_address.set()
-        await message.answer(
-            "13. Адрес вашего места работы "
-            "(если не работаете, напишите «безработный(ая)»):"
-        )
 
+# ===================== ВСПОМОГАТЕЛЬНОЕ =====================
 
-@dp.message_handler(state=Form.work_address)
-async def form_work_address(message: types.Message, state: FSMContext):
-    await state.update_data(work_address=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.airport.set()
-        await message.answer(
-            "14. Аэропорт или порт планируемого прибытия в Индию:",
-            reply_markup=airport_kb(),
-        )
+# Текст анкеты собирается по одному шаблону из подписей реестра вопросов
+# и для строки applications, и для данных FSM (предпросмотр). Шаблон
+# компилируется в строку формата один раз при запуске.
+RENDER_FIELDS = [q.field for q in _QUESTIONS if q.label]
+# После ФИО, как и раньше, идёт пустая строка
+ANSWERS_TEMPLATE = "\n".join(
+    q.label.replace("{", "{{").replace("}", "}}")
+    + ": {}"
+    + ("\n" if q.field == "full_name" else "")
+    for q in _QUESTIONS if q.label
+)
 
+_render_cache = OrderedDict()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("airport:"), state=Form.airport)
-async def form_airport(callback_query: CallbackQuery, state: FSMContext):
-    code = callback_query.data.split(":", 1)[1]
-    value = "Даболим" if code == "Dabolim" else "Мора"
-    await state.update_data(airport=value)
-    data = await state.get_data()
-    await callback_query.answer(f"Вы выбрали: {value}")
 
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(callback_query.message, state)
+def render_answers(source) -> str:
+    # source — sqlite3.Row заявки или dict данных FSM
+    if isinstance(source, dict):
+        values = [source.get(field, "") for field in RENDER_FIELDS]
     else:
-        await Form.visa_term.set()
-        await callback_query.message.answer(
-            "15. На какой срок нужна виза:", reply_markup=visa_term_kb()
-        )
+        values = [source[field] for field in RENDER_FIELDS]
+    return ANSWERS_TEMPLATE.format(*("" if value is None else value for value in values))
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("visaterm:"), state=Form.visa_term)
-async def form_visa_term(callback_query: CallbackQuery, state: FSMContext):
-    code = callback_query.data.split(":", 1)[1]
-    mapping = {"30d": "30 дней", "1y": "1 год", "5y": "5 лет"}
-    value = mapping.get(code, "")
-    await state.update_data(visa_term=value)
-    data = await state.get_data()
-    await callback_query.answer(f"Вы выбрали: {value}")
+def split_message(text: str, limit: int = TG_MESSAGE_LIMIT) -> list:
+    # Делит текст на части не длиннее limit, по возможности по переводам строк
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
 
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(callback_query.message, state)
-    else:
-        await Form.arrival_date.set()
-        await callback_query.message.answer(
-            "16. Дата планируемого прибытия в Индию (выберите дату на календаре):",
-            reply_markup=create_calendar(),
+
+def format_application_text(app: sqlite3.Row) -> str:
+    uname = f"@{app['username']}" if app["username"] else "без username"
+    status = app["status"] or "в ожидании"
+    duplicate = (
+        f"Повторная подача анкеты №{app['duplicate_of']}\n" if app["duplicate_of"] else ""
+    )
+    if app["similar_to"]:
+        duplicate += (
+            f"Возможный дубль: паспорт совпадает с анкетой №{app['similar_to']} "
+            "другого пользователя\n"
         )
+    return (
+        f"Заявка №{app['id']} (статус: {status})\n"
+        f"Создана: {app['created_at']}\n"
+        + duplicate
+        + "\n"
+        f"Пользователь: {uname} (ID {app['user_id']})\n"
+        + render_answers(app)
+    )
 
 
-@dp.callback_query_handler(lambda c: c.data == "ignore", state=Form.arrival_date)
-async def ignore_calendar(callback_query: CallbackQuery, state: FSMContext):
-    await callback_query.answer()
+def application_text_parts(app: sqlite3.Row) -> list:
+    # Текст заявки, уже разбитый на сообщения; кэш по (id, version)
+    key = (app["id"], app["version"])
+    parts = _render_cache.get(key)
+    if parts is None:
+        parts = split_message(format_application_text(app))
+        _render_cache[key] = parts
+        if len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+    else:
+        _render_cache.move_to_end(key)
+    return parts
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("cal:"), state=Form.arrival_date)
-async def form_arrival_date(callback_query: CallbackQuery, state: FSMContext):
-    date_str = callback_query.data.split(":", 1)[1]
-    await state.update_data(arrival_date=date_str)
-    data = await state.get_data()
-    await callback_query.answer(f"Дата выбрана: {date_str}")
+def format_preview_from_data(user: types.User, data: dict) -> str:
+    uname = f"@{user.username}" if user.username else "без username"
+    return f"Ваш username: {uname}\n" + render_answers(data)
 
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(callback_query.message, state)
-    else:
-        await Form.contact_name.set()
-        await callback_query.message.answer("17. Фамилия и имя контактного лица в России:")
 
+async def answer_parts(message: types.Message, parts: list, reply_markup=None):
+    # Длинный текст уходит несколькими сообщениями, клавиатура — у последнего
+    for part in parts[:-1]:
+        await message.answer(part)
+    await message.answer(parts[-1], reply_markup=reply_markup)
 
-@dp.message_handler(state=Form.contact_name)
-async def form_contact_name(message: types.Message, state: FSMContext):
-    await state.update_data(contact_name=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.contact_phone.set()
-        await message.answer("18. Телефон контактного лица в России:")
 
+async def show_preview(message: types.Message, user: types.User, data: dict):
+    text = format_preview_from_data(user, data)
+    await answer_parts(
+        message,
+        split_message(
+            "Проверьте, пожалуйста, вашу анкету:\n\n"
+            + text
+            + "\n\nЕсли всё верно, нажмите «Отправить».\n"
+              "Если нужно что-то поменять — «Редактировать анкету»."
+        ),
+        reply_markup=confirm_kb(),
+    )
 
-@dp.message_handler(state=Form.contact_phone)
-async def form_contact_phone(message: types.Message, state: FSMContext):
-    await state.update_data(contact_phone=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.contact_address.set()
-        await message.answer("19. Адрес контактного лица в России:")
 
+async def notify_admins_about_application(app_id: int):
+    app = await run_db(get_application, app_id)
+    if not app:
+        return
+    parts = application_text_parts(app)
+    kb = admin_application_kb(app_id)
+    # Рассылку всем админам параллельно и с учётом лимитов делает outbox;
+    # части одной заявки уходят в чат админа по порядку
+    await outbox.enqueue_many([
+        (admin_id, part, kb if number == len(parts) else None)
+        for admin_id in admin_roles()
+        for number, part in enumerate(parts, start=1)
+    ])
+
+
+# ===================== MIDDLEWARE =====================
+
+class RoleMiddleware(BaseMiddleware):
+    # Определяет роль пользователя один раз на апдейт и передаёт её
+    # хендлерам аргументом role (ROLE_USER / ROLE_ADMIN / ROLE_SUPERADMIN)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        data["role"] = get_role(message.from_user.id)
+
+    async def on_pre_process_callback_query(self, callback_query: CallbackQuery, data: dict):
+        data["role"] = get_role(callback_query.from_user.id)
+
+
+class TracingMiddleware(BaseMiddleware):
+    # Собирает дерево span'ов апдейта и сохраняет его, если апдейт
+    # обрабатывался дольше TRACE_SLOW_MS. Ставится только при TRACE_ENABLED.
+
+    _profiling = False
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        root = Span("update")
+        data["trace_root"] = root
+        data["trace_token"] = _current_span.set(root)
+        # cProfile не умеет профилировать вложенно, поэтому один апдейт за раз;
+        # в профиль попадают и корутины других апдейтов, идущие параллельно
+        if TRACE_PROFILE_RATE and not TracingMiddleware._profiling \
+                and random.random() < TRACE_PROFILE_RATE:
+            TracingMiddleware._profiling = True
+            profile = cProfile.Profile()
+            profile.enable()
+            data["trace_profile"] = profile
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        root = data["trace_root"]
+        root.finish()
+        _current_span.reset(data["trace_token"])
+        profile = data.get("trace_profile")
+        if profile is not None:
+            profile.disable()
+            TracingMiddleware._profiling = False
+        if root.duration * 1000 < TRACE_SLOW_MS:
+            return
+        record = {
+            "ts": round(time.time(), 3),
+            "update_id": update.update_id,
+            "type": MetricsMiddleware.update_type(update),
+            "duration_ms": round(root.duration * 1000, 3),
+            "spans": root.to_dict(root.started),
+        }
+        if profile is not None:
+            record["profile"] = profile_summary(profile)
+        dump_slow_trace(record)
+
+    @staticmethod
+    def _handler_started(data: dict):
+        span = Span("handler")
+        _current_span.get().children.append(span)
+        data["trace_handler"] = span
+        data["trace_handler_token"] = _current_span.set(span)
+
+    @staticmethod
+    def _handler_finished(data: dict):
+        span = data.get("trace_handler")
+        if span is not None:
+            span.finish()
+            span.name = f"handler:{handler_label.get()}"
+            _current_span.reset(data["trace_handler_token"])
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._handler_started(data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._handler_finished(data)
+
+    async def on_process_callback_query(self, callback_query: CallbackQuery, data: dict):
+        self._handler_started(data)
+
+    async def on_post_process_callback_query(self, callback_query: CallbackQuery, results,
+                                             data: dict):
+        self._handler_finished(data)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    # Число апдейтов и время их обработки целиком (с фильтрами и
+    # middleware), а также время работы самого хендлера по имени
+
+    @staticmethod
+    def update_type(update: types.Update) -> str:
+        if update.message:
+            return "message"
+        if update.callback_query:
+            return "callback_query"
+        return "other"
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        data["metrics_started"] = time.perf_counter()
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        kind = self.update_type(update)
+        UPDATES_TOTAL.inc(kind)
+        UPDATE_SECONDS.observe(time.perf_counter() - data["metrics_started"], kind)
+
+    @staticmethod
+    def _handler_started(data: dict):
+        handler_label.set(current_handler.get().__name__)
+        data["metrics_handler_started"] = time.perf_counter()
+
+    @staticmethod
+    def _handler_finished(data: dict):
+        started = data.get("metrics_handler_started")
+        if started is not None:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler_label.get())
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._handler_started(data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._handler_finished(data)
+
+    async def on_process_callback_query(self, callback_query: CallbackQuery, data: dict):
+        self._handler_started(data)
+
+    async def on_post_process_callback_query(self, callback_query: CallbackQuery, results,
+                                             data: dict):
+        self._handler_finished(data)
+
+
+# ---------- ЗАПИСЬ АПДЕЙТОВ ----------
+
+# Тексты, которые записываются как есть: по ним выбирается хендлер
+RECORD_KEEP_TEXTS = {"Заполнить анкету", "Админ-панель"}
+# Части callback_data, которые заменяются цифрами той же длины: номера
+# анкет и курсоры списков. Остальные части (варианты ответов, поля,
+# фильтры) — общий словарь кнопок бота и записываются как есть
+RECORD_SCRUB_FIELDS = {"app_id", "ts"}
+
+
+def _pseudo_chars(run: str, salt: bytes, alphabet: str) -> str:
+    # Замена той же длины из HMAC: одинаковые значения дают одинаковую
+    # замену, разные — разную (иначе все паспорта при воспроизведении
+    # совпали бы и анкеты считались бы повторными подачами)
+    chars = []
+    counter = 0
+    while len(chars) < len(run):
+        digest = hmac.new(salt, f"{counter}:{run.lower()}".encode(), hashlib.sha256).digest()
+        chars.extend(alphabet[b % len(alphabet)] for b in digest)
+        counter += 1
+    return "".join(chars[:len(run)])
+
+
+def scrub_text(text: str, salt: bytes) -> str:
+    # Слова и числа заменяются псевдослучайными буквами и цифрами той же
+    # длины: «форма» ответа (email, номер) сохраняется, поэтому проверки
+    # анкеты и поиск повторных подач при воспроизведении работают так же
+    if text in RECORD_KEEP_TEXTS:
+        return text
+    if text.startswith("/"):
+        command, sep, args = text.partition(" ")
+        return command + sep + scrub_text(args, salt) if args else command
+    text = re.sub(r"\d+", lambda m: _pseudo_chars(m.group(), salt, "0123456789"), text)
+    return re.sub(
+        r"[^\W\d_]+", lambda m: _pseudo_chars(m.group(), salt, "abcdefghijklmnopqrstuvwxyz"), text
+    )
 
-@dp.message_handler(state=Form.contact_address)
-async def form_contact_address(message: types.Message, state: FSMContext):
-    await state.update_data(contact_address=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.hotel_booked.set()
-        await message.answer(
-            "20. Если забронирован отель, выберите «Да». Если нет — «Нет»:",
-            reply_markup=yes_no_kb("hotel"),
-        )
 
+def scrub_callback_data(data: str, salt: bytes) -> str:
+    # Префикс сохраняется, чтобы replay шёл по тем же маршрутам. Дата
+    # прибытия сдвигается вперёд на постоянное для записи число дней:
+    # она остаётся правильной будущей датой и проходит проверку анкеты
+    route = callbacks.resolve(data)
+    if route is None:
+        return scrub_text(data, salt)
+    codec = route[0]
+    try:
+        cb = codec.unpack(data)
+        if codec is CB_DATE:
+            shift = int.from_bytes(hmac.new(salt, b"date", hashlib.sha256).digest()[:2], "big")
+            arrival = date.fromisoformat(cb.value) + timedelta(days=shift % 90 + 1)
+            return codec.pack(arrival.isoformat())
+    except ValueError:
+        # испорченные данные при воспроизведении дадут ту же «Ошибку данных»
+        return codec.prefix
+    return codec.pack(*(
+        _pseudo_chars(str(value), salt, "0123456789") if name in RECORD_SCRUB_FIELDS else value
+        for name, value in zip(cb._fields, cb)
+    ))
+
+
+class RecordingMiddleware(BaseMiddleware):
+    # Пишет апдейты в JSONL для replay.py. ID пользователей и чатов
+    # заменяются псевдонимами (HMAC со случайной солью процесса), имена
+    # и тексты обезличиваются, из сообщений под кнопками остаётся только
+    # заголовок, в данных кнопок — маршрут и варианты ответов. Запись: {"t": секунды от начала, "r": роль, "u": апдейт}.
+
+    def __init__(self, path: str):
+        super().__init__()
+        # построчная буферизация: при аварийной остановке теряется не больше строки
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+        self._salt = os.urandom(16)
+        self._started = time.monotonic()
+
+    def pseudonym(self, value: int) -> int:
+        digest = hmac.new(self._salt, str(value).encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:5], "big") + 1
+
+    def _user(self, user: types.User) -> dict:
+        return {"id": self.pseudonym(user.id), "is_bot": user.is_bot, "first_name": "User"}
+
+    def _message(self, message: types.Message, keep_text: bool) -> dict:
+        chat_id = self.pseudonym(message.chat.id)
+        return {
+            "message_id": message.message_id,
+            "date": int(message.date.timestamp()) if message.date else 0,
+            "chat": {"id": chat_id, "type": message.chat.type},
+            "text": scrub_text(message.text or "", self._salt) if keep_text else "",
+        }
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        record = {"update_id": update.update_id}
+        if update.message and update.message.from_user:
+            message = self._message(update.message, keep_text=True)
+            message["from"] = self._user(update.message.from_user)
+            record["message"] = message
+            user_id = update.message.from_user.id
+        elif update.callback_query:
+            cq = update.callback_query
+            record["callback_query"] = {
+                "id": cq.id,
+                "from": self._user(cq.from_user),
+                "chat_instance": "",
+                "data": scrub_callback_data(cq.data or "", self._salt),
+            }
+            if cq.message:
+                # текст сообщения бота (например, анкета целиком) не нужен
+                record["callback_query"]["message"] = self._message(cq.message, keep_text=False)
+            user_id = cq.from_user.id
+        else:
+            return
+        line = {
+            "t": round(time.monotonic() - self._started, 3),
+            "r": get_role(user_id),
+            "u": record,
+        }
+        self._file.write(json.dumps(line, ensure_ascii=False, separators=(",", ":")) + "\n")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("hotel:"), state=Form.hotel_booked)
-async def form_hotel(callback_query: CallbackQuery, state: FSMContext):
-    ans = callback_query.data.split(":", 1)[1]
-    value = "Да" if ans == "yes" else "Нет"
-    await state.update_data(hotel_booked=value)
-    data = await state.get_data()
-    await callback_query.answer(value)
+    def close(self):
+        self._file.close()
 
-    if value == "Да":
-        await Form.hotel_details.set()
-        await callback_query.message.answer("Укажите название отеля и его адрес:")
-    else:
-        if data.get("editing"):
-            await Form.confirm.set()
-            await show_preview(callback_query.message, state)
-        else:
-            await Form.five_year_visa.set()
-            await callback_query.message.answer(
-                "21. Были ли у вас 5-летние визы в Индию?",
-                reply_markup=yes_no_kb("fivevisa"),
-            )
 
+recorder = RecordingMiddleware(RECORD_FILE) if RECORD_FILE else None
 
-@dp.message_handler(state=Form.hotel_details)
-async def form_hotel_details(message: types.Message, state: FSMContext):
-    await state.update_data(hotel_details=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.five_year_visa.set()
-        await message.answer(
-            "21. Были ли у вас 5-летние визы в Индию?",
-            reply_markup=yes_no_kb("fivevisa"),
-        )
+if recorder is not None:
+    dp.middleware.setup(recorder)
+if TRACE_ENABLED:
+    dp.middleware.setup(TracingMiddleware())
+dp.middleware.setup(MetricsMiddleware())
+dp.middleware.setup(RoleMiddleware())
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("fivevisa:"), state=Form.five_year_visa)
-async def form_five_year_visa_cb(callback_query: CallbackQuery, state: FSMContext):
-    ans = callback_query.data.split(":", 1)[1]
-    await callback_query.answer()
-    data = await state.get_data()
-    editing = data.get("editing")
+@dp.errors_handler()
+async def count_handler_errors(update: types.Update, exception: Exception):
+    # Только считает ошибку: исключение дальше обрабатывается как обычно
+    HANDLER_ERRORS.inc(handler_label.get() or "unknown", type(exception).__name__)
 
-    if ans == "no":
-        await state.update_data(five_year_visa="Нет")
-        if editing:
-            await Form.confirm.set()
-            await show_preview(callback_query.message, state)
-        else:
-            await Form.visa_refusal.set()
-            await callback_query.message.answer(
-                "22. Были ли у вас отказы по визе в Индию:",
-                reply_markup=yes_no_kb("vref"),
-            )
-    else:
-        await state.update_data(five_year_visa="Да")
-        await Form.five_year_visa_details.set()
-        await callback_query.message.answer(
-            "Укажите срок, до которого действовала 5-летняя виза, "
-            "и любую дополнительную информацию:"
-        )
 
+# Единственный хендлер нажатий кнопок: дальше маршрут выбирает callbacks
+# по префиксу callback_data (см. CallbackRouter)
+@dp.callback_query_handler(state="*")
+async def route_callback(callback_query: CallbackQuery, state: FSMContext, role: str):
+    if not await callbacks.dispatch(callback_query, state, role):
+        # кнопка из старого сообщения или не для текущего шага
+        await callback_query.answer()
 
-@dp.message_handler(state=Form.five_year_visa_details)
-async def form_five_year_visa_details(message: types.Message, state: FSMContext):
-    details = message.text.strip()
-    data = await state.get_data()
-    editing = data.get("editing")
 
-    base = "Да"
-    if details:
-        base += f", детали: {details}"
-    await state.update_data(five_year_visa=base)
+# ===================== ХЕНДЛЕРЫ ПОЛЬЗОВАТЕЛЯ =====================
 
-    if editing:
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.visa_refusal.set()
-        await message.answer(
-            "22. Были ли у вас отказы по визе в Индию:",
-            reply_markup=yes_no_kb("vref"),
+@dp.message_handler(commands=["start"])
+async def cmd_start(message: types.Message, state: FSMContext, role: str):
+    if message.from_user.id == SUPER_ADMIN_ID:
+        await run_db(
+            upsert_admin,
+            message.from_user.id,
+            message.from_user.username or "",
+            is_super=True,
         )
+        role = ROLE_SUPERADMIN
 
+    kb = user_main_kb if role == ROLE_USER else admin_main_kb
 
-@dp.callback_query_handler(lambda c: c.data.startswith("vref:"), state=Form.visa_refusal)
-async def form_visa_refusal(callback_query: CallbackQuery, state: FSMContext):
-    ans = callback_query.data.split(":", 1)[1]
-    value = "Да" if ans == "yes" else "Нет"
-    await state.update_data(visa_refusal=value)
-    data = await state.get_data()
-    editing = data.get("editing")
-    await callback_query.answer(value)
+    await state.finish()
+    await message.answer(
+        "Здравствуйте!\n\n"
+        "Этот бот собирает анкету для оформления визы в Индию.\n"
+        "Нажмите кнопку «Заполнить анкету», чтобы начать.",
+        reply_markup=kb,
+    )
 
-    if value == "Да":
-        await Form.visa_refusal_details.set()
-        await callback_query.message.answer(
-            "Опишите, по какой причине были отказы по визе в Индию:"
-        )
-    else:
-        if editing:
-            await Form.confirm.set()
-            await show_preview(callback_query.message, state)
-        else:
-            await Form.trips_last_5y.set()
-            await callback_query.message.answer(
-                "23. Если были поездки в Индию за последние 5 лет, "
-                "укажите даты и цель поездок:"
-            )
+
+@dp.message_handler(lambda m: m.text == "Заполнить анкету")
+async def start_form(message: types.Message, state: FSMContext):
+    await state.finish()
+    # started_ts — начало анкеты, asked_ts — когда задан текущий вопрос,
+    # submission_token — ключ идемпотентной отправки (см. save_application)
+    now = time.time()
+    await state.set_data({
+        "started_ts": now,
+        "asked_ts": now,
+        "submission_token": secrets.token_hex(16),
+    })
+    funnel.record(message.from_user.id, "form", "start")
+    await ask_question(message, QUESTIONS["full_name"])
 
 
-@dp.message_handler(state=Form.visa_refusal_details)
-async def form_visa_refusal_details(message: types.Message, state: FSMContext):
-    await state.update_data(visa_refusal_details=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.trips_last_5y.set()
-        await message.answer(
-            "23. Если были поездки в Индию за последние 5 лет, "
-            "укажите даты и цель поездок:"
-        )
+# ---------- ВОПРОСЫ ----------
 
+# Все вопросы анкеты обслуживают два общих хендлера: для текстовых ответов
+# и для нажатий кнопок. Вопрос находится по текущему состоянию (raw_state)
+# через словарь QUESTIONS_BY_STATE, данные FSM читаются один раз и
+# записываются одним set_data.
 
-@dp.message_handler(state=Form.trips_last_5y)
-async def form_trips_last_5y(message: types.Message, state: FSMContext):
-    await state.update_data(trips_last_5y=message.text.strip())
-    data = await state.get_data()
-    if data.get("editing"):
-        await Form.confirm.set()
-        await show_preview(message, state)
-    else:
-        await Form.last_visa_details.set()
-        await message.answer(
-            "24. Номер последней визы, дата выдачи последней визы, "
-            "адрес проживания по последней поездке:"
-        )
+async def ask_question(message: types.Message, question: Question):
+    await question.state.set()
+    await message.answer(
+        question.prompt,
+        reply_markup=question.keyboard() if question.keyboard else None,
+    )
 
 
-@dp.message_handler(state=Form.last_visa_details)
-async def form_last_visa_details(message: types.Message, state: FSMContext):
-    await state.update_data(last_visa_details=message.text.strip())
+async def apply_answer(message: types.Message, user: types.User, state: FSMContext,
+                       question: Question, value: str):
+    now = time.time()
     data = await state.get_data()
-    if data.get("editing"):
+    funnel.record(
+        user.id,
+        question.field,
+        "edit" if data.get("editing") else "answer",
+        now - data["asked_ts"] if "asked_ts" in data else None,
+    )
+    data.update(question.save(value))
+    data["asked_ts"] = now
+    await state.set_data(data)
+
+    target = question.branches.get(value)
+    if target is None and (data.get("editing") or question.next is None):
         await Form.confirm.set()
-        await show_preview(message, state)
+        await show_preview(message, user, data)
     else:
-        await Form.outside_india.set()
-        await message.answer(
-            "25. В момент оформления вы находитесь за пределами Индии?",
-            reply_markup=yes_no_kb("outindia"),
-        )
+        await ask_question(message, QUESTIONS[target or question.next])
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("outindia:"), state=Form.outside_india)
-async def form_outside_india(callback_query: CallbackQuery, state: FSMContext):
-    ans = callback_query.data.split(":", 1)[1]
-    value = "Да" if ans == "yes" else "Нет"
-    await state.update_data(outside_india=value)
-    data = await state.get_data()
-    editing = data.get("editing")
-    await callback_query.answer(value)
+@dp.message_handler(state=TEXT_STATES)
+async def form_text_answer(message: types.Message, state: FSMContext, raw_state: str):
+    question = QUESTIONS_BY_STATE[raw_state]
+    handler_label.set(f"form:{question.field}")
+    value = message.text.strip()
+    if question.validate:
+        error = question.validate(value)
+        if error:
+            await message.answer(error)
+            return
+    await apply_answer(message, message.from_user, state, question, value)
 
-    if editing:
-        await Form.confirm.set()
-        await show_preview(callback_query.message, state)
+
+@callbacks.route(CB_IGNORE, state="*")
+async def ignore_button(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    await callback_query.answer()
+
+
+async def form_choice_answer(question: Question, callback_query: CallbackQuery, cb,
+                             state: FSMContext, role: str):
+    handler_label.set(f"form:{question.field}")
+    if question.options is None:
+        value = cb.value
+    elif cb.value in question.options:
+        value = question.options[cb.value]
     else:
-        await Form.overstay.set()
-        await callback_query.message.answer(
-            "26. Были у вас exit permit или превышения пребывания в Индии "
-            "90 дней за 1 въезд или 180 дней в году?",
-            reply_markup=yes_no_kb("overstay"),
-        )
+        await callback_query.answer()
+        return
+    if question.validate:
+        error = question.validate(value)
+        if error:
+            await callback_query.answer(error, show_alert=True)
+            return
 
+    await callback_query.answer(question.notice.format(value=value) if question.notice else None)
+    await apply_answer(callback_query.message, callback_query.from_user, state, question, value)
+
+
+@callbacks.route(CB_CAL_NAV, state=Form.arrival_date)
+async def calendar_navigate(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    # Листание месяцев меняет только клавиатуру того же сообщения
+    try:
+        await callback_query.message.edit_reply_markup(create_calendar(cb.year, cb.month))
+    except MessageNotModified:
+        pass
+    await callback_query.answer()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("overstay:"), state=Form.overstay)
-async def form_overstay(callback_query: CallbackQuery, state: FSMContext):
-    ans = callback_query.data.split(":", 1)[1]
-    value = "Да" if ans == "yes" else "Нет"
-    await state.update_data(overstay=value)
-    await callback_query.answer(value)
 
-    await Form.confirm.set()
-    await show_preview(callback_query.message, state)
+# кнопки вопроса принимаются только в его состоянии
+for _question in _QUESTIONS:
+    if _question.callback is not None:
+        callbacks.add(
+            _question.callback,
+            functools.partial(form_choice_answer, _question),
+            state=_question.state,
+        )
 
 
 # ---------- ПРЕДПРОСМОТР / ОТПРАВКА / РЕДАКТИРОВАНИЕ ----------
 
-@dp.callback_query_handler(lambda c: c.data == "confirm:send", state=Form.confirm)
-async def confirm_send(callback_query: CallbackQuery, state: FSMContext):
+@callbacks.route(CB_CONFIRM_SEND, state=Form.confirm)
+async def confirm_send(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
     data = await state.get_data()
     user = callback_query.from_user
 
-    app_id = save_application(
+    app_id, duplicate_of, created = await run_db(
+        save_application,
         user_id=user.id,
         username=user.username or "",
         data=data,
     )
 
     await state.finish()
+    if not created:
+        # эта сессия анкеты уже отправлена: ни второй строки, ни рассылки
+        await callback_query.answer(f"Анкета №{app_id} уже отправлена.")
+        return
+    funnel.record(
+        user.id,
+        "form",
+        "submit",
+        time.time() - data["started_ts"] if "started_ts" in data else None,
+    )
 
+    if duplicate_of:
+        # Повторная подача прикрепляется к исходной анкете, которую админы
+        # уже получили, и рассылку не запускает
+        text = (
+            f"Спасибо! Анкета №{app_id} сохранена как повторная подача анкеты "
+            f"№{duplicate_of}, которая уже находится на проверке."
+        )
+    else:
+        text = f"Спасибо! Ваша анкета №{app_id} отправлена на проверку администратору."
     await callback_query.message.answer(
-        f"Спасибо! Ваша анкета №{app_id} отправлена на проверку администратору.",
-        reply_markup=admin_main_kb if is_admin(user.id) else user_main_kb,
+        text,
+        reply_markup=user_main_kb if role == ROLE_USER else admin_main_kb,
     )
 
     await callback_query.answer("Анкета отправлена.")
-    await notify_admins_about_application(app_id)
+    if not duplicate_of:
+        await notify_admins_about_application(app_id)
 
 
-@dp.callback_query_handler(lambda c: c.data == "confirm:edit", state=Form.confirm)
-async def confirm_edit(callback_query: CallbackQuery, state: FSMContext):
+@callbacks.route(CB_CONFIRM_EDIT, state=Form.confirm)
+async def confirm_edit(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
     await state.update_data(editing=True)
     await callback_query.message.answer(
         "Выберите, какой вопрос вы хотите отредактировать:",
@@ -1119,305 +3386,281 @@ async def confirm_edit(callback_query: CallbackQuery, state: FSMContext):
     await callback_query.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("edit:"), state=Form.confirm)
-async def edit_field(callback_query: CallbackQuery, state: FSMContext):
-    field = callback_query.data.split(":", 1)[1]
-
-    if field == "full_name":
-        await Form.full_name.set()
-        await callback_query.message.answer("Ваше ФИО (Фамилия Имя Отчество):")
-    elif field == "place_birth":
-        await Form.place_birth.set()
-        await callback_query.message.answer(
-            "1. Место вашего рождения (город/село/область):"
-        )
-    elif field == "email":
-        await Form.email.set()
-        await callback_query.message.answer("2. Ваша электронная почта:")
-    elif field == "passport_number":
-        await Form.passport_number.set()
-        await callback_query.message.answer("3. Номер национального паспорта:")
-    elif field == "home_address":
-        await Form.home_address.set()
-        await callback_query.message.answer(
-            "4. Домашний адрес (Город, улица, номер дома, квартира, индекс):"
-        )
-    elif field == "phone":
-        await Form.phone.set()
-        await callback_query.message.answer("5. Ваш номер телефона:")
-    elif field == "father_name":
-        await Form.father_name.set()
-        await callback_query.message.answer("6. Фамилия, имя отца (даже если нет в живых):")
-    elif field == "father_birth_place":
-        await Form.father_birth_place.set()
-        await callback_query.message.answer("7. Место рождения отца:")
-    elif field == "mother_name":
-        await Form.mother_name.set()
-        await callback_query.message.answer("8. Фамилия, имя матери (даже если нет в живых):")
-    elif field == "mother_birth_place":
-        await Form.mother_birth_place.set()
-        await callback_query.message.answer("8. Место рождения матери:")
-    elif field == "marital_status":
-        await Form.marital_status.set()
-        await callback_query.message.answer("9. Ваше семейное положение:")
-    elif field == "spouse_name":
-        await Form.spouse_name.set()
-        await callback_query.message.answer(
-            "10. Если вы в браке, укажите фамилию и имя вашего супруга(и). "
-            "Если не в браке, напишите «нет»:"
-        )
-    elif field == "spouse_birth_place":
-        await Form.spouse_birth_place.set()
-        await callback_query.message.answer(
-            "11. Место рождения вашего супруга(и). "
-            "Если не в браке, напишите «нет»:"
-        )
-    elif field == "work_place":
-        await Form.work_place.set()
-        await callback_query.message.answer(
-            "12. Название вашего места работы "
-            "(если не работаете, напишите «безработный(ая)»):"
-        )
-    elif field == "work_address":
-        await Form.work_address.set()
-        await callback_query.message.answer(
-            "13. Адрес вашего места работы "
-            "(если не работаете, напишите «безработный(ая)»):"
-        )
-    elif field == "airport":
-        await Form.airport.set()
-        await callback_query.message.answer(
-            "14. Аэропорт или порт планируемого прибытия в Индию:",
-            reply_markup=airport_kb(),
-        )
-    elif field == "visa_term":
-        await Form.visa_term.set()
-        await callback_query.message.answer(
-            "15. На какой срок нужна виза:",
-            reply_markup=visa_term_kb(),
-        )
-    elif field == "arrival_date":
-        await Form.arrival_date.set()
-        await callback_query.message.answer(
-            "16. Дата планируемого прибытия в Индию:",
-            reply_markup=create_calendar(),
-        )
-    elif field == "contact_name":
-        await Form.contact_name.set()
-        await callback_query.message.answer("17. Фамилия и имя контактного лица в России:")
-    elif field == "contact_phone":
-        await Form.contact_phone.set()
-        await callback_query.message.answer("18. Телефон контактного лица в России:")
-    elif field == "contact_address":
-        await Form.contact_address.set()
-        await callback_query.message.answer("19. Адрес контактного лица в России:")
-    elif field == "hotel_booked":
-        await Form.hotel_booked.set()
-        await callback_query.message.answer(
-            "20. Если забронирован отель, выберите «Да». Если нет — «Нет»:",
-            reply_markup=yes_no_kb("hotel"),
-        )
-    elif field == "five_year_visa":
-        await Form.five_year_visa.set()
-        await callback_query.message.answer(
-            "21. Были ли у вас 5-летние визы в Индию?",
-            reply_markup=yes_no_kb("fivevisa"),
-        )
-    elif field == "visa_refusal":
-        await Form.visa_refusal.set()
-        await callback_query.message.answer(
-            "22. Были ли у вас отказы по визе в Индию:",
-            reply_markup=yes_no_kb("vref"),
-        )
-    elif field == "trips_last_5y":
-        await Form.trips_last_5y.set()
-        await callback_query.message.answer(
-            "23. Если были поездки в Индию за последние 5 лет, "
-            "укажите даты и цель поездок:"
-        )
-    elif field == "last_visa_details":
-        await Form.last_visa_details.set()
-        await callback_query.message.answer(
-            "24. Номер последней визы, дата выдачи последней визы, "
-            "адрес проживания по последней поездке:"
-        )
-    elif field == "outside_india":
-        await Form.outside_india.set()
-        await callback_query.message.answer(
-            "25. В момент оформления вы находитесь за пределами Индии?",
-            reply_markup=yes_no_kb("outindia"),
-        )
-    elif field == "overstay":
-        await Form.overstay.set()
-        await callback_query.message.answer(
-            "26. Были у вас exit permit или превышения пребывания в Индии "
-            "90 дней за 1 въезд или 180 дней в году?",
-            reply_markup=yes_no_kb("overstay"),
-        )
-
+@callbacks.route(CB_EDIT, state=Form.confirm)
+async def edit_field(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    question = QUESTIONS.get(cb.field)
+    if question is not None:
+        await state.update_data(asked_ts=time.time())
+        await ask_question(callback_query.message, question)
     await callback_query.answer()
 
 
 # ===================== АДМИН-ПАНЕЛЬ =====================
 
 @dp.message_handler(lambda m: m.text == "Админ-панель")
-async def admin_panel(message: types.Message):
-    if not is_admin(message.from_user.id):
+async def admin_panel(message: types.Message, role: str):
+    if role == ROLE_USER:
         await message.answer("Админ-панель доступна только администраторам.")
         return
     await message.answer("Админ-панель:", reply_markup=admin_panel_kb())
 
 
-@dp.callback_query_handler(lambda c: c.data == "admin:new")
-async def admin_new(callback_query: CallbackQuery):
-    if not is_admin(callback_query.from_user.id):
-        await callback_query.answer("Нет доступа", show_alert=True)
+@dp.message_handler(commands=["export"])
+async def admin_export(message: types.Message, role: str):
+    if role == ROLE_USER:
+        await message.answer("Выгрузка доступна только администраторам.")
         return
+    try:
+        fmt, status, since_ts, until_ts = parse_export_args(message.get_args() or "")
+    except ValueError as e:
+        await message.answer(
+            f"{e}\n\nФормат: /export [csv|jsonl|xlsx] [new|ok|rej|all] "
+            "[ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]]"
+        )
+        return
+
+    out, count = await run_db(export_applications, fmt, status, since_ts, until_ts)
+    with out:
+        if not count:
+            await message.answer("Заявок по этим условиям нет.")
+            return
+        size = out.seek(0, io.SEEK_END)
+        out.seek(0)
+        if size > TG_DOCUMENT_LIMIT:
+            await message.answer(
+                "Файл выгрузки больше 50 МБ и не может быть отправлен. "
+                "Сузьте период или выберите статус."
+            )
+            return
+        filename = f"applications_{datetime.utcnow():%Y%m%d_%H%M%S}.{fmt}"
+        await message.answer_document(
+            types.InputFile(out, filename=filename),
+            caption=f"Заявок: {count}",
+        )
+
 
-    apps = list_applications(only_pending=True, limit=20)
-    if not apps:
-        await callback_query.message.answer("Новых заявок нет.")
+async def show_applications_page(message: types.Message, flt: str, direction: str = "n",
+                                 cursor: tuple = None):
+    # Одна страница списка заявок в одном сообщении, которое редактируется
+    # на месте при листании и смене фильтра
+    title, status = APP_FILTERS.get(flt, APP_FILTERS["all"])
+    before = cursor if direction == "b" else None
+    after = cursor if direction == "a" else None
+    rows = await run_db(
+        list_applications, status=status, before=before, after=after, limit=APPS_PAGE_SIZE + 1
+    )
+    has_more = len(rows) > APPS_PAGE_SIZE
+    if direction == "a":
+        rows = rows[-APPS_PAGE_SIZE:]
+        has_newer, has_older = has_more, True
     else:
-        for app in apps:
+        rows = rows[:APPS_PAGE_SIZE]
+        has_newer, has_older = direction == "b", has_more
+
+    if rows:
+        lines = [f"Заявки: {title.lower()}", ""]
+        for app in rows:
             uname = f"@{app['username']}" if app["username"] else "без username"
-            status = app["status"] or "в ожидании"
-            text = (
-                f"Заявка №{app['id']} от {app['created_at']}\n"
-                f"Пользователь: {uname}\n"
-                f"Статус: {status}"
-            )
-            kb = InlineKeyboardMarkup().add(
-                InlineKeyboardButton(
-                    "Открыть", callback_data=f"admin:open:{app['id']}"
-                )
+            status_text = app["status"] or "в ожидании"
+            lines.append(
+                f"№{app['id']} от {format_ts(app['created_ts'])} — {uname}, {status_text}"
             )
-            await callback_query.message.answer(text, reply_markup=kb)
+        text = "\n".join(lines)
+    elif flt == "new":
+        text = "Новых заявок нет."
+    else:
+        text = "Заявок пока нет."
+
+    kb = applications_page_kb(rows, flt, has_newer, has_older)
+    try:
+        await message.edit_text(text, reply_markup=kb)
+    except MessageNotModified:
+        pass
+
 
+@callbacks.route(CB_ADMIN_NEW)
+async def admin_new(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    if role == ROLE_USER:
+        await callback_query.answer("Нет доступа", show_alert=True)
+        return
+
+    await show_applications_page(callback_query.message, "new")
     await callback_query.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data == "admin:all")
-async def admin_all(callback_query: CallbackQuery):
-    if not is_admin(callback_query.from_user.id):
+@callbacks.route(CB_ADMIN_ALL)
+async def admin_all(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    if role == ROLE_USER:
         await callback_query.answer("Нет доступа", show_alert=True)
         return
 
-    apps = list_applications(only_pending=False, limit=20)
-    if not apps:
-        await callback_query.message.answer("Заявок пока нет.")
-    else:
-        for app in apps:
-            uname = f"@{app['username']}" if app["username"] else "без username"
-            status = app["status"] or "в ожидании"
-            text = (
-                f"Заявка №{app['id']} от {app['created_at']}\n"
-                f"Пользователь: {uname}\n"
-                f"Статус: {status}"
-            )
-            kb = InlineKeyboardMarkup().add(
-                InlineKeyboardButton(
-                    "Открыть", callback_data=f"admin:open:{app['id']}"
-                )
-            )
-            await callback_query.message.answer(text, reply_markup=kb)
+    await show_applications_page(callback_query.message, "all")
+    await callback_query.answer()
+
+
+@callbacks.route(CB_APPS)
+async def admin_apps_page(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    if role == ROLE_USER:
+        await callback_query.answer("Нет доступа", show_alert=True)
+        return
 
+    await show_applications_page(
+        callback_query.message, cb.flt, cb.direction, (cb.ts, cb.app_id)
+    )
     await callback_query.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("admin:open:"))
-async def admin_open(callback_query: CallbackQuery):
-    if not is_admin(callback_query.from_user.id):
+@callbacks.route(CB_ADMIN_PANEL)
+async def admin_back_to_panel(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    if role == ROLE_USER:
         await callback_query.answer("Нет доступа", show_alert=True)
         return
 
+    await callback_query.message.edit_text("Админ-панель:", reply_markup=admin_panel_kb())
+    await callback_query.answer()
+
+
+# ---------- ПОИСК ----------
+
+async def show_search_page(message: types.Message, query: str, page: int, edit: bool):
+    rows = await run_db(
+        search_applications, query, limit=APPS_PAGE_SIZE + 1, offset=page * APPS_PAGE_SIZE
+    )
+    has_next = len(rows) > APPS_PAGE_SIZE
+    rows = rows[:APPS_PAGE_SIZE]
+    if rows:
+        lines = [f"Поиск «{query}», страница {page + 1}:"]
+        for app in rows:
+            uname = f"@{app['username']}" if app["username"] else "без username"
+            lines.append(
+                f"№{app['id']} от {format_ts(app['created_ts'])} — {app['full_name']}, "
+                f"{uname}, {app['status'] or 'в ожидании'}"
+            )
+        text = "\n".join(lines)
+    else:
+        text = f"По запросу «{query}» ничего не найдено."
+
+    kb = search_page_kb(rows, page, has_next)
+    if not edit:
+        await message.answer(text, reply_markup=kb)
+        return
     try:
-        app_id = int(callback_query.data.split(":", 2)[2])
-    except ValueError:
-        await callback_query.answer("Ошибка ID", show_alert=True)
+        await message.edit_text(text, reply_markup=kb)
+    except MessageNotModified:
+        pass
+
+
+@dp.message_handler(commands=["find"])
+async def admin_find(message: types.Message, state: FSMContext, role: str):
+    if role == ROLE_USER:
+        await message.answer("Поиск доступен только администраторам.")
+        return
+    query = (message.get_args() or "").strip()
+    if not fts_query(query):
+        await message.answer(
+            "Укажите, что искать: /find <ФИО, email, номер паспорта или телефона>"
+        )
+        return
+    # Запрос не помещается в callback_data, поэтому листание берёт его из FSM
+    await state.update_data(search_query=query)
+    await show_search_page(message, query, 0, edit=False)
+
+
+@callbacks.route(CB_SEARCH)
+async def admin_search_page(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    if role == ROLE_USER:
+        await callback_query.answer("Нет доступа", show_alert=True)
+        return
+    query = (await state.get_data()).get("search_query")
+    if not query:
+        await callback_query.answer("Поиск устарел, повторите /find", show_alert=True)
+        return
+    await show_search_page(callback_query.message, query, max(cb.page, 0), edit=True)
+    await callback_query.answer()
+
+
+@callbacks.route(CB_ADMIN_OPEN)
+async def admin_open(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    if role == ROLE_USER:
+        await callback_query.answer("Нет доступа", show_alert=True)
         return
 
-    app = get_application(app_id)
+    app_id = cb.app_id
+    app = await run_db(get_application, app_id)
     if not app:
         await callback_query.answer("Заявка не найдена", show_alert=True)
         return
 
-    text = format_application_text(app)
-    await callback_query.message.answer(text, reply_markup=admin_application_kb(app_id))
+    parts = application_text_parts(app)
+    duplicates = await run_db(list_duplicates, app_id)
+    if duplicates:
+        parts = parts + ["Повторные подачи этой анкеты: " + ", ".join(f"№{i}" for i in duplicates)]
+    await answer_parts(
+        callback_query.message,
+        parts,
+        reply_markup=admin_application_kb(app_id),
+    )
     await callback_query.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("approve:"))
-async def admin_approve(callback_query: CallbackQuery):
-    if not is_admin(callback_query.from_user.id):
+@callbacks.route(CB_APPROVE)
+async def admin_approve(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    if role == ROLE_USER:
         await callback_query.answer("Нет доступа", show_alert=True)
         return
 
-    try:
-        app_id = int(callback_query.data.split(":", 1)[1])
-    except ValueError:
-        await callback_query.answer("Ошибка ID", show_alert=True)
-        return
-
-    app = get_application(app_id)
+    app_id = cb.app_id
+    app = await run_db(get_application, app_id)
     if not app:
         await callback_query.answer("Заявка не найдена", show_alert=True)
         return
 
-    update_application_status(app_id, "одобрена", callback_query.from_user.id)
+    changed = await run_db(
+        update_application_status, app_id, "одобрена", callback_query.from_user.id
+    )
+    if not changed:
+        await callback_query.answer("Анкета уже одобрена.")
+        return
     await callback_query.answer("Анкета одобрена.")
 
-    try:
-        await bot.send_message(
-            app["user_id"],
-            f"Ваша анкета №{app_id} одобрена.",
-        )
-    except Exception as e:
-        logging.warning(f"Не удалось отправить уведомление пользователю: {e}")
+    await outbox.enqueue(app["user_id"], f"Ваша анкета №{app_id} одобрена.")
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("reject:"))
-async def admin_reject(callback_query: CallbackQuery):
-    if not is_admin(callback_query.from_user.id):
+@callbacks.route(CB_REJECT)
+async def admin_reject(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    if role == ROLE_USER:
         await callback_query.answer("Нет доступа", show_alert=True)
         return
 
-    try:
-        app_id = int(callback_query.data.split(":", 1)[1])
-    except ValueError:
-        await callback_query.answer("Ошибка ID", show_alert=True)
-        return
-
-    app = get_application(app_id)
+    app_id = cb.app_id
+    app = await run_db(get_application, app_id)
     if not app:
         await callback_query.answer("Заявка не найдена", show_alert=True)
         return
 
-    update_application_status(app_id, "отклонена", callback_query.from_user.id)
+    changed = await run_db(
+        update_application_status, app_id, "отклонена", callback_query.from_user.id
+    )
+    if not changed:
+        await callback_query.answer("Анкета уже отклонена.")
+        return
     await callback_query.answer("Анкета отклонена.")
 
-    try:
-        await bot.send_message(
-            app["user_id"],
-            f"Ваша анкета №{app_id} отклонена. "
-            "При необходимости свяжитесь с администратором.",
-        )
-    except Exception as e:
-        logging.warning(f"Не удалось отправить уведомление пользователю: {e}")
+    await outbox.enqueue(
+        app["user_id"],
+        f"Ваша анкета №{app_id} отклонена. "
+        "При необходимости свяжитесь с администратором.",
+    )
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("msguser:"))
-async def admin_msg_user(callback_query: CallbackQuery, state: FSMContext):
-    if not is_admin(callback_query.from_user.id):
+@callbacks.route(CB_MSG_USER)
+async def admin_msg_user(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    if role == ROLE_USER:
         await callback_query.answer("Нет доступа", show_alert=True)
         return
 
-    try:
-        app_id = int(callback_query.data.split(":", 1)[1])
-    except ValueError:
-        await callback_query.answer("Ошибка ID", show_alert=True)
-        return
-
-    app = get_application(app_id)
+    app_id = cb.app_id
+    app = await run_db(get_application, app_id)
     if not app:
         await callback_query.answer("Заявка не найдена", show_alert=True)
         return
@@ -1434,8 +3677,8 @@ async def admin_msg_user(callback_query: CallbackQuery, state: FSMContext):
 
 
 @dp.message_handler(state=AdminDialog.waiting_for_text, content_types=types.ContentTypes.TEXT)
-async def admin_send_text_to_user(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+async def admin_send_text_to_user(message: types.Message, state: FSMContext, role: str):
+    if role == ROLE_USER:
         await message.answer("Только администратор может отправлять такие сообщения.")
         await state.finish()
         return
@@ -1447,26 +3690,22 @@ async def admin_send_text_to_user(message: types.Message, state: FSMContext):
         await state.finish()
         return
 
-    try:
-        await bot.send_message(
-            target_user_id,
-            "Сообщение от администратора:\n\n" + message.text.strip(),
-        )
-        await message.answer("Сообщение отправлено пользователю.")
-    except Exception as e:
-        logging.warning(f"Не удалось отправить сообщение пользователю: {e}")
-        await message.answer("Не удалось отправить сообщение пользователю.")
+    await outbox.enqueue(
+        target_user_id,
+        "Сообщение от администратора:\n\n" + message.text.strip(),
+    )
+    await message.answer("Сообщение поставлено в очередь на отправку пользователю.")
 
     await state.finish()
 
 
-@dp.callback_query_handler(lambda c: c.data == "admin:admins")
-async def admin_list_admins(callback_query: CallbackQuery):
-    if not is_admin(callback_query.from_user.id):
+@callbacks.route(CB_ADMIN_ADMINS)
+async def admin_list_admins(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    if role == ROLE_USER:
         await callback_query.answer("Нет доступа", show_alert=True)
         return
 
-    admins = get_admins()
+    admins = await run_db(get_admins)
     if not admins:
         await callback_query.message.answer("Администраторы не найдены.")
     else:
@@ -1480,22 +3719,66 @@ async def admin_list_admins(callback_query: CallbackQuery):
     await callback_query.answer()
 
 
-@dp.callback_query_handler(lambda c: c.data.startswith("makeadmin:"))
-async def admin_make_admin(callback_query: CallbackQuery):
-    if not is_superadmin(callback_query.from_user.id):
+def format_seconds(seconds) -> str:
+    if seconds is None:
+        return "—"
+    if seconds < 60:
+        return f"{seconds:.0f} с"
+    if seconds < 3600:
+        return f"{seconds / 60:.1f} мин"
+    return f"{seconds / 3600:.1f} ч"
+
+
+def format_funnel(stats: dict, days: int) -> str:
+    started, _ = stats.get(("form", "start"), (0, None))
+    lines = [f"Воронка анкеты за {days} дн.", f"Начали: {started}", ""]
+    for question in _QUESTIONS:
+        answered, avg = stats.get((question.field, "answer"), (0, None))
+        if not answered:
+            continue
+        share = f"{answered * 100 / started:.0f}%" if started else "—"
+        title = question.label.strip() if question.label else question.field
+        line = f"{title}: {answered} ({share}), ~{format_seconds(avg)}"
+        edits, _ = stats.get((question.field, "edit"), (0, None))
+        if edits:
+            line += f", правок {edits}"
+        lines.append(line)
+    submitted, avg = stats.get(("form", "submit"), (0, None))
+    share = f"{submitted * 100 / started:.0f}%" if started else "—"
+    lines += ["", f"Отправили: {submitted} ({share})", f"Среднее время заполнения: {format_seconds(avg)}"]
+    return "\n".join(lines)
+
+
+@callbacks.route(CB_ADMIN_FUNNEL)
+async def admin_funnel(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    if role == ROLE_USER:
+        await callback_query.answer("Нет доступа", show_alert=True)
+        return
+
+    # Недописанные события из буфера тоже должны попасть в отчёт
+    await funnel.flush()
+    since = (datetime.utcnow() - timedelta(days=cb.days - 1)).strftime("%Y-%m-%d")
+    stats = await run_db(funnel_stats, since)
+    try:
+        await callback_query.message.edit_text(
+            format_funnel(stats, cb.days), reply_markup=funnel_kb(cb.days)
+        )
+    except MessageNotModified:
+        pass
+    await callback_query.answer()
+
+
+@callbacks.route(CB_MAKE_ADMIN)
+async def admin_make_admin(callback_query: CallbackQuery, cb, state: FSMContext, role: str):
+    if role != ROLE_SUPERADMIN:
         await callback_query.answer(
             "Только главный администратор может назначать админов.",
             show_alert=True,
         )
         return
 
-    try:
-        app_id = int(callback_query.data.split(":", 1)[1])
-    except ValueError:
-        await callback_query.answer("Ошибка ID", show_alert=True)
-        return
-
-    app = get_application(app_id)
+    app_id = cb.app_id
+    app = await run_db(get_application, app_id)
     if not app:
         await callback_query.answer("Заявка не найдена", show_alert=True)
         return
@@ -1503,21 +3786,151 @@ async def admin_make_admin(callback_query: CallbackQuery):
     target_user_id = app["user_id"]
     target_username = app["username"] or ""
 
-    upsert_admin(target_user_id, target_username, is_super=False)
+    await run_db(upsert_admin, target_user_id, target_username, is_super=False)
     await callback_query.answer("Пользователь назначен администратором.")
 
+    await outbox.enqueue(
+        target_user_id,
+        "Вы назначены администратором бота. "
+        "Перезапустите диалог с помощью /start, чтобы увидеть админ-панель.",
+    )
+
+
+# ===================== ЗАПУСК =====================
+
+async def reload_roles_periodically():
+    while True:
+        await asyncio.sleep(ROLES_RELOAD_INTERVAL)
+        try:
+            await run_db(reload_admin_roles)
+        except Exception:
+            logging.exception("Не удалось перечитать список админов")
+
+
+_service_tasks = []
+
+
+# ---------- МЕТРИКИ ----------
+
+_metrics_runner = None
+
+
+async def collect_runtime_metrics():
+    stats = storage.stats()
+    FSM_SESSIONS.set(stats["cached"], "cached")
+    FSM_SESSIONS.set(stats["dirty"], "dirty")
+    FSM_SESSIONS.set(await run_db(count_fsm_sessions), "db")
+    OUTBOX_DEPTH.set(outbox.stats["depth"])
+    scheduler_stats = dp.scheduler.stats()
+    UPDATES_PENDING.set(scheduler_stats["pending"])
+    UPDATE_QUEUES.set(scheduler_stats["chats"])
+    for result in ("enqueued", "sent", "retried", "failed"):
+        OUTBOX_MESSAGES.set(outbox.stats[result], result)
+
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    await collect_runtime_metrics()
+    return web.Response(
+        body=render_metrics().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+async def start_metrics_server():
+    global _metrics_runner
+    app = web.Application()
+    app.router.add_get(METRICS_PATH, metrics_handler)
+    _metrics_runner = web.AppRunner(app)
+    await _metrics_runner.setup()
+    await web.TCPSite(_metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logging.info(f"Метрики: http://{METRICS_HOST}:{METRICS_PORT}{METRICS_PATH}")
+
+
+async def stop_metrics_server():
+    global _metrics_runner
+    if _metrics_runner is not None:
+        await _metrics_runner.cleanup()
+        _metrics_runner = None
+
+
+async def on_startup(dispatcher: Dispatcher):
+    dp.scheduler.start()
+    outbox.start()
+    funnel.start()
+    _service_tasks.append(asyncio.create_task(reload_roles_periodically()))
+    if METRICS_PORT:
+        await start_metrics_server()
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    # aiogram останавливает polling только после on_shutdown; без этого
+    # апдейты принимались бы, пока очереди дорабатывают и закрывается база
+    dispatcher.stop_polling()
+    for task in _service_tasks:
+        task.cancel()
+    _service_tasks.clear()
+    await dp.scheduler.drain()
+    await stop_metrics_server()
+    await outbox.stop()
+    await funnel.stop()
+    if recorder is not None:
+        recorder.close()
+    # сессии FSM сбрасываем в базу до остановки потоков БД
+    await dispatcher.storage.close()
+    db_write_executor.shutdown(wait=True)
+    db_read_executor.shutdown(wait=True)
+    close_db()
+
+
+# ---------- WEBHOOK ----------
+
+# Апдейт подтверждается сразу после постановки в очередь чата, обработка
+# идёт в фоне (см. UpdateScheduler). Когда очереди заполнены, запрос ждёт
+# свободного места (backpressure).
+
+async def webhook_handler(request: web.Request) -> web.Response:
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return web.Response(status=403)
     try:
-        await bot.send_message(
-            target_user_id,
-            "Вы назначены администратором бота. "
-            "Перезапустите диалог с помощью /start, чтобы увидеть админ-панель.",
+        update = types.Update(**await request.json())
+    except (ValueError, TypeError):
+        return web.Response(status=400)
+
+    # через process_updates: повторные доставки отбрасываются до очереди
+    await dp.process_updates([update])
+    return web.Response()
+
+
+async def on_webhook_startup(app: web.Application):
+    await on_startup(dp)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=min(WEBHOOK_CONCURRENCY, 100),
         )
-    except Exception as e:
-        logging.warning(f"Не удалось уведомить нового админа: {e}")
 
 
-# ===================== ЗАПУСК =====================
+async def on_webhook_shutdown(app: web.Application):
+    await on_shutdown(dp)
+    session = await bot.get_session()
+    await session.close()
+
+
+def create_webhook_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    app.on_startup.append(on_webhook_startup)
+    app.on_shutdown.append(on_webhook_shutdown)
+    return app
+
 
 if __name__ == "__main__":
     init_db()
-    executor.start_polling(dp, skip_updates=True)
\ No newline at end of file
+    if BOT_MODE == "webhook":
+        web.run_app(create_webhook_app(), host=WEBAPP_HOST, port=WEBAPP_PORT)
+    else:
+        executor.start_polling(
+            dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown
+        )
@@ -0,0 +1,233 @@
+"""Воспроизведение записанного потока апдейтов.
+
+Запись включается в работающем боте переменной RECORD_FILE (см. main.py):
+
+    RECORD_FILE=updates.jsonl python main.py
+
+Воспроизведение прогоняет апдейты через Dispatcher бота на чистой временной
+базе, запросы к Bot API уходят в заглушку из fake_telegram.py:
+
+    python replay.py updates.jsonl                        # без пауз
+    python replay.py updates.jsonl --speed 1              # в записанном темпе
+    python replay.py updates.jsonl --speed 10             # в 10 раз быстрее
+    python replay.py updates.jsonl --out new.json --compare old.json
+
+Без пауз апдейты обрабатываются по одному, поэтому результаты разных версий
+бота сравнимы между собой. С --speed апдейты запускаются в записанные моменты
+и обрабатываются параллельно, как в проде. Отчёт — время на апдейт по
+хендлерам; --compare показывает разницу с прошлым отчётом и завершается
+с кодом 1, если p50 какого-то хендлера вырос больше, чем на --threshold.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from collections import Counter, defaultdict
+
+from fake_telegram import FakeTelegram, percentile
+
+
+def load_records(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def sender(record: dict) -> dict:
+    update = record["u"]
+    return (update.get("message") or update.get("callback_query"))["from"]
+
+
+def recorded_messages(records: list) -> list:
+    # Сообщения бота, под которыми нажимали кнопки
+    return [
+        record["u"]["callback_query"]["message"]
+        for record in records
+        if "message" in record["u"].get("callback_query", {})
+    ]
+
+
+def last_message_id(records: list) -> int:
+    update_messages = (
+        record["u"].get("message") or record["u"].get("callback_query", {}).get("message")
+        for record in records
+    )
+    return max((message["message_id"] for message in update_messages if message), default=0)
+
+
+def recorded_admins(records: list) -> dict:
+    # псевдоним -> главный ли админ, по ролям на момент записи
+    return {
+        sender(record)["id"]: record["r"] == "superadmin"
+        for record in records
+        if record["r"] != "user"
+    }
+
+
+def configure_env(args, admins: dict):
+    # Настройки бота читаются при импорте main, поэтому задаются до него
+    superadmins = [user_id for user_id, is_super in admins.items() if is_super]
+    os.environ.update(
+        BOT_TOKEN="123456:replay",
+        SUPER_ADMIN_ID=str(superadmins[0] if superadmins else 1),
+        TELEGRAM_API_URL=f"http://127.0.0.1:{args.api_port}",
+        DB_PATH=args.db or os.path.join(tempfile.mkdtemp(prefix="replay-"), "bot.db"),
+        RECORD_FILE="",
+        METRICS_PORT="0",
+        TG_CHAT_RATE="1000",
+        TG_CHAT_BURST="1000",
+        TG_GLOBAL_RATE="100000",
+    )
+
+
+async def replay(args, records: list, admins: dict) -> dict:
+    import logging
+    import main
+    from aiogram import Bot, Dispatcher, types
+
+    # миграции и служебные сообщения бота в отчёте не нужны
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # Записанные сообщения с кнопками заводятся в заглушке, иначе их правка
+    # (листание, календарь, «Назад») падала бы с «message to edit not found»
+    # и отчёт мерил бы путь ошибки. Новые сообщения получают id после
+    # записанных, чтобы не совпасть с ними.
+    fake = FakeTelegram(first_message_id=last_message_id(records) + 1)
+    for message in recorded_messages(records):
+        fake.add_message(message)
+    await fake.start(port=args.api_port)
+    main.init_db()
+    for user_id, is_super in admins.items():
+        main.upsert_admin(user_id, "", is_super)
+    Bot.set_current(main.bot)
+    Dispatcher.set_current(main.dp)
+    await main.on_startup(main.dp)
+
+    timings = defaultdict(list)
+    errors = Counter()
+
+    async def handle(record):
+        # Выполняется отдельной задачей: aiogram кэширует состояние FSM в
+        # contextvar, и апдейты не должны видеть контекст друг друга. Внутри
+        # задачи notify вызывается напрямую, а не через process_updates
+        # (gather), чтобы метка хендлера из MetricsMiddleware была видна здесь.
+        main.handler_label.set("-")
+        update = types.Update(**record["u"])
+        started = time.perf_counter()
+        try:
+            await main.dp.updates_handler.notify(update)
+        except Exception:
+            errors[main.handler_label.get()] += 1
+        timings[main.handler_label.get()].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    if args.speed <= 0:
+        for record in records:
+            await asyncio.ensure_future(handle(record))
+    else:
+        # Разные пользователи обрабатываются параллельно, апдейты одного
+        # пользователя — по порядку, как и было при записи: при ускорении
+        # иначе ответ мог бы обогнать вопрос, на который он отвечает
+        async def after(previous, record):
+            if previous is not None:
+                await previous
+            await handle(record)
+
+        last = {}
+        for record in records:
+            delay = started + record["t"] / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            user_id = sender(record)["id"]
+            last[user_id] = asyncio.ensure_future(after(last.get(user_id), record))
+        await asyncio.gather(*last.values())
+    elapsed = time.perf_counter() - started
+
+    await main.on_shutdown(main.dp)
+    await (await main.bot.get_session()).close()
+    await fake.stop()
+
+    handlers = {}
+    for label, values in sorted(timings.items()):
+        ms = [v * 1000 for v in values]
+        handlers[label] = {
+            "n": len(ms),
+            "p50": percentile(ms, 50),
+            "p95": percentile(ms, 95),
+            "p99": percentile(ms, 99),
+            "mean": sum(ms) / len(ms),
+            "errors": errors[label],
+        }
+    return {
+        "updates": len(records),
+        "speed": args.speed,
+        "elapsed": elapsed,
+        "handlers": handlers,
+        "api_calls": dict(fake.calls),
+    }
+
+
+def print_report(report: dict):
+    print(
+        f"апдейтов: {report['updates']} за {report['elapsed']:.2f} с "
+        f"({report['updates'] / report['elapsed']:.1f}/с), скорость: {report['speed'] or 'без пауз'}"
+    )
+    print(f"{'хендлер':<28} {'n':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'mean':>8}  ошибки")
+    for label, h in report["handlers"].items():
+        print(
+            f"{label:<28} {h['n']:>6} {h['p50']:>8.2f} {h['p95']:>8.2f} "
+            f"{h['p99']:>8.2f} {h['mean']:>8.2f}  {h['errors'] or ''}"
+        )
+
+
+def compare_reports(old: dict, new: dict, threshold: float) -> int:
+    # Сравнение p50 по хендлерам; возвращает число регрессий
+    regressions = 0
+    print(f"\n{'хендлер':<28} {'было p50':>10} {'стало p50':>10} {'разница':>9}")
+    for label in sorted(set(old["handlers"]) | set(new["handlers"])):
+        before = old["handlers"].get(label)
+        after = new["handlers"].get(label)
+        if before is None or after is None:
+            print(f"{label:<28} {'есть только в ' + ('новом' if before is None else 'старом'):>31}")
+            continue
+        delta = (after["p50"] - before["p50"]) / before["p50"] if before["p50"] else 0.0
+        mark = ""
+        if delta > threshold:
+            mark = "  регрессия"
+            regressions += 1
+        print(f"{label:<28} {before['p50']:>10.2f} {after['p50']:>10.2f} {delta:>+8.0%}{mark}")
+    return regressions
+
+
+def main_cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных апдейтов")
+    parser.add_argument("log", help="JSONL, записанный с RECORD_FILE")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="0 — без пауз и по одному, 1 — записанный темп, N — в N раз быстрее")
+    parser.add_argument("--db", help="файл базы (по умолчанию временный)")
+    parser.add_argument("--api-port", type=int, default=8082, help="порт заглушки Bot API")
+    parser.add_argument("--out", help="сохранить отчёт в JSON")
+    parser.add_argument("--compare", help="отчёт JSON прошлого прогона для сравнения")
+    parser.add_argument("--threshold", type=float, default=0.2, help="допустимый рост p50 (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    records = load_records(args.log)
+    admins = recorded_admins(records)
+    configure_env(args, admins)
+    report = asyncio.run(replay(args, records, admins))
+    print_report(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            regressions = compare_reports(json.load(f), report, args.threshold)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
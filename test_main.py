@@ -0,0 +1,141 @@
+"""Тесты работы с базой: повторные подачи, смена статуса, хранилище FSM.
+
+Каждый тест получает чистую временную базу:
+
+    python -m pytest -q
+"""
+import os
+import asyncio
+import tempfile
+
+# Настройки бота читаются при импорте main, поэтому задаются до него
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("SUPER_ADMIN_ID", "1")
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="bot-test-"), "bot.db"))
+os.environ["RECORD_FILE"] = ""
+
+import pytest
+
+import main
+
+PENDING = "в ожидании"
+APPROVED = "одобрена"
+
+
+@pytest.fixture(autouse=True)
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "DB_PATH", str(tmp_path / "bot.db"))
+    main.init_db()
+    yield
+    main.close_db()
+
+
+def form(passport="AB1234567", phone="+7 900 123-45-67", email="user@example.com", **extra):
+    return dict(passport_number=passport, phone=phone, email=email, full_name="Test", **extra)
+
+
+def column(app_id: int, name: str):
+    return main.get_application(app_id)[name]
+
+
+# ---------- повторные подачи ----------
+
+def test_repeat_submission_is_attached_to_original():
+    first, duplicate_of, created = main.save_application(10, "u", form())
+    assert (duplicate_of, created) == (None, True)
+
+    second, duplicate_of, created = main.save_application(10, "u", form(passport=""))
+    assert (duplicate_of, created) == (first, True)
+    assert column(second, "similar_to") is None
+    assert main.list_duplicates(first) == [second]
+
+
+def test_other_users_passport_is_only_marked_similar():
+    first, _, _ = main.save_application(10, "u", form())
+
+    other, duplicate_of, created = main.save_application(
+        20, "v", form(phone="+7 900 000-00-00", email="other@example.com")
+    )
+    assert (duplicate_of, created) == (None, True)
+    assert column(other, "similar_to") == first
+    assert main.list_duplicates(first) == []
+
+
+def test_other_users_phone_and_email_are_ignored():
+    main.save_application(10, "u", form())
+
+    other, duplicate_of, _ = main.save_application(20, "v", form(passport="XY7654321"))
+    assert duplicate_of is None
+    assert column(other, "similar_to") is None
+
+
+def test_same_submission_is_saved_once():
+    data = form(submission_token="t" * 32)
+    first = main.save_application(10, "u", data)
+    again = main.save_application(10, "u", data)
+
+    assert first == (first[0], None, True)
+    assert again == (first[0], None, False)
+    count = main.get_conn().execute("SELECT COUNT(*) FROM applications").fetchone()[0]
+    assert count == 1
+
+
+# ---------- смена статуса ----------
+
+def test_status_change_is_reported_once():
+    app_id, _, _ = main.save_application(10, "u", form())
+
+    assert main.update_application_status(app_id, APPROVED, 1) is True
+    assert main.update_application_status(app_id, APPROVED, 2) is False
+    assert column(app_id, "status") == APPROVED
+    assert column(app_id, "admin_id") == 1
+
+
+def test_status_covers_own_repeats_but_not_similar():
+    first, _, _ = main.save_application(10, "u", form())
+    repeat, _, _ = main.save_application(10, "u", form(passport=""))
+    similar, _, _ = main.save_application(20, "v", form(phone="", email=""))
+
+    assert main.update_application_status(first, APPROVED, 1) is True
+    assert column(repeat, "status") == APPROVED
+    assert column(similar, "status") == PENDING
+
+
+# ---------- хранилище FSM ----------
+
+def test_storage_sessions_survive_restart():
+    async def scenario():
+        storage = main.SQLiteStorage(flush_interval=60)
+        await storage.set_state(chat=5, user=5, state="Form:email")
+        await storage.update_data(chat=5, user=5, data={"email": "a@b.c"})
+        await storage.set_state(chat=6, user=6, state="Form:phone")
+        await storage.close()
+
+        # закончившаяся сессия удаляется из базы при следующей записи
+        restarted = main.SQLiteStorage(flush_interval=60)
+        await restarted.reset_state(chat=6, user=6)
+        await restarted.close()
+
+        fresh = main.SQLiteStorage(flush_interval=60)
+        result = (
+            await fresh.get_state(chat=5, user=5),
+            await fresh.get_data(chat=5, user=5),
+            await fresh.get_state(chat=6, user=6),
+        )
+        await fresh.close()
+        return result
+
+    assert asyncio.run(scenario()) == ("Form:email", {"email": "a@b.c"}, None)
+
+
+def test_storage_keeps_evicted_session_until_flush():
+    async def scenario():
+        storage = main.SQLiteStorage(cache_size=1, flush_interval=60)
+        await storage.update_data(chat=5, user=5, data={"step": 1})
+        # вытесняет сессию 5 из кэша до записи в базу
+        await storage.update_data(chat=6, user=6, data={"step": 2})
+        data = await storage.get_data(chat=5, user=5)
+        await storage.close()
+        return data
+
+    assert asyncio.run(scenario()) == {"step": 1}